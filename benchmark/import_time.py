@@ -0,0 +1,69 @@
+"""
+Benchmark the time it takes to import lpaprogram.
+
+pandas and matplotlib are imported by lpaprogram only when calibration
+data is read or a plot is made. This script compares the time it takes to
+import lpaprogram alone against the time it takes when pandas and
+matplotlib are imported as well, as was the case when both were imported
+at the top of the module. Each import is timed in a fresh interpreter.
+
+Usage: python import_time.py [n_repeats]
+
+"""
+
+import os
+import subprocess
+import sys
+
+# Make lpaprogram importable when running from this folder
+MODULE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+STATEMENTS = [
+    ("lpaprogram",
+     "import lpaprogram"),
+    ("lpaprogram + pandas + matplotlib",
+     "import lpaprogram, pandas; from matplotlib import pyplot"),
+]
+
+TIMING_CODE = """
+import sys, time
+t = time.time()
+{}
+t = time.time() - t
+sys.stdout.write('{{}} {{}} {{}}'.format(t,
+                                    'pandas' in sys.modules,
+                                    'matplotlib' in sys.modules))
+"""
+
+def time_import(statement):
+    """
+    Time a statement in a fresh interpreter.
+
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = MODULE_PATH + os.pathsep + env.get('PYTHONPATH', '')
+    env['MPLBACKEND'] = 'Agg'
+    output = subprocess.check_output(
+        [sys.executable, '-c', TIMING_CODE.format(statement)],
+        env=env)
+    t, pandas_loaded, matplotlib_loaded = output.decode().split()
+    return float(t), pandas_loaded == 'True', matplotlib_loaded == 'True'
+
+if __name__ == "__main__":
+    n_repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    # Warm up filesystem caches
+    for name, statement in STATEMENTS:
+        time_import(statement)
+    # Time
+    times = {}
+    for name, statement in STATEMENTS:
+        results = [time_import(statement) for i in range(n_repeats)]
+        times[name] = sorted(r[0] for r in results)[n_repeats//2]
+        print("{}: {:.1f} ms (median of {}), pandas loaded: {}, "
+              "matplotlib loaded: {}".format(name,
+                                             times[name]*1000,
+                                             n_repeats,
+                                             results[0][1],
+                                             results[0][2]))
+    print("Speedup: {:.1f}x".format(
+        times[STATEMENTS[1][0]]/times[STATEMENTS[0][0]]))
@@ -9,18 +9,300 @@ Generate programs for a Light Plate Apparatus (LPA).
 # https://packaging.python.org/en/latest/single_source_version.html
 __version__ = '1.0.0'
 
+import atexit
+import collections
+import filecmp
+import functools
+import hashlib
+import json
+import numbers
 import os
+import queue
 import random
+import shutil
 import struct
+import sys
+import tempfile
+import threading
+import time
 import warnings
 
 import numpy
-import pandas
-from matplotlib import pyplot
+# pandas and matplotlib take a long time to import, and are only needed to
+# read calibration data and to make plots, respectively. Therefore, they are
+# imported only inside the functions that use them.
 
 LED_CALIBRATION_PATH = ""
 LED_LAYOUT_FILENAME = "led_layouts.xlsx"
 
+class _NullStage(object):
+    """
+    Context manager that does nothing, used when instrumentation is off.
+
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage(object):
+    """
+    Context manager that times one execution of an instrumented stage.
+
+    """
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation._record_stage(self.name,
+                                           self.start,
+                                           time.perf_counter())
+        return False
+
+class Instrumentation(object):
+    """
+    Collector of timing, call count, and byte count statistics.
+
+    Instrumentation is disabled by default, in which case instrumented
+    functions run with the overhead of a single attribute lookup. When
+    enabled, each execution of an instrumented stage is timed, counted,
+    and recorded as a trace event. Statistics can be queried with
+    `summary()` and exported to a Chrome trace file (readable in
+    ``chrome://tracing`` or Perfetto) with `save_trace()`.
+
+    A module-level instance, ``lpaprogram.instrumentation``, is used by
+    all objects in this module.
+
+    Statistics of each stage take constant memory. Trace events, however,
+    are kept individually, so only the first `max_events` are recorded.
+    Later ones are still included in the statistics, and their number is
+    reported in the trace file.
+
+    Attributes
+    ----------
+    enabled : bool
+        Whether statistics are being collected.
+    max_events : int
+        Maximum number of trace events recorded.
+
+    """
+    max_events = 100000
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def enable(self):
+        """
+        Start collecting statistics.
+
+        """
+        self.enabled = True
+
+    def disable(self):
+        """
+        Stop collecting statistics. Collected data is preserved.
+
+        """
+        self.enabled = False
+
+    def reset(self):
+        """
+        Discard all collected statistics.
+
+        """
+        with self._lock:
+            self._stages = {}
+            self._counters = {}
+            self._bytes = {}
+            self._events = []
+            self._dropped_events = 0
+            self._start = time.perf_counter()
+
+    def stage(self, name):
+        """
+        Get a context manager that times a stage with the specified name.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage.
+
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def count(self, name, n=1):
+        """
+        Increase a named counter.
+
+        Parameters
+        ----------
+        name : str
+            Name of the counter.
+        n : int, optional
+            Amount to add to the counter.
+
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def add_bytes(self, name, n):
+        """
+        Increase a named counter of bytes written.
+
+        Parameters
+        ----------
+        name : str
+            Name of the counter.
+        n : int
+            Number of bytes to add.
+
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._bytes[name] = self._bytes.get(name, 0) + n
+
+    def _record_stage(self, name, start, stop):
+        duration = stop - start
+        with self._lock:
+            stats = self._stages.get(name)
+            if stats is None:
+                self._stages[name] = [1, duration, duration, duration]
+            else:
+                stats[0] += 1
+                stats[1] += duration
+                stats[2] = min(stats[2], duration)
+                stats[3] = max(stats[3], duration)
+            if len(self._events) < self.max_events:
+                self._events.append((name,
+                                     start - self._start,
+                                     duration,
+                                     threading.current_thread().ident))
+            else:
+                self._dropped_events += 1
+
+    def summary(self):
+        """
+        Get a summary of the collected statistics.
+
+        Returns
+        -------
+        dict
+            Dictionary with keys "stages", "counters", and "bytes". The
+            "stages" entry maps each stage name to a dictionary with the
+            number of calls and the total, mean, minimum, and maximum
+            durations in seconds. The "counters" and "bytes" entries map
+            counter names to their values.
+
+        """
+        with self._lock:
+            stages = {}
+            for name, (calls, total, t_min, t_max) in self._stages.items():
+                stages[name] = {'calls': calls,
+                                'total': total,
+                                'mean': total/calls,
+                                'min': t_min,
+                                'max': t_max}
+            return {'stages': stages,
+                    'counters': dict(self._counters),
+                    'bytes': dict(self._bytes)}
+
+    def save_trace(self, file_name):
+        """
+        Save all recorded stage executions as a Chrome trace JSON file.
+
+        Counters and byte counters are saved in the "otherData" entry,
+        under the keys "counters" and "bytes", respectively, along with
+        the number of stage executions not recorded because of
+        `max_events` ("dropped_events").
+
+        Parameters
+        ----------
+        file_name : str
+            Name of the file to save.
+
+        """
+        pid = os.getpid()
+        with self._lock:
+            events = [{'name': name,
+                       'cat': name.split('.')[0],
+                       'ph': 'X',
+                       'ts': start*1e6,
+                       'dur': duration*1e6,
+                       'pid': pid,
+                       'tid': tid}
+                      for name, start, duration, tid in self._events]
+            other_data = {'counters': dict(self._counters),
+                          'bytes': dict(self._bytes),
+                          'dropped_events': self._dropped_events}
+        with open(file_name, 'w') as f:
+            json.dump({'traceEvents': events,
+                       'displayTimeUnit': 'ms',
+                       'otherData': other_data}, f)
+
+instrumentation = Instrumentation()
+
+def _instrumented(name):
+    """
+    Decorator that times every call of a function as a stage.
+
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not instrumentation.enabled:
+                return func(*args, **kwargs)
+            with _Stage(instrumentation, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class _ReplacedFile(object):
+    """
+    Context manager that writes a file through a temporary file.
+
+    The temporary file is created in the same folder as the target file,
+    and replaces it with ``os.replace()`` only if the block completes
+    without errors. Otherwise, the temporary file is removed and an
+    existing target file is left unchanged. Other links to the target file
+    and memory maps of it are not modified either.
+
+    """
+    def __init__(self, file_name, mode='wb'):
+        self.file_name = file_name
+        self.mode = mode
+
+    def __enter__(self):
+        self.temp_file_name = '{}.{}-{}.tmp'.format(self.file_name,
+                                                    os.getpid(),
+                                                    threading.get_ident())
+        self.file = open(self.temp_file_name, self.mode)
+        return self.file
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.file.close()
+        finally:
+            if exc_type is None:
+                os.replace(self.temp_file_name, self.file_name)
+            else:
+                os.remove(self.temp_file_name)
+        return False
+
 class LPF(object):
     """
     Class that represents a light program file (.lpf).
@@ -61,7 +343,8 @@ class LPF(object):
         if file_name is not None:
             self.load(file_name)
 
-    def load(self, file_name):
+    @_instrumented('LPF.load')
+    def load(self, file_name, memmap=False):
         """
         Load data from an lpf file.
 
@@ -69,6 +352,9 @@ class LPF(object):
         ----------
         file_name : str
             Name of the file to load.
+        memmap : bool, optional
+            If True, `grayscale` is a read-only array memory-mapped to the
+            file, and values are only read from disk when accessed.
 
         """
         # Open file
@@ -101,7 +387,11 @@ class LPF(object):
                     offset=32,
                     shape=(number_words_data,),
                     order='C')
-                data = numpy.array(data)
+                if memmap:
+                    instrumentation.add_bytes('LPF.load', 32)
+                else:
+                    data = numpy.array(data)
+                    instrumentation.add_bytes('LPF.load', 32 + data.nbytes)
                 # Resize to get grayscale values
                 self.grayscale = data.reshape((
                     self.n_steps,
@@ -114,46 +404,346 @@ class LPF(object):
         finally:
             f.close()
 
+    @_instrumented('LPF.save')
     def save(self, file_name):
         """
         Save data into an lpf file.
 
+        Data is written into a temporary file, which then replaces the
+        specified file. If anything goes wrong, an existing file is left
+        unchanged.
+
         Parameters
         ----------
         file_name : str
             Name of the file to save.
 
         """
-        # Open file for writing
-        f = open(file_name, 'wb')
+        with _ReplacedFile(file_name) as f:
+            self._write_header(f)
+            # Saturate grayscale at 4095 and save
+            gs = self.grayscale.astype(numpy.uint16, copy=False)
+            if numpy.any(gs > 4095):
+                gs = numpy.minimum(gs, 4095)
+            gs.tofile(f)
+            instrumentation.add_bytes('LPF.save', 32 + gs.nbytes)
+
+    def _write_header(self, f):
+        # Write the 32-byte header of an lpf file into an open file
+        # First 4 bytes are the file version
+        f.write(struct.pack('<I', self.file_version))
+
+        # What to do if file version is 1.0
+        if self.file_version == 1:
+            # Next 4 bytes are the total number of channels
+            f.write(struct.pack('<I', self.n_channels))
+            # Next 4 bytes are the step size in ms
+            f.write(struct.pack('<I', self.step_size))
+            # Next 4 bytes are the number of steps
+            f.write(struct.pack('<I', self.n_steps))
+            # Write 16 more empty bytes
+            f.write(struct.pack('<IIII', 0, 0, 0, 0))
 
-        # Use a try block to free resources in case anything goes wrong
-        try:
-            # Header is 32 bytes
-            # First 4 bytes are the file version
-            f.write(struct.pack('<I', self.file_version))
+        else:
+            raise NotImplementedError("LPF file version {} not recognized"
+                .format(self.file_version))
+
+def _find_differences(a, b, chunk_steps=65536):
+    # Find ranges of steps in which two grayscale arrays of shape
+    # ``(n_steps, n_leds)`` differ, processing a chunk of steps at a time.
+    # Returns a list of ``[led, step_start, step_stop, max_delta]``
+    # entries sorted by LED and step, with `step_stop` excluded.
+    n_steps, n_leds = a.shape
+    runs = []
+    for start in range(0, n_steps, chunk_steps):
+        a_chunk = numpy.asarray(a[start:start + chunk_steps])
+        b_chunk = numpy.asarray(b[start:start + chunk_steps])
+        # Absolute differences, with one row per LED
+        delta = numpy.abs(a_chunk.astype(numpy.int32) - b_chunk)
+        delta = numpy.ascontiguousarray(delta.T)
+        mask = delta != 0
+        if not mask.any():
+            continue
+        # Find start and end of each range of differences
+        n = delta.shape[1]
+        padded = numpy.zeros((n_leds, n + 2), dtype=numpy.int8)
+        padded[:, 1:-1] = mask
+        edges = numpy.diff(padded, axis=1)
+        leds, run_starts = numpy.nonzero(edges==1)
+        run_stops = numpy.nonzero(edges==-1)[1]
+        # Maximum difference within each range. Each reduction segment
+        # extends up to the next range, but values in between are zero.
+        max_delta = numpy.maximum.reduceat(delta.ravel(), leds*n + run_starts)
+        runs.extend(zip(leds.tolist(),
+                        (run_starts + start).tolist(),
+                        (run_stops + start).tolist(),
+                        max_delta.tolist()))
+    # Merge ranges split between chunks
+    runs.sort()
+    merged_runs = []
+    for run in runs:
+        if merged_runs and (merged_runs[-1][0] == run[0]) and \
+                (merged_runs[-1][2] == run[1]):
+            merged_runs[-1][2] = run[2]
+            merged_runs[-1][3] = max(merged_runs[-1][3], run[3])
+        else:
+            merged_runs.append(list(run))
+    return merged_runs
 
-            # What to do if file version is 1.0
-            if self.file_version == 1:
-                # Next 4 bytes are the total number of channels
-                f.write(struct.pack('<I', self.n_channels))
-                # Next 4 bytes are the step size in ms
-                f.write(struct.pack('<I', self.step_size))
-                # Next 4 bytes are the number of steps
-                f.write(struct.pack('<I', self.n_steps))
-                # Write 16 more empty bytes
-                f.write(struct.pack('<IIII', 0, 0, 0, 0))
-                # Saturate grayscale at 4095 and save
-                gs = self.grayscale.astype(numpy.uint16)
-                gs[gs > 4095] = 4095
-                gs.tofile(f)
+class LPFDiff(object):
+    """
+    Differences between the grayscale values of two light program files.
 
-            else:
-                raise NotImplementedError("LPF file version {} not recognized"
-                    .format(self.file_version))
+    Returned by `diff_lpf()`. Each difference corresponds to a contiguous
+    range of steps in which the grayscale values of one channel differ
+    between both files. Only the steps present in both files are
+    compared.
 
-        finally:
-            f.close()
+    Attributes
+    ----------
+    file_name_a, file_name_b : str
+        Names of the compared files.
+    n_channels : int
+        Total number of channels (i.e. LEDs) in both files.
+    n_steps_a, n_steps_b : int
+        Number of time steps in each file.
+    step_size_a, step_size_b : int
+        Size of the time step of each file, in milliseconds.
+    differences : list
+        List of dictionaries, one per difference, sorted by channel and
+        step. Keys are "channel" (the channel in the file, zero-indexed),
+        "step_start" and "step_stop" (the range of steps, with
+        `step_stop` excluded), "max_delta" (the largest absolute
+        difference in grayscale values within the range), and
+        "max_intensity_delta" (the largest absolute difference in
+        intensity within the range, in µmol/(m^2*s), or None if not
+        calculated).
+
+    """
+    columns = ['channel',
+               'step_start',
+               'step_stop',
+               'max_delta',
+               'max_intensity_delta']
+
+    def __init__(self,
+                 file_name_a,
+                 file_name_b,
+                 n_channels,
+                 n_steps_a,
+                 n_steps_b,
+                 step_size_a,
+                 step_size_b,
+                 differences):
+        self.file_name_a = file_name_a
+        self.file_name_b = file_name_b
+        self.n_channels = n_channels
+        self.n_steps_a = n_steps_a
+        self.n_steps_b = n_steps_b
+        self.step_size_a = step_size_a
+        self.step_size_b = step_size_b
+        self.differences = differences
+
+    @property
+    def identical(self):
+        """
+        Whether both files have the same steps and grayscale values.
+
+        """
+        return (len(self.differences) == 0) and \
+            (self.n_steps_a == self.n_steps_b) and \
+            (self.step_size_a == self.step_size_b)
+
+    @property
+    def max_delta(self):
+        """
+        Largest absolute difference in grayscale values.
+
+        """
+        return max([d['max_delta'] for d in self.differences] + [0])
+
+    @property
+    def n_changed_steps(self):
+        """
+        Number of steps in which at least one channel is different.
+
+        """
+        # Merge ranges of all channels
+        n_changed_steps = 0
+        stop = 0
+        for d in sorted(self.differences, key=lambda d: d['step_start']):
+            if d['step_stop'] > stop:
+                n_changed_steps += d['step_stop'] - max(d['step_start'],
+                                                        stop)
+                stop = d['step_stop']
+        return n_changed_steps
+
+    def __len__(self):
+        return len(self.differences)
+
+    def __iter__(self):
+        return iter(self.differences)
+
+    def __str__(self):
+        lines = ["{} vs. {}: {} changed steps, max grayscale delta {}".format(
+            self.file_name_a,
+            self.file_name_b,
+            self.n_changed_steps,
+            self.max_delta)]
+        if self.step_size_a != self.step_size_b:
+            lines.append("different step size: {} vs. {}".format(
+                self.step_size_a,
+                self.step_size_b))
+        if self.n_steps_a != self.n_steps_b:
+            lines.append("different number of steps: {} vs. {}".format(
+                self.n_steps_a,
+                self.n_steps_b))
+        for d in self.differences:
+            line = "channel {}, steps {}-{}: max delta {}".format(
+                d['channel'],
+                d['step_start'],
+                d['step_stop'] - 1,
+                d['max_delta'])
+            if d['max_intensity_delta'] is not None:
+                line += " ({:.3f} µmol/(m^2*s))".format(
+                    d['max_intensity_delta'])
+            lines.append(line)
+        return "\n".join(lines)
+
+    def to_dataframe(self):
+        """
+        Get differences as a table.
+
+        Returns
+        -------
+        DataFrame
+            Table with one row per difference, and one column per
+            difference key.
+
+        """
+        import pandas
+        return pandas.DataFrame(self.differences, columns=self.columns)
+
+    def channel_summary(self):
+        """
+        Summarize differences per channel.
+
+        Returns
+        -------
+        DataFrame
+            Table with one row per channel with differences, and columns
+            "channel", "n_ranges" (number of ranges of different steps),
+            "n_changed_steps", "max_delta", and "max_intensity_delta".
+
+        """
+        import pandas
+        summary = collections.OrderedDict()
+        for d in self.differences:
+            if d['channel'] not in summary:
+                summary[d['channel']] = {'channel': d['channel'],
+                                         'n_ranges': 0,
+                                         'n_changed_steps': 0,
+                                         'max_delta': 0,
+                                         'max_intensity_delta': None}
+            s = summary[d['channel']]
+            s['n_ranges'] += 1
+            s['n_changed_steps'] += d['step_stop'] - d['step_start']
+            s['max_delta'] = max(s['max_delta'], d['max_delta'])
+            if d['max_intensity_delta'] is not None:
+                s['max_intensity_delta'] = max(s['max_intensity_delta'] or 0,
+                                               d['max_intensity_delta'])
+        return pandas.DataFrame(list(summary.values()),
+                                columns=['channel',
+                                         'n_ranges',
+                                         'n_changed_steps',
+                                         'max_delta',
+                                         'max_intensity_delta'])
+
+def diff_lpf(file_name_a, file_name_b, lpa=None, chunk_steps=65536):
+    """
+    Compare the grayscale values of two light program files.
+
+    Both files are memory-mapped and compared a chunk of steps at a time,
+    such that neither is fully loaded into memory.
+
+    Parameters
+    ----------
+    file_name_a, file_name_b : str
+        Names of the files to compare.
+    lpa : LPA, optional
+        If specified, differences are also expressed in intensity units,
+        using the LPA's LED sets and its current dc and gcal values for
+        both files. Channels without an LED set get an intensity
+        difference of None.
+    chunk_steps : int, optional
+        Number of steps compared at a time. This limits the amount of
+        memory used.
+
+    Returns
+    -------
+    LPFDiff
+        Differences between both files.
+
+    Raises
+    ------
+    ValueError
+        If the files, or a file and `lpa`, have a different number of
+        channels.
+
+    """
+    lpf_a = LPF()
+    lpf_a.load(file_name_a, memmap=True)
+    lpf_b = LPF()
+    lpf_b.load(file_name_b, memmap=True)
+    if lpf_a.n_channels != lpf_b.n_channels:
+        raise ValueError("light program files have a different number of "
+            "channels: {} vs. {}".format(lpf_a.n_channels, lpf_b.n_channels))
+
+    # Intensity per grayscale unit of each LED, ordered as in the file
+    if lpa is not None:
+        if lpf_a.n_channels != lpa.n_rows*lpa.n_cols*lpa.n_channels:
+            raise ValueError("unexpected number of channels in light "
+                "program file")
+        if lpa.led_sets is None:
+            raise Exception("LED sets have not been loaded. "
+                "Call load_led_sets().")
+        unit_intensity = numpy.full((lpa.n_rows, lpa.n_cols, lpa.n_channels),
+                                    numpy.nan)
+        n_wells = lpa.n_rows*lpa.n_cols
+        for channel, led_set in enumerate(lpa.led_sets):
+            if led_set is None:
+                continue
+            unit_intensity[:, :, channel] = led_set.get_intensity(
+                gs=numpy.ones(n_wells, dtype=int),
+                dc=lpa.dc[:, :, channel].flatten(),
+                gcal=lpa.gcal[:, :, channel].flatten()).reshape(lpa.n_rows,
+                                                                 lpa.n_cols)
+        unit_intensity = unit_intensity.flatten()
+
+    n_steps = min(lpf_a.n_steps, lpf_b.n_steps)
+    runs = _find_differences(lpf_a.grayscale[:n_steps],
+                             lpf_b.grayscale[:n_steps],
+                             chunk_steps=chunk_steps)
+    differences = []
+    for channel, step_start, step_stop, max_delta in runs:
+        if lpa is None or numpy.isnan(unit_intensity[channel]):
+            max_intensity_delta = None
+        else:
+            max_intensity_delta = float(max_delta*unit_intensity[channel])
+        differences.append({'channel': channel,
+                            'step_start': step_start,
+                            'step_stop': step_stop,
+                            'max_delta': max_delta,
+                            'max_intensity_delta': max_intensity_delta})
+
+    return LPFDiff(file_name_a=file_name_a,
+                   file_name_b=file_name_b,
+                   n_channels=lpf_a.n_channels,
+                   n_steps_a=lpf_a.n_steps,
+                   n_steps_b=lpf_b.n_steps,
+                   step_size_a=lpf_a.step_size,
+                   step_size_b=lpf_b.step_size,
+                   differences=differences)
 
 class LEDSet(object):
     """
@@ -166,6 +756,10 @@ class LEDSet(object):
     then used to convert from light intensity values in µmol/(m^2*s) into
     grayscale values at the specified dc and gcal values, and viceversa.
 
+    Only the measured dc, gcal, and intensity of each well are kept after
+    loading, as plain numpy arrays. An LEDSet can also be created directly
+    from these arrays with `from_arrays()`, which does not require pandas.
+
     Parameters
     ----------
     name : str
@@ -185,22 +779,52 @@ class LEDSet(object):
         Number of cols in the LPA.
     channel : int
         Channel of the LPA in which the LED set is located.
+    measured_dc : array
+        Dot correction used during calibration, one value per well.
+    measured_gcal : array
+        Grayscale calibration used during calibration, one value per well.
+    measured_intensity : array
+        Intensity measured at grayscale 4095 during calibration, in
+        µmol/(m^2*s), one value per well.
     calibration_data : DataFrame
-        A table with the LED set calibration data.
+        A table with the LED set calibration data. This is the table loaded
+        from the Excel file, with its original columns and types. LED sets
+        created with `from_arrays()` or unpickled build it from the arrays
+        above when first accessed, with only the columns used by this
+        object.
 
     """
+    __slots__ = ['name',
+                 'lpa_name',
+                 'n_rows',
+                 'n_cols',
+                 'channel',
+                 'measured_dc',
+                 'measured_gcal',
+                 'measured_intensity',
+                 '_calibration_data',
+                 '_dc_tables',
+                 '_luts',
+                 '_lock']
+
+    # Maximum number of lookup tables cached by get_lut()
+    lut_cache_size = 8
+
+    @_instrumented('LEDSet.__init__')
     def __init__(self, name, file_name):
+        import pandas
         # Store name
         self.name = name
         # Load calibration data
-        self.calibration_data = pandas.read_excel(file_name,
-                                                  'Sheet1',
-                                                  index_col='Well')
+        with instrumentation.stage('LEDSet.read_excel'):
+            calibration_data = pandas.read_excel(file_name,
+                                                 'Sheet1',
+                                                 index_col='Well')
         # Extract LPA information
-        self.lpa_name = self.calibration_data['LPA'].iloc[0]
-        self.n_rows = self.calibration_data['Row'].max()
-        self.n_cols = self.calibration_data['Col'].max()
-        channel = self.calibration_data['Channel'].iloc[0]
+        self.lpa_name = calibration_data['LPA'].iloc[0]
+        self.n_rows = int(calibration_data['Row'].max())
+        self.n_cols = int(calibration_data['Col'].max())
+        channel = calibration_data['Channel'].iloc[0]
         if channel in [1, 'c1', 'Top']:
             self.channel = 0
         elif channel in [2, 'c2', 'Bot', 'Bottom']:
@@ -208,14 +832,172 @@ class LEDSet(object):
         else:
             raise ValueError("channel not recognized")
         # Sanity checks
-        if not (self.calibration_data['LPA']==self.lpa_name).all():
+        if not (calibration_data['LPA']==self.lpa_name).all():
             raise ValueError("LPA name is not consistent in calibration data")
-        if not (self.calibration_data['Channel']==channel).all():
+        if not (calibration_data['Channel']==channel).all():
             raise ValueError("channel is not consistent in calibration data")
-        if len(self.calibration_data) != (self.n_rows*self.n_cols):
+        if len(calibration_data) != (self.n_rows*self.n_cols):
             raise ValueError("calibration data does not have the expected " + \
                 "dimensions")
+        # Keep the original table
+        self._calibration_data = calibration_data
+        # Sort by well number
+        calibration_data = calibration_data.loc[
+            numpy.arange(1, self.n_rows*self.n_cols + 1)]
+        # Extract calibration values
+        self.measured_dc = calibration_data['DC'].values.astype(float)
+        self.measured_gcal = calibration_data['GS Cal'].values.astype(float)
+        # Intensity units can be expressed as µmol/(m^2*s) or umol/m2/s
+        if u'Intensity (µmol/(m^2*s))' in calibration_data.columns:
+            self.measured_intensity = \
+                calibration_data[u'Intensity (µmol/(m^2*s))']\
+                .values.astype(float)
+        else:
+            self.measured_intensity = \
+                calibration_data['Intensity (umol/m2/s)'].values.astype(float)
+        self._dc_tables = None
+        self._luts = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_arrays(cls,
+                    name,
+                    lpa_name,
+                    channel,
+                    n_rows,
+                    n_cols,
+                    measured_dc,
+                    measured_gcal,
+                    measured_intensity):
+        """
+        Create an LEDSet from arrays of calibration values.
+
+        Arrays are used as given, without copying, if they are already
+        float arrays.
+
+        Parameters
+        ----------
+        name : str
+            Name of LED set.
+        lpa_name : str
+            Name of the LPA in which calibration measurements were
+            conducted.
+        channel : int
+            Channel of the LPA in which the LED set is located,
+            zero-indexed.
+        n_rows, n_cols : int
+            Number of rows and columns in the LPA.
+        measured_dc, measured_gcal, measured_intensity : array
+            Dot correction, grayscale calibration, and intensity at
+            grayscale 4095 in µmol/(m^2*s) measured during calibration.
+            Each array should have one value per well, ordered by row.
+
+        Returns
+        -------
+        LEDSet
+            The new LEDSet object.
+
+        """
+        led_set = cls.__new__(cls)
+        led_set.name = name
+        led_set.lpa_name = lpa_name
+        led_set.channel = int(channel)
+        led_set.n_rows = int(n_rows)
+        led_set.n_cols = int(n_cols)
+        led_set.measured_dc = numpy.asarray(measured_dc, dtype=float)
+        led_set.measured_gcal = numpy.asarray(measured_gcal, dtype=float)
+        led_set.measured_intensity = numpy.asarray(measured_intensity,
+                                                   dtype=float)
+        led_set._calibration_data = None
+        led_set._dc_tables = None
+        led_set._luts = None
+        led_set._lock = threading.Lock()
+        # Sanity checks
+        for values in [led_set.measured_dc,
+                       led_set.measured_gcal,
+                       led_set.measured_intensity]:
+            if values.shape != (led_set.n_rows*led_set.n_cols,):
+                raise ValueError("calibration data does not have the "
+                    "expected dimensions")
+        return led_set
+
+    def __getstate__(self):
+        # Do not pickle the calibration_data table and cached tables
+        return dict((attr, getattr(self, attr))
+                    for attr in self.__slots__
+                    if not attr.startswith('_'))
+
+    def __setstate__(self, state):
+        for attr, value in state.items():
+            setattr(self, attr, value)
+        self._calibration_data = None
+        self._dc_tables = None
+        self._luts = None
+        self._lock = threading.Lock()
+
+    @property
+    def calibration_data(self):
+        """
+        Table with the calibration data, indexed by well number.
+
+        """
+        if self._calibration_data is None:
+            import pandas
+            well = numpy.arange(self.n_rows*self.n_cols)
+            # Dot correction and grayscale calibration values are integers
+            self._calibration_data = pandas.DataFrame(
+                {'LPA': self.lpa_name,
+                 'Channel': self.channel + 1,
+                 'Row': well//self.n_cols + 1,
+                 'Col': well%self.n_cols + 1,
+                 'DC': self.measured_dc.astype(int),
+                 'GS Cal': self.measured_gcal.astype(int),
+                 u'Intensity (µmol/(m^2*s))': self.measured_intensity},
+                index=pandas.Index(well + 1, name='Well'),
+                columns=['LPA',
+                         'Channel',
+                         'Row',
+                         'Col',
+                         'DC',
+                         'GS Cal',
+                         u'Intensity (µmol/(m^2*s))'])
+        return self._calibration_data
+
+    def fingerprint(self):
+        """
+        Get a string that identifies this LED set's calibration data.
 
+        Two LED sets with the same fingerprint produce the same
+        conversions between intensity and grayscale.
+
+        Returns
+        -------
+        str
+            Hexadecimal SHA-256 digest of the calibration data.
+
+        """
+        h = hashlib.sha256()
+        h.update(repr((self.name,
+                       self.lpa_name,
+                       self.channel,
+                       self.n_rows,
+                       self.n_cols)).encode())
+        for values in [self.measured_dc,
+                       self.measured_gcal,
+                       self.measured_intensity]:
+            h.update(numpy.ascontiguousarray(values, dtype=float))
+        return h.hexdigest()
+
+    def _get_well(self, row, col):
+        # If row is None, use all wells
+        if (row is None) or (col is None):
+            return numpy.arange(self.n_rows*self.n_cols)
+        # Transform (row, col) pair into well number
+        row = numpy.atleast_1d(row)
+        col = numpy.atleast_1d(col)
+        return row*self.n_cols + col
+
+    @_instrumented('LEDSet.get_intensity')
     def get_intensity(self, gs, dc=None, gcal=None, row=None, col=None):
         """
         Calculate intensity in µmol/(m^2*s) from grayscale values.
@@ -249,28 +1031,14 @@ class LEDSet(object):
             The intensities of each well in µmol/(m^2*s).
 
         """
-        # If row is None, use all wells
-        if (row is None) or (col is None):
-            well = numpy.arange(self.n_rows*self.n_cols)
-        else:
-            # Transform (row, col) pair into well number
-            row = numpy.atleast_1d(row)
-            col = numpy.atleast_1d(col)
-            well = row*self.n_cols + col
-        # Get info for relevant wells
-        led_data = self.calibration_data.loc[well + 1]
-        # Get intensity at measured conditions
-        measured_dc = led_data['DC'].values.astype(float)
-        measured_gcal = led_data['GS Cal'].values.astype(float)
-        # Intensity units can be expressed as µmol/(m^2*s) or umol/m2/s
-        if 'Intensity (µmol/(m^2*s))' in led_data.columns:
-            measured_intensity = led_data['Intensity (µmol/(m^2*s))']\
-                .values.astype(float)
-        else:
-            measured_intensity = led_data['Intensity (umol/m2/s)']\
-                .values.astype(float)
+        # Get calibration values for relevant wells
+        well = self._get_well(row, col)
+        measured_dc = self.measured_dc[well]
+        measured_gcal = self.measured_gcal[well]
+        measured_intensity = self.measured_intensity[well]
         # Convert grayscale input to array
         gs = numpy.array(gs)
+        instrumentation.count('LEDSet.get_intensity.values', gs.size)
         # Convert dc and gcal to arrays, or use measured calibration values
         if dc is not None:
             dc = numpy.array(dc)
@@ -280,6 +1048,17 @@ class LEDSet(object):
             gcal = numpy.array(gcal)
         else:
             gcal = measured_gcal
+        # If all wells are used, integer grayscale values can be converted
+        # by looking up a precalculated table.
+        n_wells = len(measured_dc)
+        if (row is None or col is None) and \
+                (gs.dtype.kind in 'ui') and (gs.size > 0) and \
+                (gs.ndim == 0 or gs.shape[-1] == n_wells) and \
+                (dc.ndim == 0 or dc.shape == (n_wells,)) and \
+                (gcal.ndim == 0 or gcal.shape == (n_wells,)) and \
+                (gs.min() >= 0) and (gs.max() <= 4095):
+            lut = self.get_lut(dc=dc, gcal=gcal)
+            return lut[numpy.arange(n_wells), gs]
         # Calculate intensity
         intensity = measured_intensity * (dc/measured_dc) * \
                                          (gcal/measured_gcal) * \
@@ -287,6 +1066,7 @@ class LEDSet(object):
 
         return intensity
 
+    @_instrumented('LEDSet.get_grayscale')
     def get_grayscale(self, intensity, dc=None, gcal=None, row=None, col=None):
         """
         Calculate grayscale values to achieve the specified intensities.
@@ -325,28 +1105,14 @@ class LEDSet(object):
             Grayscale values to achieve the specified intensities.
 
         """
-        # If row is None, use all wells
-        if (row is None) or (col is None):
-            well = numpy.arange(self.n_rows*self.n_cols)
-        else:
-            # Transform (row, col) pair into well number
-            row = numpy.atleast_1d(row)
-            col = numpy.atleast_1d(col)
-            well = row*self.n_cols + col
-        # Get info for relevant wells
-        led_data = self.calibration_data.loc[well + 1]
-        # Get intensity at measured conditions
-        measured_dc = led_data['DC'].values.astype(float)
-        measured_gcal = led_data['GS Cal'].values.astype(float)
-        # Intensity units can be expressed as µmol/(m^2*s) or umol/m2/s
-        if 'Intensity (µmol/(m^2*s))' in led_data.columns:
-            measured_intensity = led_data['Intensity (µmol/(m^2*s))']\
-                .values.astype(float)
-        else:
-            measured_intensity = led_data['Intensity (umol/m2/s)']\
-                .values.astype(float)
+        # Get calibration values for relevant wells
+        well = self._get_well(row, col)
+        measured_dc = self.measured_dc[well]
+        measured_gcal = self.measured_gcal[well]
+        measured_intensity = self.measured_intensity[well]
         # Convert intensity input to array
         intensity = numpy.array(intensity)
+        instrumentation.count('LEDSet.get_grayscale.values', intensity.size)
         # Convert dc and gcal to arrays, or use measured calibration values
         if dc is not None:
             dc = numpy.array(dc)
@@ -367,6 +1133,54 @@ class LEDSet(object):
 
         return gs
 
+    def get_grayscale_factor(self, dc=None, gcal=None, row=None, col=None):
+        """
+        Calculate the grayscale value per unit of intensity.
+
+        Multiplying an intensity in µmol/(m^2*s) by the returned factor
+        gives the corresponding (unrounded) grayscale value. This allows
+        converting many intensities per well with a single multiplication.
+
+        Parameters
+        ----------
+        dc : array, optional
+            Dot-correction values. If None (default), use same dc as in
+            calibration data.
+        gcal : array, optional
+            Grayscale calibration values. If None (default), use same gcal
+            as in calibration data.
+        row : array, optional
+            Row positions of each well, zero-indexed.
+        col : array, optional
+            Column positions of each well, zero-indexed.
+
+        Returns
+        -------
+        array
+            Grayscale value per µmol/(m^2*s) for each well.
+
+        """
+        # Get calibration values for relevant wells
+        well = self._get_well(row, col)
+        measured_dc = self.measured_dc[well]
+        measured_gcal = self.measured_gcal[well]
+        measured_intensity = self.measured_intensity[well]
+        # Convert dc and gcal to arrays, or use measured calibration values
+        if dc is not None:
+            dc = numpy.array(dc)
+        else:
+            dc = measured_dc
+        if gcal is not None:
+            gcal = numpy.array(gcal)
+        else:
+            gcal = measured_gcal
+        # Calculate factor
+        with numpy.errstate(divide='ignore'):
+            return 4095. / measured_intensity * \
+                           (measured_dc/dc) * \
+                           (measured_gcal/gcal)
+
+    @_instrumented('LEDSet.discretize_intensity')
     def discretize_intensity(self,
                              intensity,
                              dc=None,
@@ -417,37 +1231,216 @@ class LEDSet(object):
         gs = self.get_grayscale(intensity, dc, gcal, row, col)
         return self.get_intensity(gs, dc, gcal, row, col)
 
-    def optimize_dc(self,
-                    intensity,
-                    gcal=None,
-                    min_dc=1,
-                    uniform=False,
-                    row=None,
-                    col=None,
-                    ):
-        """
-        Get the lowest dc value so that a specified intensity is possible.
+    def _get_gcal_key(self, gcal):
+        # Hashable key that identifies gcal values
+        if gcal is None:
+            return None
+        gcal = numpy.asarray(gcal, dtype=float)
+        if gcal.ndim == 0:
+            return float(gcal)
+        return gcal.tobytes()
 
-        At constant dc and gcal values, intensities are represented by
-        integer grayscale values ranging from 0 to 4095. Therefore, at a
-        given dc value there is a highest possible intensity. While larger
-        dc values allow for larger intensities, resolution is lost, as each
-        grayscale step represents a larger increase in intensity as well.
-        This function calculates the lowest dc required to achieve a
-        certain intensity, which also maximizes the resolution for lower
-        intensities.
+    def get_dc_table(self, gcal=None):
+        """
+        Get the maximum intensity and resolution of each well at every dc.
 
-        Note that using a dot correction value different from the one
-        in the calibration file will result in an intensity that will not
-        exactly match what is predicted here.
+        Tables are calculated once for each set of gcal values, and cached.
 
         Parameters
         ----------
-        intensity : array
-            The intensities of each well in µmol/(m^2*s).
         gcal : array, optional
-            Grayscale calibration values. If None (default), use same gcal
-            as in calibration data.
+            Grayscale calibration values, either a single value or one per
+            well. If None (default), use same gcal as in calibration data.
+
+        Returns
+        -------
+        dict
+            Dictionary with keys "max_intensity", the intensity at
+            grayscale 4095, and "resolution", the intensity of one
+            grayscale step, both in µmol/(m^2*s). Each one is a read-only
+            array of size ``(n_rows, n_cols, 64)``, indexed by row, column,
+            and dot correction value.
+
+        """
+        key = self._get_gcal_key(gcal)
+        with self._lock:
+            return self._get_dc_table(key, gcal)
+
+    def _get_dc_table(self, key, gcal):
+        # Get a table from the cache, or calculate it. Should be called
+        # with the lock acquired.
+        if self._dc_tables is None:
+            self._dc_tables = {}
+        table = self._dc_tables.get(key)
+        if table is None:
+            if gcal is None:
+                gcal = self.measured_gcal
+            gcal = numpy.broadcast_to(numpy.asarray(gcal, dtype=float),
+                                      self.measured_gcal.shape)
+            dc = numpy.arange(64)
+            # Same calculation as in get_intensity(), at grayscale 4095 and
+            # at grayscale 1
+            max_intensity = self.measured_intensity[:, numpy.newaxis] * \
+                (dc/self.measured_dc[:, numpy.newaxis]) * \
+                (gcal/self.measured_gcal)[:, numpy.newaxis]
+            table = {'max_intensity': max_intensity,
+                     'resolution': max_intensity * (1/4095.)}
+            for values in table.values():
+                values.shape = (self.n_rows, self.n_cols, 64)
+                values.flags.writeable = False
+            self._dc_tables[key] = table
+        return table
+
+    def get_max_intensity(self, dc, gcal=None, row=None, col=None):
+        """
+        Get the highest intensity possible at the specified dc values.
+
+        Values are looked up from the table returned by `get_dc_table()`.
+
+        Parameters
+        ----------
+        dc : array
+            Dot-correction values.
+        gcal : array, optional
+            Grayscale calibration values. If None (default), use same gcal
+            as in calibration data. This should be either a single value
+            or one value per well in the LED set.
+        row : array, optional
+            Row positions of each well, zero-indexed.
+        col : array, optional
+            Column positions of each well, zero-indexed.
+
+        Returns
+        -------
+        array
+            Intensity at grayscale 4095 of each well, in µmol/(m^2*s).
+
+        """
+        table = self.get_dc_table(gcal)['max_intensity'].reshape(-1, 64)
+        return table[self._get_well(row, col), dc]
+
+    def get_resolution(self, dc, gcal=None, row=None, col=None):
+        """
+        Get the intensity of one grayscale step at the specified dc values.
+
+        Values are looked up from the table returned by `get_dc_table()`.
+
+        Parameters
+        ----------
+        dc : array
+            Dot-correction values.
+        gcal : array, optional
+            Grayscale calibration values. If None (default), use same gcal
+            as in calibration data. This should be either a single value
+            or one value per well in the LED set.
+        row : array, optional
+            Row positions of each well, zero-indexed.
+        col : array, optional
+            Column positions of each well, zero-indexed.
+
+        Returns
+        -------
+        array
+            Intensity of one grayscale step for each well, in
+            µmol/(m^2*s).
+
+        """
+        table = self.get_dc_table(gcal)['resolution'].reshape(-1, 64)
+        return table[self._get_well(row, col), dc]
+
+    def get_lut(self, dc=None, gcal=None):
+        """
+        Get a lookup table of intensities for every grayscale value.
+
+        At fixed dc and gcal values, each well can only produce 4096
+        different intensities. This function returns all of them, so that
+        grayscale values can be converted to intensities by indexing.
+        Tables are cached for the most recently used dc and gcal values.
+        This function can be called from several threads.
+
+        Parameters
+        ----------
+        dc : array, optional
+            Dot-correction values, either a single value or one per well.
+            If None (default), use same dc as in calibration data.
+        gcal : array, optional
+            Grayscale calibration values, either a single value or one per
+            well. If None (default), use same gcal as in calibration data.
+
+        Returns
+        -------
+        array
+            Read-only array of size ``(n_rows*n_cols, 4096)``, in which
+            element ``[well, gs]`` is the intensity of well number `well`
+            at grayscale `gs`, in µmol/(m^2*s). Values are identical to
+            those calculated by `get_intensity()`.
+
+        """
+        key = (self._get_gcal_key(dc), self._get_gcal_key(gcal))
+        with self._lock:
+            return self._get_lut(key, dc, gcal)
+
+    def _get_lut(self, key, dc, gcal):
+        # Get a table from the LRU cache, or calculate it. Should be called
+        # with the lock acquired.
+        if self._luts is None:
+            self._luts = collections.OrderedDict()
+        lut = self._luts.get(key)
+        if lut is None:
+            dc = self.measured_dc if dc is None else numpy.asarray(dc)
+            gcal = self.measured_gcal if gcal is None else numpy.asarray(gcal)
+            dc = dc[..., numpy.newaxis]
+            gcal = gcal[..., numpy.newaxis]
+            # Same calculation as in get_intensity()
+            lut = self.measured_intensity[:, numpy.newaxis] * \
+                (dc/self.measured_dc[:, numpy.newaxis]) * \
+                (gcal/self.measured_gcal[:, numpy.newaxis]) * \
+                (numpy.arange(4096)/4095.)
+            lut = numpy.broadcast_to(
+                lut,
+                (self.n_rows*self.n_cols, 4096)).copy()
+            lut.flags.writeable = False
+            self._luts[key] = lut
+            if len(self._luts) > self.lut_cache_size:
+                self._luts.popitem(last=False)
+        else:
+            # Mark as most recently used
+            del self._luts[key]
+            self._luts[key] = lut
+        return lut
+
+    @_instrumented('LEDSet.optimize_dc')
+    def optimize_dc(self,
+                    intensity,
+                    gcal=None,
+                    min_dc=1,
+                    uniform=False,
+                    row=None,
+                    col=None,
+                    ):
+        """
+        Get the lowest dc value so that a specified intensity is possible.
+
+        At constant dc and gcal values, intensities are represented by
+        integer grayscale values ranging from 0 to 4095. Therefore, at a
+        given dc value there is a highest possible intensity. While larger
+        dc values allow for larger intensities, resolution is lost, as each
+        grayscale step represents a larger increase in intensity as well.
+        This function calculates the lowest dc required to achieve a
+        certain intensity, which also maximizes the resolution for lower
+        intensities.
+
+        Note that using a dot correction value different from the one
+        in the calibration file will result in an intensity that will not
+        exactly match what is predicted here.
+
+        Parameters
+        ----------
+        intensity : array
+            The intensities of each well in µmol/(m^2*s).
+        gcal : array, optional
+            Grayscale calibration values. If None (default), use same gcal
+            as in calibration data.
         min_dc : array, optional
             Minimum dc value to return.
         uniform : bool, optional
@@ -459,53 +1452,2838 @@ class LEDSet(object):
 
         Returns
         -------
-        array
-            Optimized dot correction values.
+        array
+            Optimized dot correction values.
+
+        """
+        # Get calibration values for relevant wells
+        well = self._get_well(row, col)
+        measured_dc = self.measured_dc[well]
+        measured_gcal = self.measured_gcal[well]
+        measured_intensity = self.measured_intensity[well]
+        # Convert intensity input to array
+        intensity = numpy.array(intensity)
+        # Convert gcal to arrays, or use measured calibration values
+        if gcal is not None:
+            gcal = numpy.array(gcal)
+        else:
+            gcal = measured_gcal
+        # Calculate dc value
+        # We calculate the dot correction value required to achieve the desired
+        # intensity with 4095 grayscale, and then round up.
+        dc = measured_dc * (intensity/measured_intensity) * \
+                           (measured_gcal/gcal)
+        dc = numpy.ceil(dc).astype(numpy.uint16)
+        # Saturate
+        dc = numpy.maximum(dc, min_dc)
+        # Make uniform if necessary
+        if uniform:
+            dc.fill(numpy.max(dc))
+        # Verify that the dc values are feasible
+        if numpy.any(dc > 63):
+            raise ValueError("not possible to generate requested intensity")
+
+        return dc
+
+    def optimize_dc_gcal(self,
+                         intensity,
+                         min_dc=1,
+                         max_dc=63,
+                         min_gcal=1,
+                         max_gcal=255,
+                         row=None,
+                         col=None,
+                         chunk_size=2**22):
+        """
+        Get dc and gcal values that minimize the discretization error.
+
+        At constant dc and gcal values, intensities are represented by
+        integer grayscale values ranging from 0 to 4095, and the size of
+        each grayscale step is proportional to the product of dc and gcal.
+        This function considers every feasible (dc, gcal) pair on each
+        well, and returns the one that minimizes the sum of squared
+        differences between the specified intensities and their
+        discretized values. Pairs are evaluated on a growing subset of
+        intensities, and discarded as soon as their error on the subset
+        exceeds the full error of the best pair found so far.
+
+        Pairs with the same product of dc and gcal produce the same
+        intensities. Among these, the one with the dc value closest to the
+        calibration dc is used, since intensities at other dc values are
+        only approximate. Remaining ties are broken in favor of higher gcal
+        values.
+
+        Parameters
+        ----------
+        intensity : array
+            Intensities of each well over time in µmol/(m^2*s), with
+            dimensions ``(n_steps, n_wells)``.
+        min_dc, max_dc : int, optional
+            Range of dot correction values to consider.
+        min_gcal, max_gcal : int, optional
+            Range of grayscale calibration values to consider.
+        row : array, optional
+            Row positions of each well, zero-indexed.
+        col : array, optional
+            Column positions of each well, zero-indexed.
+        chunk_size : int, optional
+            Maximum number of (candidate, intensity) combinations
+            evaluated at a time. This limits the amount of temporary memory
+            used.
+
+        Returns
+        -------
+        dc : array
+            Optimized dot correction values.
+        gcal : array
+            Optimized grayscale calibration values.
+        error : array
+            Sum of squared discretization errors at the optimized values,
+            in (µmol/(m^2*s))^2.
+
+        Raises
+        ------
+        ValueError
+            If the intensities of a well cannot be generated with any
+            (dc, gcal) pair in the specified ranges, or if they are
+            negative.
+
+        """
+        well = self._get_well(row, col)
+        intensity = numpy.asarray(intensity, dtype=float)
+        if intensity.ndim == 1:
+            intensity = intensity[:, numpy.newaxis]
+        measured_dc = self.measured_dc[well][:, numpy.newaxis]
+        measured_gcal = self.measured_gcal[well][:, numpy.newaxis]
+        measured_intensity = self.measured_intensity[well][:, numpy.newaxis]
+        # All candidate pairs, sorted by product
+        dc_candidates, gcal_candidates = numpy.meshgrid(
+            numpy.arange(min_dc, max_dc + 1),
+            numpy.arange(min_gcal, max_gcal + 1),
+            indexing='ij')
+        dc_candidates = dc_candidates.ravel()
+        gcal_candidates = gcal_candidates.ravel()
+        product = dc_candidates*gcal_candidates
+        order = numpy.argsort(product, kind='stable')
+        dc_candidates = dc_candidates[order]
+        gcal_candidates = gcal_candidates[order]
+        product = product[order]
+        first = numpy.flatnonzero(numpy.concatenate(
+            ([True], numpy.diff(product) != 0)))
+        # Keep one pair per product on each well, ordered by preference.
+        # Products are sorted in the same way on all wells.
+        dc_distance = numpy.abs(dc_candidates - measured_dc)
+        order = numpy.lexsort(
+            (numpy.broadcast_to(-gcal_candidates, dc_distance.shape),
+             dc_distance,
+             numpy.broadcast_to(product, dc_distance.shape)),
+            axis=-1)[:, first]
+        dc_all = dc_candidates[order]
+        gcal_all = gcal_candidates[order]
+        dc_distance = numpy.take_along_axis(dc_distance, order, axis=-1)
+        # Intensity per grayscale step, increasing with the product
+        step_all = measured_intensity * (dc_all/measured_dc) * \
+            (gcal_all/measured_gcal) / 4095.
+        # Discard infeasible pairs
+        min_intensity = intensity.min(axis=0)
+        max_intensity = intensity.max(axis=0)
+        feasible_all = max_intensity[:, numpy.newaxis]/step_all < 4095.5
+
+        dc = numpy.zeros(len(well), dtype=int)
+        gcal = numpy.zeros(len(well), dtype=int)
+        error = numpy.zeros(len(well))
+        for i in range(len(well)):
+            if min_intensity[i] < 0:
+                raise ValueError("intensities should not be negative")
+            feasible = feasible_all[i]
+            if not numpy.any(feasible):
+                raise ValueError("not possible to generate requested "
+                    "intensity with any dc and gcal value")
+            dc_w = dc_all[i][feasible]
+            gcal_w = gcal_all[i][feasible]
+            step = step_all[i][feasible]
+            # Unique intensities and number of occurrences
+            values, counts = numpy.unique(intensity[:, i],
+                                          return_counts=True)
+            # Evaluate error of each pair, on a few values at a time. The
+            # full error of the pair with the lowest partial error is an
+            # upper bound for the lowest error, and pairs with a partial
+            # error above this bound are discarded. Values are evaluated in
+            # an order that samples their whole range early, and the
+            # number of values evaluated at a time increases as pairs are
+            # discarded.
+            order = numpy.argsort(numpy.arange(len(values)) % 64,
+                                  kind='stable')
+            values = values[order]
+            counts = counts[order]
+            error_w = numpy.zeros(len(step))
+            active = numpy.arange(len(step))
+            start = 0
+            chunk_values = 64
+            while start < len(values):
+                v = values[start:start + max(1, min(chunk_values,
+                                                    chunk_size//len(active)))]
+                c = counts[start:start + len(v)]
+                s = step[active][:, numpy.newaxis]
+                d = v - s*numpy.round(v/s)
+                error_w[active] += numpy.dot(d*d, c)
+                start += len(v)
+                chunk_values *= 2
+                if start < len(values):
+                    s = step[active[numpy.argmin(error_w[active])]]
+                    d = values - s*numpy.round(values/s)
+                    bound = numpy.dot(d*d, counts)
+                    active = active[
+                        error_w[active] <= bound*(1 + 1e-9) + 1e-24]
+            # Choose pair with lowest error. Errors within floating point
+            # precision are considered ties.
+            error_w = error_w[active]
+            tolerance = 1e-9*error_w.min() + 1e-24
+            candidates = active[error_w <= error_w.min() + tolerance]
+            best = candidates[numpy.lexsort((-gcal_w[candidates],
+                                             dc_distance[i][feasible]
+                                             [candidates]))[0]]
+            dc[i] = dc_w[best]
+            gcal[i] = gcal_w[best]
+            error[i] = error_w[numpy.searchsorted(active, best)]
+
+        return dc, gcal, error
+
+def _load_layout_index(file_name):
+    """
+    Load an LED layout table into a dictionary.
+
+    The returned dictionary maps tuples of (LPA name, zero-indexed channel,
+    layout name) to lists of LED set names.
+
+    """
+    import pandas
+    with instrumentation.stage('LPA.read_layout_table'):
+        layout_table = pandas.read_excel(file_name)
+    layout_index = {}
+    for lpa_name, channel, layout, led_set_name in zip(
+            layout_table['LPA'],
+            layout_table['Channel'],
+            layout_table['Layout'],
+            layout_table['LED Set']):
+        # Skip incomplete rows
+        if pandas.isnull(channel):
+            continue
+        key = (lpa_name, int(channel) - 1, layout)
+        layout_index.setdefault(key, []).append(led_set_name)
+    return layout_index
+
+def _find_led_set_name(layout_index, lpa_name, channel, layout, file_name):
+    """
+    Get the name of the LED set that corresponds to a layout.
+
+    `channel` is zero-indexed. `file_name` is only used in error messages.
+
+    """
+    led_set_names = layout_index.get((lpa_name, channel, layout), [])
+    # Check for more or less than one hit
+    if len(led_set_names) > 1:
+        raise ValueError("more than one rows with LPA name {},"
+            " Channel {}, Layout {} in {}".format(
+                lpa_name, channel + 1, layout, file_name))
+    elif len(led_set_names) < 1:
+        raise ValueError("no layout data for LPA name {},"
+            " Channel {}, Layout {} in {}".format(
+                lpa_name, channel + 1, layout, file_name))
+    return led_set_names[0]
+
+def _get_led_set_file_name(path, led_set_name, lpa_name, channel):
+    """
+    Get the name of the Excel file with calibration data of an LED set.
+
+    `channel` is zero-indexed.
+
+    """
+    return os.path.join(path,
+                        led_set_name,
+                        "{}_c{}".format(lpa_name, channel + 1),
+                        "{}_{}_c{}.xlsx".format(led_set_name,
+                                                lpa_name,
+                                                channel + 1))
+
+class CalibrationRepository(object):
+    """
+    Collection of LED set calibration files in a folder.
+
+    A calibration repository locates calibration files as described in
+    `LPA`, relative to its own root folder and layout file. The layout
+    table is read once, when first needed, and LEDSet objects are cached
+    after being loaded. Therefore, many LPA objects using the same
+    repository only read each calibration file once.
+
+    Repositories can be safely used from several threads. Separate
+    repositories have separate caches, and can point to different
+    folders. This allows, for example, to concurrently generate programs
+    against production calibration data and a candidate recalibration.
+
+    Parameters
+    ----------
+    path : str, optional
+        Folder containing calibration data. If None, use
+        ``LED_CALIBRATION_PATH``.
+    layout_file_name : str, optional
+        Name of the LED layout file inside `path`. If None, use
+        ``LED_LAYOUT_FILENAME``.
+
+    Attributes
+    ----------
+    path : str
+        Folder containing calibration data.
+    layout_file_name : str
+        Name of the LED layout file inside `path`.
+
+    """
+    def __init__(self, path=None, layout_file_name=None):
+        self.path = LED_CALIBRATION_PATH if path is None else path
+        self.layout_file_name = LED_LAYOUT_FILENAME \
+            if layout_file_name is None else layout_file_name
+        self._layout_index = None
+        self._led_sets = {}
+        self._lock = threading.RLock()
+
+    @property
+    def layout_index(self):
+        """
+        Dictionary mapping tuples of (LPA name, zero-indexed channel,
+        layout name) to lists of LED set names.
+
+        """
+        with self._lock:
+            if self._layout_index is None:
+                self._layout_index = _load_layout_index(
+                    os.path.join(self.path, self.layout_file_name))
+            return self._layout_index
+
+    def get_led_set_name(self, lpa_name, channel, layout):
+        """
+        Get the name of the LED set that corresponds to a layout.
+
+        Parameters
+        ----------
+        lpa_name : str
+            Name of the LPA.
+        channel : int
+            Channel of the LPA, zero-indexed.
+        layout : str
+            Name of the layout.
+
+        Returns
+        -------
+        str
+            Name of the LED set.
+
+        """
+        return _find_led_set_name(self.layout_index,
+                                  lpa_name,
+                                  channel,
+                                  layout,
+                                  self.layout_file_name)
+
+    def get_led_set(self, led_set_name, lpa_name, channel):
+        """
+        Get an LEDSet object, loading it if not already cached.
+
+        Parameters
+        ----------
+        led_set_name : str
+            Name of the LED set.
+        lpa_name : str
+            Name of the LPA.
+        channel : int
+            Channel of the LPA, zero-indexed.
+
+        Returns
+        -------
+        LEDSet
+            LEDSet object.
+
+        """
+        key = (led_set_name, lpa_name, channel)
+        with self._lock:
+            led_set = self._led_sets.get(key)
+            if led_set is None:
+                led_set = LEDSet(
+                    name=led_set_name,
+                    file_name=_get_led_set_file_name(self.path,
+                                                     led_set_name,
+                                                     lpa_name,
+                                                     channel))
+                self._led_sets[key] = led_set
+            return led_set
+
+    @property
+    def led_sets(self):
+        """
+        List of cached LEDSet objects.
+
+        """
+        with self._lock:
+            return list(self._led_sets.values())
+
+    def clear_cache(self):
+        """
+        Discard the layout table and all cached LEDSet objects.
+
+        """
+        with self._lock:
+            self._layout_index = None
+            self._led_sets = {}
+
+# SharedCalibration objects attached to a memory block by this process, by
+# block name. These are kept until closed or until the process exits, so
+# that each process attaches to a block only once.
+_attached_shared_calibration = {}
+
+def _close_shared_calibration():
+    # Close all memory blocks attached to by this process
+    for shared_calibration in list(_attached_shared_calibration.values()):
+        shared_calibration.close()
+
+atexit.register(_close_shared_calibration)
+
+class SharedCalibration(object):
+    """
+    Calibration data of many LED sets, stored in shared memory.
+
+    This object allows several processes to use the same LED set
+    calibration data without each of them reading calibration files or
+    keeping a copy in memory. The process that creates the object copies
+    the calibration arrays of all LED sets into one
+    ``multiprocessing.shared_memory`` block. When the object is pickled
+    and sent to a worker process, only the name of the block and a small
+    amount of metadata are transferred. The worker then attaches to the
+    block and creates LEDSet objects whose arrays are read-only views into
+    shared memory. Each worker process attaches only once, no matter how
+    many times the object is received.
+
+    To use the shared calibration data, pass this object as the
+    `calibration` argument of an `LPA`.
+
+    The creating process owns the memory block, and should call
+    `unlink()` when all workers are done. This object can also be used as
+    a context manager for this purpose. Other processes release their
+    attachment with `close()`, or automatically when they exit. LEDSet
+    objects obtained from this object remain usable after either call,
+    since their arrays are then copied out of shared memory. This
+    requires Python 3.8 or later.
+
+    Parameters
+    ----------
+    led_sets : list
+        LEDSet objects to share.
+    layout_index : dict, optional
+        Dictionary mapping tuples of (LPA name, zero-indexed channel,
+        layout name) to lists of LED set names, used to find LED sets by
+        layout. If None, only LED set names can be used.
+
+    """
+    def __init__(self, led_sets, layout_index=None):
+        from multiprocessing import shared_memory
+        # Calculate position of each LED set's data in the memory block.
+        # Three values are stored per well: dc, gcal, and intensity.
+        self._metadata = []
+        offset = 0
+        for led_set in led_sets:
+            n_wells = led_set.n_rows*led_set.n_cols
+            self._metadata.append((led_set.name,
+                                   led_set.lpa_name,
+                                   led_set.channel,
+                                   led_set.n_rows,
+                                   led_set.n_cols,
+                                   offset))
+            offset += 3*n_wells
+        self._size = offset
+        # Create memory block and copy data
+        self._shm = shared_memory.SharedMemory(create=True,
+                                               size=max(self._size*8, 1))
+        self._owner = True
+        data = numpy.ndarray((self._size,), dtype=float, buffer=self._shm.buf)
+        for led_set, metadata in zip(led_sets, self._metadata):
+            n_wells = led_set.n_rows*led_set.n_cols
+            offset = metadata[5]
+            data[offset:offset + n_wells] = led_set.measured_dc
+            data[offset + n_wells:offset + 2*n_wells] = led_set.measured_gcal
+            data[offset + 2*n_wells:offset + 3*n_wells] = \
+                led_set.measured_intensity
+        self.layout_index = dict(layout_index) if layout_index else {}
+        self._build_led_sets()
+
+    @classmethod
+    def load(cls, lpa_names, layout_names, repository=None):
+        """
+        Load LED sets for many LPAs from a calibration repository.
+
+        Parameters
+        ----------
+        lpa_names : list
+            Names of the LPAs.
+        layout_names : list or dict
+            Layout names for each channel, used for all LPAs. A dictionary
+            mapping each LPA name to a list of layout names can also be
+            used. ``None`` elements are skipped.
+        repository : CalibrationRepository, optional
+            Repository from which to load LED sets. If None, use a new
+            repository at ``LED_CALIBRATION_PATH``.
+
+        Returns
+        -------
+        SharedCalibration
+            The new object.
+
+        """
+        if repository is None:
+            repository = CalibrationRepository()
+        led_sets = []
+        layout_index = {}
+        for lpa_name in lpa_names:
+            if isinstance(layout_names, dict):
+                lpa_layout_names = layout_names[lpa_name]
+            else:
+                lpa_layout_names = layout_names
+            for channel, layout in enumerate(lpa_layout_names):
+                if layout is None:
+                    continue
+                led_set_name = repository.get_led_set_name(lpa_name,
+                                                           channel,
+                                                           layout)
+                layout_index[(lpa_name, channel, layout)] = [led_set_name]
+                led_sets.append(repository.get_led_set(led_set_name,
+                                                       lpa_name,
+                                                       channel))
+        return cls(led_sets, layout_index)
+
+    def _build_led_sets(self):
+        # Create LEDSet objects with views into shared memory
+        data = numpy.ndarray((self._size,), dtype=float, buffer=self._shm.buf)
+        data.flags.writeable = False
+        self._led_sets = {}
+        for name, lpa_name, channel, n_rows, n_cols, offset in self._metadata:
+            n_wells = n_rows*n_cols
+            self._led_sets[(name, lpa_name, channel)] = LEDSet.from_arrays(
+                name=name,
+                lpa_name=lpa_name,
+                channel=channel,
+                n_rows=n_rows,
+                n_cols=n_cols,
+                measured_dc=data[offset:offset + n_wells],
+                measured_gcal=data[offset + n_wells:offset + 2*n_wells],
+                measured_intensity=data[offset + 2*n_wells:
+                                        offset + 3*n_wells])
+
+    def __getstate__(self):
+        if self._shm is None:
+            raise ValueError("shared calibration is closed")
+        return {'name': self._shm.name,
+                'size': self._size,
+                'metadata': self._metadata,
+                'layout_index': self.layout_index}
+
+    def __setstate__(self, state):
+        from multiprocessing import shared_memory
+        self._size = state['size']
+        self._metadata = state['metadata']
+        self.layout_index = state['layout_index']
+        self._owner = False
+        attached = _attached_shared_calibration.get(state['name'])
+        if attached is None:
+            try:
+                # Prevent the resource tracker from removing the memory
+                # block when this process ends (Python 3.13 or later)
+                shm = shared_memory.SharedMemory(name=state['name'],
+                                                 track=False)
+            except TypeError:
+                shm = shared_memory.SharedMemory(name=state['name'])
+            self._shm = shm
+            self._build_led_sets()
+            _attached_shared_calibration[state['name']] = self
+        else:
+            # Share memory block and LEDSet objects with the first object
+            # received by this process
+            self._shm = attached._shm
+            self._led_sets = attached._led_sets
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.unlink()
+        return False
+
+    @property
+    def led_sets(self):
+        """
+        List of shared LEDSet objects.
+
+        """
+        return list(self._led_sets.values())
+
+    def get_led_set_name(self, lpa_name, channel, layout):
+        """
+        Get the name of the LED set that corresponds to a layout.
+
+        Parameters
+        ----------
+        lpa_name : str
+            Name of the LPA.
+        channel : int
+            Channel of the LPA, zero-indexed.
+        layout : str
+            Name of the layout.
+
+        Returns
+        -------
+        str
+            Name of the LED set.
+
+        """
+        return _find_led_set_name(self.layout_index,
+                                  lpa_name,
+                                  channel,
+                                  layout,
+                                  'shared calibration')
+
+    def get_led_set(self, led_set_name, lpa_name, channel):
+        """
+        Get a shared LEDSet object.
+
+        Parameters
+        ----------
+        led_set_name : str
+            Name of the LED set.
+        lpa_name : str
+            Name of the LPA.
+        channel : int
+            Channel of the LPA, zero-indexed.
+
+        Returns
+        -------
+        LEDSet
+            LEDSet object with read-only calibration arrays in shared
+            memory.
+
+        """
+        try:
+            return self._led_sets[(led_set_name, lpa_name, channel)]
+        except KeyError:
+            raise ValueError("LED set {} for LPA {}, channel {} not found in "
+                "shared calibration".format(led_set_name,
+                                            lpa_name,
+                                            channel + 1))
+
+    def _detach(self):
+        # Copy the arrays of all LEDSet objects out of shared memory
+        for led_set in self._led_sets.values():
+            for attr in ['measured_dc', 'measured_gcal', 'measured_intensity']:
+                values = numpy.array(getattr(led_set, attr))
+                values.flags.writeable = False
+                setattr(led_set, attr, values)
+
+    def _close(self):
+        # Close the memory block and return it, or None if already closed
+        shm = self._shm
+        if shm is None:
+            return None
+        # Objects received by this process share the same memory block
+        attached = _attached_shared_calibration.get(shm.name)
+        if (attached is not None) and (attached._shm is shm):
+            del _attached_shared_calibration[shm.name]
+            attached._shm = None
+        self._shm = None
+        self._detach()
+        shm.close()
+        return shm
+
+    def close(self):
+        """
+        Close this process's attachment to the shared memory block.
+
+        LEDSet objects obtained from this object keep working, with their
+        own copy of the calibration arrays. Arrays previously obtained from
+        these LEDSet objects, however, should no longer be used.
+
+        """
+        self._close()
+
+    def unlink(self):
+        """
+        Close and release the shared memory block.
+
+        This should only be called by the process that created this object,
+        after all workers are done. LEDSet objects obtained from this object
+        keep working, as described in `close()`.
+
+        """
+        if self._owner:
+            shm = self._close()
+            if shm is not None:
+                shm.unlink()
+
+class VirtualIntensity(object):
+    """
+    Base class for intensity arrays that are calculated on access.
+
+    A virtual intensity array behaves like a read-only numpy array of size
+    (n_steps, n_rows, n_cols, n_channels) with light intensity values in
+    µmol/(m^2*s), but values are only calculated for the elements being
+    accessed. This allows inspecting or processing a few steps, wells,
+    or channels at a time without allocating the full array.
+
+    Modifying any element calculates all values and stores them in a
+    regular array, in the `dense` attribute, which is used from then on.
+    In-place operators, such as ``intensity *= 2``, also modify `dense`.
+    Objects that store a virtual intensity array, such as `LPA`, replace
+    it with `dense` afterwards.
+
+    Virtual intensity arrays can be passed to numpy functions, which
+    calculate all values first. Arithmetic operators and the methods
+    `copy()`, `astype()`, `min()`, `max()`, `sum()`, and `mean()` do the
+    same, and return regular arrays.
+
+    Subclasses should implement ``_get_items(key)``, which calculates the
+    values of ``self[key]`` for any valid numpy index ``key``.
+
+    Properties
+    ----------
+    shape : tuple
+        Size of the array.
+
+    Attributes
+    ----------
+    shape : tuple
+        Size of the array.
+    ndim : int
+        Number of dimensions.
+    size : int
+        Number of elements.
+    dtype : numpy.dtype
+        Data type of the calculated values.
+    dense : array or None
+        Array with all values, if it has been created.
+
+    """
+    dtype = numpy.dtype(float)
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.dense = None
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(numpy.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if self.dense is not None:
+            return self.dense[key]
+        return self._get_items(key)
+
+    def __setitem__(self, key, value):
+        self.materialize()[key] = value
+
+    def __array__(self, dtype=None, copy=None):
+        if self.dense is not None:
+            values = self.dense
+        else:
+            values = self._get_items(Ellipsis)
+        if dtype is not None:
+            values = values.astype(dtype)
+        return values
+
+    def copy(self):
+        """
+        Get a regular array with a copy of all values.
+
+        """
+        return numpy.array(self)
+
+    def astype(self, dtype):
+        """
+        Get a regular array with all values converted to a data type.
+
+        """
+        return numpy.array(self, dtype=dtype)
+
+    def min(self, *args, **kwargs):
+        return numpy.asarray(self).min(*args, **kwargs)
+
+    def max(self, *args, **kwargs):
+        return numpy.asarray(self).max(*args, **kwargs)
+
+    def sum(self, *args, **kwargs):
+        return numpy.asarray(self).sum(*args, **kwargs)
+
+    def mean(self, *args, **kwargs):
+        return numpy.asarray(self).mean(*args, **kwargs)
+
+    def __neg__(self):
+        return -numpy.asarray(self)
+
+    def __add__(self, other):
+        return numpy.asarray(self) + other
+
+    def __radd__(self, other):
+        return other + numpy.asarray(self)
+
+    def __sub__(self, other):
+        return numpy.asarray(self) - other
+
+    def __rsub__(self, other):
+        return other - numpy.asarray(self)
+
+    def __mul__(self, other):
+        return numpy.asarray(self) * other
+
+    def __rmul__(self, other):
+        return other * numpy.asarray(self)
+
+    def __truediv__(self, other):
+        return numpy.asarray(self) / other
+
+    def __rtruediv__(self, other):
+        return other / numpy.asarray(self)
+
+    def __iadd__(self, other):
+        self.materialize()[...] += other
+        return self
+
+    def __isub__(self, other):
+        self.materialize()[...] -= other
+        return self
+
+    def __imul__(self, other):
+        self.materialize()[...] *= other
+        return self
+
+    def __itruediv__(self, other):
+        self.materialize()[...] /= other
+        return self
+
+    def materialize(self):
+        """
+        Calculate all values and store them in the `dense` attribute.
+
+        Returns
+        -------
+        array
+            Array with all values.
+
+        """
+        if self.dense is None:
+            self.dense = numpy.array(self._get_items(Ellipsis), dtype=float)
+        return self.dense
+
+    def _get_items(self, key):
+        raise NotImplementedError
+
+def _split_step_key(key, n_steps):
+    # Split a numpy index into an array of size (n_steps, ...) into the
+    # selected steps and the index of the remaining dimensions. Returns
+    # ``(steps, rest, is_slice)``, where ``steps`` is an integer array with
+    # the selected steps, or None if the index cannot be split (e.g. if it
+    # starts with an ellipsis). If ``is_slice`` is True, steps were selected
+    # with a slice, and ``rest`` should be applied after selecting steps.
+    # Otherwise, ``array[key]`` is equivalent to ``array[(steps,) + rest]``.
+    if not isinstance(key, tuple):
+        key = (key,)
+    step_key = key[0] if key else Ellipsis
+    rest = key[1:]
+    if isinstance(step_key, slice):
+        return numpy.arange(*step_key.indices(n_steps)), rest, True
+    if step_key is Ellipsis or step_key is None:
+        return None, rest, False
+    steps = numpy.asarray(step_key)
+    if steps.dtype == bool and steps.ndim == 1:
+        if len(steps) != n_steps:
+            raise IndexError("boolean index did not match the number of "
+                "steps")
+        return numpy.nonzero(steps)[0], rest, False
+    elif steps.dtype.kind in 'ui':
+        if numpy.any((steps < -n_steps) | (steps >= n_steps)):
+            raise IndexError("step index out of bounds")
+        return numpy.where(steps < 0, steps + n_steps, steps), rest, False
+    else:
+        return None, rest, False
+
+class LazyIntensity(VirtualIntensity):
+    """
+    Intensity array calculated on access from grayscale values.
+
+    Intensities are obtained by looking up the intensity of each
+    grayscale value in tables built with `LEDSet.get_lut()`. Values are
+    identical to the ones calculated by setting `LPA.grayscale`. Grayscale
+    values can be stored in any array-like object that supports numpy
+    indexing, such as a memory-mapped file (see `LPF.load()`), in which
+    case only the accessed grayscale values are read.
+
+    Parameters
+    ----------
+    grayscale : array
+        Array of size (n_steps, n_rows, n_cols, n_channels) with integer
+        grayscale values.
+    led_sets : list
+        LEDSet objects for each channel. Intensities of channels with an
+        LEDSet of None are zero.
+    dc : array
+        Array of size (n_rows, n_cols, n_channels) with dot correction
+        values.
+    gcal : array
+        Array of size (n_rows, n_cols, n_channels) with grayscale
+        calibration values.
+
+    Attributes
+    ----------
+    grayscale : array
+        Array of size (n_steps, n_rows, n_cols, n_channels) with grayscale
+        values.
+
+    """
+    def __init__(self, grayscale, led_sets, dc, gcal):
+        super(LazyIntensity, self).__init__(grayscale.shape)
+        self.grayscale = grayscale
+        n_steps, n_rows, n_cols, n_channels = grayscale.shape
+        n_wells = n_rows*n_cols
+        # Lookup tables of all LEDs, ordered by channel and well, and
+        # position of each LED's table in the flattened lookup table
+        self._lut = numpy.zeros((n_channels, n_wells, 4096))
+        for channel, led_set in enumerate(led_sets):
+            if led_set is not None:
+                self._lut[channel] = led_set.get_lut(
+                    dc=dc[:, :, channel].flatten(),
+                    gcal=gcal[:, :, channel].flatten())
+        self._lut = self._lut.ravel()
+        self._offsets = (numpy.arange(n_channels)*n_wells + \
+            numpy.arange(n_wells).reshape(n_rows, n_cols, 1))*4096
+
+    def _get_items(self, key):
+        gs = numpy.asarray(self.grayscale[key])
+        if gs.size and gs.max() > 4095:
+            raise ValueError("grayscale values should not be greater than 4095")
+        offsets = numpy.broadcast_to(self._offsets, self.shape)[key]
+        return numpy.take(self._lut, offsets + gs)
+
+class PeriodicIntensity(VirtualIntensity):
+    """
+    Intensity array made of a cycle of steps repeated several times.
+
+    The array consists of the steps in `prefix`, followed by the steps in
+    `cycle` repeated `n_repeats` times, followed by the steps in `suffix`.
+    Only these steps are stored. `ConversionEngine` converts each of them
+    once, such that `LPA.grayscale`, `LPA.discretize_intensity()`, and
+    `LPA.save_lpf()` take time proportional to the length of the cycle
+    rather than the total number of steps. `LPA.save_lpf()` also writes
+    the repeated grayscale values without creating the full array.
+
+    Parameters
+    ----------
+    cycle : array
+        Array of size (n_cycle_steps, n_rows, n_cols, n_channels) with
+        light intensity values of one cycle, in µmol/(m^2*s).
+    n_repeats : int
+        Number of times the cycle is repeated.
+    prefix : array, optional
+        Array of size (n_prefix_steps, n_rows, n_cols, n_channels) with
+        light intensity values before the first cycle.
+    suffix : array, optional
+        Array of size (n_suffix_steps, n_rows, n_cols, n_channels) with
+        light intensity values after the last cycle.
+
+    Attributes
+    ----------
+    cycle : array
+        Light intensity values of one cycle.
+    n_repeats : int
+        Number of times the cycle is repeated.
+    prefix : array
+        Light intensity values before the first cycle.
+    suffix : array
+        Light intensity values after the last cycle.
+
+    """
+    def __init__(self, cycle, n_repeats, prefix=None, suffix=None):
+        cycle = numpy.array(cycle, dtype=float)
+        if cycle.ndim != 4:
+            raise ValueError("cycle should be a 4D array")
+        if n_repeats < 0:
+            raise ValueError("n_repeats should not be negative")
+        if prefix is None:
+            prefix = numpy.zeros((0,) + cycle.shape[1:])
+        if suffix is None:
+            suffix = numpy.zeros((0,) + cycle.shape[1:])
+        prefix = numpy.array(prefix, dtype=float)
+        suffix = numpy.array(suffix, dtype=float)
+        if prefix.shape[1:] != cycle.shape[1:]:
+            raise ValueError("prefix dimensions are not appropriate")
+        if suffix.shape[1:] != cycle.shape[1:]:
+            raise ValueError("suffix dimensions are not appropriate")
+        self.cycle = cycle
+        self.n_repeats = int(n_repeats)
+        self.prefix = prefix
+        self.suffix = suffix
+        n_steps = len(prefix) + self.n_repeats*len(cycle) + len(suffix)
+        super(PeriodicIntensity, self).__init__((n_steps,) + cycle.shape[1:])
+        # Stored steps in one array, in order
+        self._steps = numpy.concatenate([prefix, cycle, suffix])
+
+    @property
+    def segments(self):
+        """
+        Parts of the array with distinct steps.
+
+        List of tuples ``(intensity, first_step, n_repeats)``, one for each
+        of the prefix, cycle, and suffix, indicating that steps
+        ``first_step`` to ``first_step + n_repeats*len(intensity)`` are
+        ``intensity`` repeated ``n_repeats`` times. Parts without steps
+        are omitted.
+
+        """
+        segments = [(self.prefix, 0, 1),
+                    (self.cycle, len(self.prefix), self.n_repeats),
+                    (self.suffix,
+                     len(self.prefix) + self.n_repeats*len(self.cycle),
+                     1)]
+        return [s for s in segments if len(s[0]) and s[2]]
+
+    def _get_source_steps(self, steps):
+        # Get the position in ``_steps`` of each step in the array
+        n_prefix = len(self.prefix)
+        n_cycle = len(self.cycle)
+        cycle_stop = n_prefix + self.n_repeats*n_cycle
+        steps = numpy.asarray(steps)
+        source_steps = numpy.where(steps >= cycle_stop,
+                                   steps - cycle_stop + n_prefix + n_cycle,
+                                   steps)
+        if n_cycle:
+            source_steps = numpy.where(
+                (steps >= n_prefix) & (steps < cycle_stop),
+                n_prefix + (steps - n_prefix) % n_cycle,
+                source_steps)
+        return source_steps
+
+    def _get_items(self, key):
+        steps, rest, is_slice = _split_step_key(key, self.shape[0])
+        if steps is None:
+            # Build all steps, and index them with the full key
+            return self._steps[self._get_source_steps(
+                numpy.arange(self.shape[0]))][key]
+        elif is_slice:
+            return self._steps[self._get_source_steps(steps)][
+                (slice(None),) + rest]
+        else:
+            return self._steps[(self._get_source_steps(steps),) + rest]
+
+class Waveform(object):
+    """
+    Base class for light intensity waveforms.
+
+    A waveform describes the light intensity of an LED, in µmol/(m^2*s),
+    as a function of time measured in steps. Waveforms are evaluated
+    only when needed, for example by a `WaveformIntensity` object, so
+    that programs of any length can be described in constant memory.
+
+    Waveforms can be added, subtracted, and multiplied with each other
+    or with numbers, which results in a new waveform.
+
+    Subclasses should implement ``evaluate(t)``. Subclasses can also
+    implement ``integrate(t_start, t_stop)`` with an exact integral,
+    which is otherwise calculated with Gauss-Legendre quadrature.
+
+    Attributes
+    ----------
+    quadrature_points : int
+        Number of points per interval used by Gauss-Legendre quadrature.
+    quadrature_chunk : int
+        Maximum number of intervals integrated at once by Gauss-Legendre
+        quadrature, which limits the memory used.
+
+    """
+    quadrature_points = 16
+    quadrature_chunk = 65536
+
+    def evaluate(self, t):
+        """
+        Calculate intensities at specified times.
+
+        Parameters
+        ----------
+        t : array
+            Times at which to calculate intensities, in steps. Step ``i``
+            starts at time ``i``.
+
+        Returns
+        -------
+        array
+            Intensities at each time, in µmol/(m^2*s).
+
+        """
+        raise NotImplementedError
+
+    def integrate(self, t_start, t_stop):
+        """
+        Calculate the integral of intensity over time intervals.
+
+        Parameters
+        ----------
+        t_start, t_stop : array
+            Start and end of each interval, in steps.
+
+        Returns
+        -------
+        array
+            Integral of intensity over each interval, in
+            µmol/(m^2*s)*steps.
+
+        """
+        t_start, t_stop = numpy.broadcast_arrays(
+            numpy.asarray(t_start, dtype=float),
+            numpy.asarray(t_stop, dtype=float))
+        x, w = numpy.polynomial.legendre.leggauss(self.quadrature_points)
+        shape = t_start.shape
+        t_start = t_start.ravel()
+        t_stop = t_stop.ravel()
+        integral = numpy.empty(t_start.shape)
+        # Integrate in chunks to limit the size of the array of points
+        for start in range(0, len(integral), self.quadrature_chunk):
+            stop = start + self.quadrature_chunk
+            half = (t_stop[start:stop] - t_start[start:stop])/2.
+            mid = (t_stop[start:stop] + t_start[start:stop])/2.
+            values = self.evaluate(mid[:, numpy.newaxis] +
+                                   half[:, numpy.newaxis]*x)
+            integral[start:stop] = half*values.dot(w)
+        return integral.reshape(shape)
+
+    def average(self, t_start, t_stop):
+        """
+        Calculate the average intensity over time intervals.
+
+        Intervals of zero length return the intensity at their start.
+
+        Parameters
+        ----------
+        t_start, t_stop : array
+            Start and end of each interval, in steps.
+
+        Returns
+        -------
+        array
+            Average intensity over each interval, in µmol/(m^2*s).
+
+        """
+        t_start, t_stop = numpy.broadcast_arrays(
+            numpy.asarray(t_start, dtype=float),
+            numpy.asarray(t_stop, dtype=float))
+        length = t_stop - t_start
+        empty = length == 0
+        intensity = self.integrate(t_start, t_stop) / \
+            numpy.where(empty, 1., length)
+        if numpy.any(empty):
+            intensity = numpy.where(empty, self.evaluate(t_start), intensity)
+        return intensity
+
+    def __add__(self, other):
+        other = _as_waveform(other)
+        if other is NotImplemented:
+            return other
+        return _Sum(self, other)
+
+    def __radd__(self, other):
+        other = _as_waveform(other)
+        if other is NotImplemented:
+            return other
+        return _Sum(other, self)
+
+    def __sub__(self, other):
+        other = _as_waveform(other)
+        if other is NotImplemented:
+            return other
+        return _Sum(self, -other)
+
+    def __rsub__(self, other):
+        other = _as_waveform(other)
+        if other is NotImplemented:
+            return other
+        return _Sum(other, -self)
+
+    def __mul__(self, other):
+        other = _as_waveform(other)
+        if other is NotImplemented:
+            return other
+        return _Product(self, other)
+
+    def __rmul__(self, other):
+        other = _as_waveform(other)
+        if other is NotImplemented:
+            return other
+        return _Product(other, self)
+
+    def __neg__(self):
+        return _Product(Constant(-1.), self)
+
+def _as_waveform(value):
+    # Convert numbers to constant waveforms
+    if isinstance(value, Waveform):
+        return value
+    elif isinstance(value, numbers.Real):
+        return Constant(value)
+    else:
+        return NotImplemented
+
+class _Sum(Waveform):
+    # Sum of two waveforms
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+
+    def evaluate(self, t):
+        return self.a.evaluate(t) + self.b.evaluate(t)
+
+    def integrate(self, t_start, t_stop):
+        return self.a.integrate(t_start, t_stop) + \
+            self.b.integrate(t_start, t_stop)
+
+class _Product(Waveform):
+    # Product of two waveforms
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+
+    def evaluate(self, t):
+        return self.a.evaluate(t) * self.b.evaluate(t)
+
+    def integrate(self, t_start, t_stop):
+        # Products with a constant can be integrated exactly
+        if isinstance(self.a, Constant):
+            return self.a.value*self.b.integrate(t_start, t_stop)
+        elif isinstance(self.b, Constant):
+            return self.b.value*self.a.integrate(t_start, t_stop)
+        return super(_Product, self).integrate(t_start, t_stop)
+
+class Constant(Waveform):
+    """
+    Waveform with a constant intensity.
+
+    Parameters
+    ----------
+    value : float
+        Intensity, in µmol/(m^2*s).
+
+    """
+    def __init__(self, value):
+        self.value = float(value)
+
+    def evaluate(self, t):
+        return numpy.full(numpy.shape(t), self.value)
+
+    def integrate(self, t_start, t_stop):
+        return self.value*(numpy.asarray(t_stop, dtype=float) -
+                           numpy.asarray(t_start, dtype=float))
+
+class Ramp(Waveform):
+    """
+    Waveform that changes linearly between two intensities.
+
+    At steps ``first_step`` to ``first_step + n_steps - 1``, intensities
+    are the same as ``numpy.linspace(start, stop, n_steps)``. Intensities
+    are `start` before, and `stop` after.
+
+    Parameters
+    ----------
+    start, stop : float
+        Intensities at the beginning and end of the ramp, in
+        µmol/(m^2*s).
+    n_steps : int
+        Number of steps in the ramp.
+    first_step : int, optional
+        Step at which the ramp starts.
+
+    """
+    def __init__(self, start, stop, n_steps, first_step=0):
+        self.start = float(start)
+        self.stop = float(stop)
+        self.n_steps = int(n_steps)
+        self.first_step = first_step
+
+    def _get_fraction(self, t):
+        # Fraction of the ramp completed at each time
+        if self.n_steps <= 1:
+            return numpy.zeros(numpy.shape(t))
+        return numpy.clip((numpy.asarray(t) - self.first_step) /
+                          float(self.n_steps - 1), 0., 1.)
+
+    def evaluate(self, t):
+        return self.start + (self.stop - self.start)*self._get_fraction(t)
+
+    def _integrate_ramp(self, duration):
+        # Integral from the start of the ramp to ``duration`` steps later,
+        # with ``0 <= duration <= n_steps - 1``
+        slope = (self.stop - self.start)/float(self.n_steps - 1)
+        return duration*(self.start + slope*duration/2.)
+
+    def _antiderivative(self, t):
+        # Integral from the start of the ramp to time t
+        t = numpy.asarray(t, dtype=float)
+        if self.n_steps <= 1:
+            return self.start*(t - self.first_step)
+        last_step = self.first_step + self.n_steps - 1
+        return self.start*(numpy.minimum(t, self.first_step) -
+                           self.first_step) + \
+            self._integrate_ramp(numpy.clip(t, self.first_step, last_step) -
+                                 self.first_step) + \
+            self.stop*(numpy.maximum(t, last_step) - last_step)
+
+    def integrate(self, t_start, t_stop):
+        return self._antiderivative(t_stop) - self._antiderivative(t_start)
+
+class LogRamp(Ramp):
+    """
+    Waveform that changes exponentially between two intensities.
+
+    At steps ``first_step`` to ``first_step + n_steps - 1``, intensities
+    are the same as ``numpy.logspace(numpy.log10(start),
+    numpy.log10(stop), n_steps)``. Intensities are `start` before, and
+    `stop` after.
+
+    Parameters
+    ----------
+    start, stop : float
+        Intensities at the beginning and end of the ramp, in
+        µmol/(m^2*s). Should be greater than zero.
+    n_steps : int
+        Number of steps in the ramp.
+    first_step : int, optional
+        Step at which the ramp starts.
+
+    """
+    def __init__(self, start, stop, n_steps, first_step=0):
+        if start <= 0 or stop <= 0:
+            raise ValueError("start and stop should be greater than zero")
+        super(LogRamp, self).__init__(start, stop, n_steps, first_step)
+
+    def evaluate(self, t):
+        log_start = numpy.log10(self.start)
+        log_stop = numpy.log10(self.stop)
+        return 10**(log_start + (log_stop - log_start)*self._get_fraction(t))
+
+    def _integrate_ramp(self, duration):
+        # Integral of ``start*exp(rate*t)`` from zero to ``duration``
+        rate = numpy.log(self.stop/self.start)/float(self.n_steps - 1)
+        if rate == 0:
+            return self.start*duration
+        return self.start*numpy.expm1(rate*duration)/rate
+
+class Step(Waveform):
+    """
+    Waveform that changes from one intensity to another at a given step.
+
+    Parameters
+    ----------
+    before, after : float
+        Intensities before and after the change, in µmol/(m^2*s).
+    step : int
+        First step with intensity `after`.
+
+    """
+    def __init__(self, before, after, step):
+        self.before = float(before)
+        self.after = float(after)
+        self.step = step
+
+    def evaluate(self, t):
+        return numpy.where(numpy.asarray(t) < self.step,
+                           self.before,
+                           self.after)
+
+    def integrate(self, t_start, t_stop):
+        def antiderivative(t):
+            t = numpy.asarray(t, dtype=float)
+            return self.before*(numpy.minimum(t, self.step) - self.step) + \
+                self.after*(numpy.maximum(t, self.step) - self.step)
+        return antiderivative(t_stop) - antiderivative(t_start)
+
+class PulseTrain(Waveform):
+    """
+    Waveform with periodic pulses of constant intensity.
+
+    Parameters
+    ----------
+    intensity : float
+        Intensity during pulses, in µmol/(m^2*s).
+    period : float
+        Time between the start of consecutive pulses, in steps.
+    duration : float
+        Duration of each pulse, in steps.
+    first_step : float, optional
+        Start of the first pulse.
+    n_pulses : int, optional
+        Number of pulses. If None, pulses continue indefinitely.
+    baseline : float, optional
+        Intensity outside of pulses, in µmol/(m^2*s).
+
+    """
+    def __init__(self,
+                 intensity,
+                 period,
+                 duration,
+                 first_step=0,
+                 n_pulses=None,
+                 baseline=0.):
+        self.intensity = float(intensity)
+        self.period = period
+        self.duration = duration
+        self.first_step = first_step
+        self.n_pulses = n_pulses
+        self.baseline = float(baseline)
+
+    def evaluate(self, t):
+        t = numpy.asarray(t) - self.first_step
+        on = (t >= 0) & (numpy.mod(t, self.period) < self.duration)
+        if self.n_pulses is not None:
+            on &= t < self.n_pulses*self.period
+        return numpy.where(on, self.intensity, self.baseline)
+
+    def _get_on_time(self, t):
+        # Total duration of pulses from the first pulse to time t
+        t = numpy.maximum(numpy.asarray(t, dtype=float) - self.first_step,
+                          0.)
+        duration = min(self.duration, self.period)
+        n_periods = numpy.floor(t/self.period)
+        on_time = n_periods*duration + \
+            numpy.minimum(t - n_periods*self.period, duration)
+        if self.n_pulses is not None:
+            on_time = numpy.minimum(on_time, self.n_pulses*duration)
+        return on_time
+
+    def integrate(self, t_start, t_stop):
+        t_start = numpy.asarray(t_start, dtype=float)
+        t_stop = numpy.asarray(t_stop, dtype=float)
+        on_time = self._get_on_time(t_stop) - self._get_on_time(t_start)
+        return self.baseline*(t_stop - t_start) + \
+            (self.intensity - self.baseline)*on_time
+
+class Sine(Waveform):
+    """
+    Waveform with a sinusoidal intensity.
+
+    Intensity is ``mean + amplitude*sin(2*pi*t/period + phase)``, with
+    time `t` in steps.
+
+    Parameters
+    ----------
+    mean : float
+        Mean intensity, in µmol/(m^2*s).
+    amplitude : float
+        Amplitude, in µmol/(m^2*s).
+    period : float
+        Period, in steps.
+    phase : float, optional
+        Phase at time zero, in radians.
+
+    """
+    def __init__(self, mean, amplitude, period, phase=0.):
+        self.mean = float(mean)
+        self.amplitude = float(amplitude)
+        self.period = period
+        self.phase = float(phase)
+
+    def evaluate(self, t):
+        return self.mean + self.amplitude * \
+            numpy.sin(2*numpy.pi*numpy.asarray(t)/self.period + self.phase)
+
+    def integrate(self, t_start, t_stop):
+        t_start = numpy.asarray(t_start, dtype=float)
+        t_stop = numpy.asarray(t_stop, dtype=float)
+        # The difference of cosines is calculated as a product of sines,
+        # which is accurate for short intervals
+        w = numpy.pi/self.period
+        return self.mean*(t_stop - t_start) + \
+            self.amplitude/w*numpy.sin(w*(t_start + t_stop) + self.phase) * \
+            numpy.sin(w*(t_stop - t_start))
+
+class Piecewise(Waveform):
+    """
+    Waveform made of consecutive pieces.
+
+    Piece ``i`` starts at ``steps[i]`` and lasts until the next piece
+    starts. Each piece can be a constant intensity or a `Waveform`, which
+    is evaluated at the same times as the piecewise waveform.
+
+    Parameters
+    ----------
+    steps : array
+        Start of each piece, in increasing order.
+    values : list
+        Intensity, in µmol/(m^2*s), or `Waveform` object of each piece.
+    initial : float, optional
+        Intensity before the first piece, in µmol/(m^2*s).
+
+    """
+    def __init__(self, steps, values, initial=0.):
+        self.steps = numpy.array(steps, dtype=float)
+        if len(self.steps) != len(values):
+            raise ValueError("steps and values should have the same length")
+        if numpy.any(numpy.diff(self.steps) < 0):
+            raise ValueError("steps should be in increasing order")
+        self.values = list(values)
+        self.initial = float(initial)
+        # Constant pieces are evaluated by looking up this array
+        self._constant_values = numpy.array(
+            [self.initial] + [numpy.nan if isinstance(value, Waveform)
+                              else float(value) for value in self.values])
+        # Integral of constant pieces from the first piece to the start of
+        # each piece, used to integrate without looping over pieces
+        self._cumulative = numpy.concatenate(
+            [[0.], numpy.cumsum(numpy.diff(self.steps) *
+                                numpy.nan_to_num(self._constant_values[1:-1]))])
+
+    def evaluate(self, t):
+        t = numpy.asarray(t, dtype=float)
+        piece = numpy.searchsorted(self.steps, t, side='right')
+        intensity = self._constant_values[piece]
+        for i, value in enumerate(self.values):
+            if isinstance(value, Waveform):
+                mask = piece == i + 1
+                if numpy.any(mask):
+                    intensity[mask] = value.evaluate(t[mask])
+        return intensity
+
+    def _constant_antiderivative(self, t):
+        # Integral from the first piece to time t, excluding pieces that
+        # are waveforms
+        piece = numpy.searchsorted(self.steps, t, side='right')
+        values = numpy.nan_to_num(self._constant_values[piece])
+        first = numpy.maximum(piece - 1, 0)
+        return self._cumulative[first] + values*(t - self.steps[first])
+
+    def integrate(self, t_start, t_stop):
+        t_start, t_stop = numpy.broadcast_arrays(
+            numpy.asarray(t_start, dtype=float),
+            numpy.asarray(t_stop, dtype=float))
+        if not len(self.steps):
+            return self.initial*(t_stop - t_start)
+        integral = self._constant_antiderivative(t_stop) - \
+            self._constant_antiderivative(t_start)
+        # Add the part of each interval within pieces that are waveforms
+        piece_stops = numpy.append(self.steps[1:], numpy.inf)
+        for i, value in enumerate(self.values):
+            if isinstance(value, Waveform):
+                lower = numpy.clip(t_start, self.steps[i], piece_stops[i])
+                upper = numpy.clip(t_stop, self.steps[i], piece_stops[i])
+                mask = lower != upper
+                if numpy.any(mask):
+                    integral[mask] += value.integrate(lower[mask],
+                                                      upper[mask])
+        return integral
+
+class StepAverage(Waveform):
+    """
+    Waveform with the average intensity of another one over each step.
+
+    The intensity at time ``t`` is the average intensity of `waveform`
+    from ``t`` to ``t + 1``. When evaluated at the start of each step,
+    this results in intensities that deliver the same light dose as
+    `waveform` regardless of how fast it changes within a step, instead
+    of sampling it at one point. Averages are calculated exactly for
+    the waveforms defined in this module, their sums, and their
+    products with constants, and by Gauss-Legendre quadrature
+    otherwise.
+
+    Parameters
+    ----------
+    waveform : Waveform
+        Waveform to average.
+
+    """
+    def __init__(self, waveform):
+        self.waveform = waveform
+
+    def evaluate(self, t):
+        t = numpy.asarray(t, dtype=float)
+        return self.waveform.average(t, t + 1)
+
+class _Samples(Waveform):
+    # Waveform with one intensity per step, looked up in an array that can
+    # be shared with other waveforms, e.g. a row of a larger array. As in a
+    # Piecewise waveform with one piece per step, the intensity is zero
+    # before the first step, and the last value after the last step.
+    def __init__(self, values):
+        self.values = values
+        self._cumulative = None
+
+    def _get_steps(self, t):
+        return numpy.clip(numpy.floor(t), 0, len(self.values) - 1).astype(
+            numpy.int64)
+
+    def evaluate(self, t):
+        t = numpy.asarray(t, dtype=float)
+        return numpy.where(t < 0, 0., self.values[self._get_steps(t)])
+
+    def _antiderivative(self, t):
+        # Integral from time zero to time t
+        if self._cumulative is None:
+            self._cumulative = numpy.concatenate(
+                [[0.], numpy.cumsum(self.values[:-1])])
+        steps = self._get_steps(t)
+        return numpy.where(
+            t < 0,
+            0.,
+            self._cumulative[steps] + self.values[steps]*(t - steps))
+
+    def integrate(self, t_start, t_stop):
+        t_start, t_stop = numpy.broadcast_arrays(
+            numpy.asarray(t_start, dtype=float),
+            numpy.asarray(t_stop, dtype=float))
+        return self._antiderivative(t_stop) - self._antiderivative(t_start)
+
+class _LEDIntensity(VirtualIntensity):
+    # Virtual intensity array whose values are calculated per LED.
+    # Subclasses should implement ``_evaluate(steps, leds)``, which returns
+    # the intensities of LEDs ``leds`` (an integer array with positions in
+    # a flattened (n_rows, n_cols, n_channels) array) at each step in
+    # ``steps``, as an array of size ``(len(steps),) + leds.shape``.
+    def __init__(self, shape):
+        super(_LEDIntensity, self).__init__(shape)
+        self._leds = numpy.arange(int(numpy.prod(shape[1:]))).reshape(
+            shape[1:])
+
+    def _evaluate(self, steps, leds):
+        raise NotImplementedError
+
+    def _get_items(self, key):
+        steps, rest, is_slice = _split_step_key(key, self.shape[0])
+        if steps is None:
+            return self._evaluate(numpy.arange(self.shape[0]),
+                                  self._leds)[key]
+        elif is_slice:
+            # Only evaluate the selected LEDs
+            return self._evaluate(steps, numpy.asarray(self._leds[rest]))
+        else:
+            intensity = self._evaluate(steps.ravel(), self._leds)
+            positions = numpy.arange(steps.size).reshape(steps.shape)
+            return intensity[(positions,) + rest]
+
+class WaveformIntensity(_LEDIntensity):
+    """
+    Intensity array calculated on access from one waveform per LED.
+
+    Parameters
+    ----------
+    n_steps : int
+        Number of steps.
+    waveforms : array
+        Object array of size (n_rows, n_cols, n_channels) with the
+        `Waveform` of each LED. The same waveform object can be used by
+        many LEDs, in which case it is evaluated once for all of them.
+
+    Attributes
+    ----------
+    waveforms : array
+        Object array of size (n_rows, n_cols, n_channels) with the
+        `Waveform` of each LED.
+
+    """
+    def __init__(self, n_steps, waveforms):
+        self.waveforms = numpy.array(waveforms, dtype=object)
+        if self.waveforms.ndim != 3:
+            raise ValueError("waveforms should be a 3D array")
+        super(WaveformIntensity, self).__init__(
+            (n_steps,) + self.waveforms.shape)
+
+    @classmethod
+    def from_array(cls, intensity):
+        """
+        Create a WaveformIntensity object from an intensity array.
+
+        LEDs with the same intensity at every step are represented by a
+        `Constant` waveform. Intensities of other LEDs are copied, a few
+        steps at a time, into a single array shared by their waveforms,
+        which look up the intensity of each step in it.
+
+        Parameters
+        ----------
+        intensity : array
+            Array of size (n_steps, n_rows, n_cols, n_channels) with light
+            intensity values, in µmol/(m^2*s).
+
+        Returns
+        -------
+        WaveformIntensity
+            New object with the same intensities.
+
+        """
+        n_steps = intensity.shape[0]
+        waveforms = numpy.empty(intensity.shape[1:], dtype=object)
+        if n_steps == 0:
+            waveforms.fill(Constant(0.))
+            return cls(n_steps, waveforms)
+        # Intensities of each LED, in one row per LED
+        n_leds = waveforms.size
+        samples = numpy.empty((n_leds, n_steps))
+        chunk_steps = max(65536//n_leds, 1)
+        for start in range(0, n_steps, chunk_steps):
+            chunk = numpy.asarray(intensity[start:start + chunk_steps],
+                                  dtype=float)
+            samples[:, start:start + len(chunk)] = chunk.reshape(-1, n_leds).T
+        constant = numpy.all(samples == samples[:, :1], axis=1)
+        waveforms_flat = waveforms.reshape(-1)
+        for led in range(n_leds):
+            if constant[led]:
+                waveforms_flat[led] = Constant(samples[led, 0])
+            else:
+                waveforms_flat[led] = _Samples(samples[led])
+        return cls(n_steps, waveforms)
+
+    def _evaluate(self, steps, leds):
+        # Get intensities of LEDs ``leds`` at each step in ``steps``, as an
+        # array of size ``(len(steps),) + leds.shape``
+        leds = numpy.asarray(leds)
+        waveforms = self.waveforms.ravel()[leds.ravel()]
+        intensity = numpy.empty((len(steps), leds.size))
+        t = numpy.asarray(steps, dtype=float)
+        # Evaluate each distinct waveform once
+        positions = collections.OrderedDict()
+        for position, waveform in enumerate(waveforms):
+            positions.setdefault(id(waveform), (waveform, []))[1].append(
+                position)
+        for waveform, waveform_positions in positions.values():
+            intensity[:, waveform_positions] = \
+                waveform.evaluate(t)[:, numpy.newaxis]
+        return intensity.reshape((len(steps),) + leds.shape)
+
+class RunLengthIntensity(_LEDIntensity):
+    """
+    Intensity array stored as runs of constant intensity per LED.
+
+    Each LED's intensity is described by the steps at which it changes,
+    and the intensity from each of these steps until the next one.
+    Values are found by binary search when accessed, and memory used is
+    proportional to the number of runs rather than the number of steps.
+
+    LEDs are numbered as in a flattened (n_rows, n_cols, n_channels)
+    array, i.e. LED ``(row*n_cols + col)*n_channels + channel``.
+
+    Unlike other virtual intensity arrays, modifying elements with
+    ``intensity[key] = value`` updates the runs of the LEDs written, and
+    does not calculate all values. In-place operators still create
+    `dense`.
+
+    Parameters
+    ----------
+    shape : tuple
+        Size of the array, (n_steps, n_rows, n_cols, n_channels).
+    run_leds : array
+        LED of each run.
+    run_steps : array
+        First step of each run. Every LED should have a run starting at
+        step zero.
+    run_values : array
+        Intensity of each run, in µmol/(m^2*s).
+
+    Attributes
+    ----------
+    run_leds, run_steps, run_values : array
+        LED, first step, and intensity of each run, sorted by LED and
+        step.
+
+    """
+    def __init__(self, shape, run_leds, run_steps, run_values):
+        super(RunLengthIntensity, self).__init__(shape)
+        run_leds = numpy.asarray(run_leds, dtype=numpy.int64)
+        run_steps = numpy.asarray(run_steps, dtype=numpy.int64)
+        # Sort runs by LED and step, and check that all LEDs start at zero
+        keys = run_leds*self.shape[0] + run_steps
+        order = numpy.argsort(keys, kind='stable')
+        self._keys = keys[order]
+        self.run_leds = run_leds[order]
+        self.run_steps = run_steps[order]
+        self.run_values = numpy.asarray(run_values, dtype=float)[order]
+        n_leds = self._leds.size
+        if not numpy.array_equal(
+                numpy.searchsorted(self._keys,
+                                   numpy.arange(n_leds)*self.shape[0]),
+                numpy.searchsorted(self._keys,
+                                   numpy.arange(n_leds)*self.shape[0],
+                                   side='right') - 1):
+            raise ValueError("every LED should have one run starting at step "
+                "zero")
+
+    @classmethod
+    def from_array(cls, intensity, chunk_steps=65536):
+        """
+        Create a RunLengthIntensity object from an intensity array.
+
+        Parameters
+        ----------
+        intensity : array
+            Array of size (n_steps, n_rows, n_cols, n_channels) with light
+            intensity values, in µmol/(m^2*s).
+        chunk_steps : int, optional
+            Number of steps processed at a time.
+
+        Returns
+        -------
+        RunLengthIntensity
+            New object with the same intensities.
+
+        """
+        n_steps = intensity.shape[0]
+        n_leds = int(numpy.prod(intensity.shape[1:]))
+        run_leds = []
+        run_steps = []
+        run_values = []
+        previous = None
+        for start in range(0, n_steps, chunk_steps):
+            chunk = numpy.asarray(intensity[start:start + chunk_steps],
+                                  dtype=float).reshape(-1, n_leds)
+            # Steps at which each LED changes, including the first step
+            if previous is None:
+                changed = numpy.ones(chunk.shape, dtype=bool)
+                changed[1:] = chunk[1:] != chunk[:-1]
+            else:
+                changed = chunk != numpy.concatenate([previous, chunk[:-1]])
+            steps, leds = numpy.nonzero(changed)
+            run_leds.append(leds)
+            run_steps.append(steps + start)
+            run_values.append(chunk[steps, leds])
+            previous = chunk[-1:]
+        if not run_leds:
+            return cls(intensity.shape, [], [], [])
+        return cls(intensity.shape,
+                   numpy.concatenate(run_leds),
+                   numpy.concatenate(run_steps),
+                   numpy.concatenate(run_values))
+
+    def _evaluate(self, steps, leds):
+        leds = numpy.asarray(leds)
+        steps = numpy.asarray(steps, dtype=numpy.int64)
+        led_keys = leds.ravel()*self.shape[0]
+        if len(steps) > 1 and numpy.all(numpy.diff(steps) == 1):
+            # Consecutive steps. Find the run of each LED at the first and
+            # last step. LEDs with the same run at both are filled with it.
+            # For the others, runs starting in between are written at their
+            # first step, and filled forward.
+            first = numpy.searchsorted(self._keys,
+                                       led_keys + steps[0],
+                                       side='right') - 1
+            last = numpy.searchsorted(self._keys,
+                                      led_keys + steps[-1],
+                                      side='right') - 1
+            runs = numpy.empty((len(steps), len(led_keys)), dtype=numpy.int64)
+            runs[:] = first
+            changed = numpy.flatnonzero(last != first)
+            if len(changed):
+                counts = last[changed] - first[changed]
+                offsets = numpy.cumsum(counts) - counts
+                new_runs = numpy.arange(counts.sum()) + \
+                    numpy.repeat(first[changed] + 1 - offsets, counts)
+                changed_runs = numpy.zeros((len(steps), len(changed)),
+                                           dtype=numpy.int64)
+                changed_runs[0] = first[changed]
+                changed_runs[self.run_steps[new_runs] - steps[0],
+                             numpy.repeat(numpy.arange(len(changed)),
+                                          counts)] = new_runs
+                numpy.maximum.accumulate(changed_runs,
+                                         axis=0,
+                                         out=changed_runs)
+                runs[:, changed] = changed_runs
+        else:
+            # Find the last run of each LED starting at or before each step
+            runs = numpy.searchsorted(self._keys,
+                                      steps[:, numpy.newaxis] + led_keys,
+                                      side='right') - 1
+        return self.run_values[runs].reshape((len(steps),) + leds.shape)
+
+    def __setitem__(self, key, value):
+        if self.dense is not None:
+            self.dense[key] = value
+            return
+        n_steps = self.shape[0]
+        # Find the step and LED of each element written
+        steps = numpy.broadcast_to(
+            numpy.arange(n_steps).reshape((-1,) + (1,)*(self.ndim - 1)),
+            self.shape)[key]
+        leds = numpy.broadcast_to(self._leds, self.shape)[key]
+        values = numpy.broadcast_to(numpy.asarray(value, dtype=float),
+                                    numpy.shape(steps))
+        keys = numpy.ravel(leds*n_steps + steps)
+        if not len(keys):
+            return
+        # Keep the last value written to each element, as numpy does
+        keys, last = numpy.unique(keys[::-1], return_index=True)
+        values = values.ravel()[::-1][last]
+        # Elements after the ones written keep their previous values, and
+        # start new runs unless they are also written
+        next_keys = numpy.setdiff1d(keys[keys % n_steps != n_steps - 1] + 1,
+                                    keys,
+                                    assume_unique=True)
+        next_values = self.run_values[numpy.searchsorted(self._keys,
+                                                         next_keys,
+                                                         side='right') - 1]
+        # Replace runs starting at any of these elements
+        keep = ~numpy.isin(self._keys, numpy.concatenate([keys, next_keys]))
+        keys = numpy.concatenate([self._keys[keep], keys, next_keys])
+        values = numpy.concatenate([self.run_values[keep],
+                                    values,
+                                    next_values])
+        order = numpy.argsort(keys, kind='stable')
+        keys = keys[order]
+        values = values[order]
+        # Merge runs with the same value as the previous run of their LED
+        run_leds = keys // n_steps
+        merged = numpy.zeros(len(keys), dtype=bool)
+        merged[1:] = (run_leds[1:] == run_leds[:-1]) & \
+            (values[1:] == values[:-1])
+        self._keys = keys[~merged]
+        self.run_leds = run_leds[~merged]
+        self.run_steps = self._keys % n_steps
+        self.run_values = values[~merged]
+
+    def get_runs(self, row, col, channel):
+        """
+        Get the runs of constant intensity of one LED.
+
+        Runs are found by binary search, such that the time taken depends
+        on the number of runs of the LED rather than the number of steps.
+
+        Parameters
+        ----------
+        row, col, channel : int
+            Position of the LED.
+
+        Returns
+        -------
+        step_start, step_stop : array
+            First step of each run, and step after its last one.
+        values : array
+            Intensity of each run, in µmol/(m^2*s).
 
         """
-        # If row is None, use all wells
-        if (row is None) or (col is None):
-            well = numpy.arange(self.n_rows*self.n_cols)
-        else:
-            # Transform (row, col) pair into well number
-            row = numpy.atleast_1d(row)
-            col = numpy.atleast_1d(col)
-            well = row*self.n_cols + col
-        # Get info for relevant wells
-        led_data = self.calibration_data.loc[well + 1]
-        # Get intensity at measured conditions
-        measured_dc = led_data['DC'].values.astype(float)
-        measured_gcal = led_data['GS Cal'].values.astype(float)
-        # Intensity units can be expressed as µmol/(m^2*s) or umol/m2/s
-        if 'Intensity (µmol/(m^2*s))' in led_data.columns:
-            measured_intensity = led_data['Intensity (µmol/(m^2*s))']\
-                .values.astype(float)
+        n_steps, n_rows, n_cols, n_channels = self.shape
+        led = self._leds[row, col, channel]
+        start, stop = numpy.searchsorted(self._keys,
+                                         [led*n_steps, (led + 1)*n_steps])
+        step_start = self.run_steps[start:stop]
+        step_stop = numpy.append(step_start[1:], n_steps)
+        return step_start, step_stop, self.run_values[start:stop]
+
+def compile_events(events,
+                   n_steps,
+                   n_rows=4,
+                   n_cols=6,
+                   n_channels=2,
+                   step_size=None,
+                   initial=0.,
+                   run_length=False):
+    """
+    Build an intensity array from a table of intensity change events.
+
+    Each event sets the intensity of one LED from one step onwards,
+    until the next event of the same LED. Events are sorted once by LED
+    and step, and intensities are then filled forward in time, without
+    iterating over events in Python.
+
+    Parameters
+    ----------
+    events : dict or DataFrame
+        Table with columns "row", "col", "channel" (the LED's position,
+        zero-indexed), "intensity" (in µmol/(m^2*s)), and either "step"
+        (step at which the intensity is set) or "time" (time in
+        milliseconds, converted to the step that contains it using
+        `step_size`). If several events set the same LED at the same
+        step, the last one in the table is used.
+    n_steps : int
+        Number of steps.
+    n_rows, n_cols, n_channels : int, optional
+        Dimensions of the LPA.
+    step_size : int, optional
+        Duration of each time step in milliseconds. Required if events
+        are specified by "time".
+    initial : float, optional
+        Intensity of each LED before its first event.
+    run_length : bool, optional
+        If True, return a `RunLengthIntensity` object instead of a full
+        array.
+
+    Returns
+    -------
+    array or RunLengthIntensity
+        Array of size (n_steps, n_rows, n_cols, n_channels) with light
+        intensity values.
+
+    Raises
+    ------
+    ValueError
+        If an event refers to an LED or step outside of the LPA.
+
+    """
+    # Get columns
+    if 'step' in events:
+        steps = numpy.asarray(events['step'], dtype=numpy.int64)
+    else:
+        if step_size is None:
+            raise ValueError("step_size is required to use event times")
+        steps = numpy.floor_divide(
+            numpy.asarray(events['time'], dtype=float),
+            step_size).astype(numpy.int64)
+    rows = numpy.asarray(events['row'], dtype=numpy.int64)
+    cols = numpy.asarray(events['col'], dtype=numpy.int64)
+    channels = numpy.asarray(events['channel'], dtype=numpy.int64)
+    values = numpy.asarray(events['intensity'], dtype=float)
+    # Check that events are within the LPA
+    for name, column, n in [('step', steps, n_steps),
+                            ('row', rows, n_rows),
+                            ('col', cols, n_cols),
+                            ('channel', channels, n_channels)]:
+        if len(column) and ((column.min() < 0) or (column.max() >= n)):
+            raise ValueError("event {} out of range".format(name))
+
+    n_leds = n_rows*n_cols*n_channels
+    shape = (n_steps, n_rows, n_cols, n_channels)
+    leds = (rows*n_cols + cols)*n_channels + channels
+    if run_length:
+        # Add a run at step zero with the initial intensity, which is
+        # replaced by any event at that step
+        leds = numpy.concatenate([numpy.arange(n_leds), leds])
+        steps = numpy.concatenate([numpy.zeros(n_leds, dtype=numpy.int64),
+                                   steps])
+        values = numpy.concatenate([numpy.full(n_leds, float(initial)),
+                                    values])
+
+    # Sort events by LED and step, keeping the table's order for ties, and
+    # keep the last event of each LED and step
+    keys = leds*n_steps + steps
+    n_events = len(keys)
+    if n_leds*n_steps*n_events < 2**62:
+        # Breaking ties with the event number allows for a faster,
+        # unstable sort
+        order = numpy.argsort(keys*n_events + numpy.arange(n_events))
+    else:
+        order = numpy.argsort(keys, kind='stable')
+    keys = keys[order]
+    last = numpy.ones(len(keys), dtype=bool)
+    last[:-1] = keys[1:] != keys[:-1]
+    order = order[last]
+    leds = leds[order]
+    steps = steps[order]
+    values = values[order]
+
+    if run_length:
+        # Remove events that don't change the intensity
+        changed = numpy.ones(len(leds), dtype=bool)
+        changed[1:] = (values[1:] != values[:-1]) | (leds[1:] != leds[:-1])
+        return RunLengthIntensity(shape,
+                                  leds[changed],
+                                  steps[changed],
+                                  values[changed])
+
+    # Write the number of each event at its step and LED, counting from
+    # one, and fill forward. Since events are sorted by LED and step, the
+    # most recent event of each LED has the highest number.
+    if len(values) < 2**31 - 1:
+        index_dtype = numpy.int32
+    else:
+        index_dtype = numpy.int64
+    index = numpy.zeros((n_steps, n_leds), dtype=index_dtype)
+    index[steps, leds] = numpy.arange(1, len(values) + 1)
+    numpy.maximum.accumulate(index, axis=0, out=index)
+    values = numpy.concatenate([[float(initial)], values])
+    return numpy.take(values, index).reshape(shape)
+
+class _FlatSteps(object):
+    # Two-dimensional (n_steps, n_leds) view of a virtual intensity array,
+    # used by ConversionEngine to access a few steps at a time.
+    def __init__(self, intensity):
+        self.intensity = intensity
+        self.shape = (intensity.shape[0], int(numpy.prod(intensity.shape[1:])))
+
+    def __getitem__(self, key):
+        return numpy.ascontiguousarray(self.intensity[key],
+                                       dtype=float).reshape(-1, self.shape[1])
+
+class _LazyGrayscale(object):
+    # Grayscale values of a virtual intensity array, converted by a
+    # ConversionEngine when accessed. Used as the grayscale array of a
+    # LazyIntensity object, to discretize intensities without creating the
+    # full array.
+    def __init__(self, engine, intensity, led_sets, dc, gcal):
+        self.engine = engine
+        self.intensity = intensity
+        self.led_sets = led_sets
+        self.dc = numpy.array(dc)
+        self.gcal = numpy.array(gcal)
+        self.shape = intensity.shape
+
+    def __getitem__(self, key):
+        # All LEDs of the selected steps are converted
+        steps, rest, is_slice = _split_step_key(key, self.shape[0])
+        if steps is None:
+            steps = numpy.arange(self.shape[0])
+            rest = None
+        # Steps in error messages are exact for consecutive steps only
+        step_offset = steps.min() if steps.size else 0
+        gs = self.engine._convert(self.intensity[steps.ravel()],
+                                  self.led_sets,
+                                  self.dc,
+                                  self.gcal,
+                                  step_offset=step_offset)
+        if rest is None:
+            return gs[key]
+        elif is_slice:
+            return gs[(slice(None),) + rest]
         else:
-            measured_intensity = led_data['Intensity (umol/m2/s)']\
-                .values.astype(float)
-        # Convert intensity input to array
-        intensity = numpy.array(intensity)
-        # Convert gcal to arrays, or use measured calibration values
-        if gcal is not None:
-            gcal = numpy.array(gcal)
+            positions = numpy.arange(steps.size).reshape(steps.shape)
+            return gs[(positions,) + rest]
+
+class ConversionEngine(object):
+    """
+    Object that converts light intensities of an LPA to grayscale values.
+
+    Grayscale values are obtained from intensities by multiplying them by
+    a per-LED factor that depends on the LED set calibration data and the
+    dc and gcal values (see `LEDSet.get_grayscale_factor()`), and rounding
+    the result. This object combines all factors into a single array, and
+    converts intensities a few time steps at a time into a preallocated
+    grayscale array. This keeps temporary arrays small and avoids
+    allocating one float array per step and channel.
+
+    Long programs can be converted in parallel by setting `n_workers`. The
+    step axis is then split into ranges of whole chunks that are
+    processed in a thread pool, and results are written into the same
+    output array. NumPy releases the GIL during the calculations, so
+    several threads can run at the same time. Results do not depend on
+    the number of workers.
+
+    Results are identical to the ones obtained with
+    `LEDSet.get_grayscale()`. Because the combined factor can differ from
+    the full calculation in the last bits, the few values that are close
+    to a rounding boundary are recalculated with the full expression.
+
+    Properties
+    ----------
+    chunk_steps : int, optional
+        Number of time steps to convert at a time. If None, use as many
+        steps as fit in ``chunk_bytes`` bytes of float values.
+    n_workers : int, optional
+        Number of threads used for conversion. If None, use one thread
+        per CPU.
+
+    Attributes
+    ----------
+    chunk_steps : int or None
+        Number of time steps to convert at a time. If None, use as many
+        steps as fit in ``chunk_bytes`` bytes of float values.
+    chunk_bytes : int
+        Approximate size of temporary arrays, in bytes, if `chunk_steps` is
+        None.
+    n_workers : int or None
+        Number of threads used for conversion. If None, use one thread
+        per CPU.
+
+    """
+    # Values whose unrounded grayscale value is closer than this to a
+    # rounding boundary are recalculated with the full expression.
+    tie_tolerance = 1e-8
+
+    def __init__(self, chunk_steps=None, n_workers=1):
+        self.chunk_steps = chunk_steps
+        self.chunk_bytes = 2**18
+        self.n_workers = n_workers
+
+    def get_chunk_steps(self, n_values_per_step):
+        """
+        Get the number of time steps to convert at a time.
+
+        Parameters
+        ----------
+        n_values_per_step : int
+            Number of values in one time step.
+
+        Returns
+        -------
+        int
+            Number of time steps.
+
+        """
+        if self.chunk_steps is not None:
+            return max(int(self.chunk_steps), 1)
+        return max(self.chunk_bytes//(8*max(n_values_per_step, 1)), 1)
+
+    def _get_led_parameters(self, led_sets, dc, gcal):
+        # Calibration values of each LED, ordered as in a flattened
+        # (n_rows, n_cols, n_channels) array. LEDs of channels without an
+        # LEDSet are marked as missing, and get a factor of zero.
+        n_rows, n_cols, n_channels = dc.shape
+        params = {}
+        for name in ['measured_intensity', 'measured_dc', 'measured_gcal']:
+            params[name] = numpy.ones((n_rows, n_cols, n_channels))
+        params['dc'] = numpy.array(dc, dtype=float)
+        params['gcal'] = numpy.array(gcal, dtype=float)
+        params['factor'] = numpy.zeros((n_rows, n_cols, n_channels))
+        params['missing'] = numpy.zeros((n_rows, n_cols, n_channels),
+                                        dtype=bool)
+        for channel, led_set in enumerate(led_sets):
+            if led_set is None:
+                params['missing'][:, :, channel] = True
+                continue
+            for name in ['measured_intensity', 'measured_dc', 'measured_gcal']:
+                params[name][:, :, channel] = getattr(led_set, name).reshape(
+                    n_rows, n_cols)
+            params['factor'][:, :, channel] = led_set.get_grayscale_factor(
+                dc=dc[:, :, channel].flatten(),
+                gcal=gcal[:, :, channel].flatten()).reshape(n_rows, n_cols)
+        return dict((name, value.flatten()) for name, value in params.items())
+
+    def get_factors(self, led_sets, dc, gcal):
+        """
+        Get the grayscale value per unit of intensity of each LED.
+
+        Parameters
+        ----------
+        led_sets : list
+            LEDSet objects for each channel. Channels with an LEDSet of
+            None are assigned a factor of zero.
+        dc : array
+            Array of size (n_rows, n_cols, n_channels) with dot correction
+            values.
+        gcal : array
+            Array of size (n_rows, n_cols, n_channels) with grayscale
+            calibration values.
+
+        Returns
+        -------
+        array
+            Array of size (n_rows, n_cols, n_channels) with grayscale
+            factors.
+
+        """
+        params = self._get_led_parameters(led_sets, dc, gcal)
+        return params['factor'].reshape(dc.shape)
+
+    def _prepare(self, intensity, led_sets, dc, gcal):
+        # Get the arguments of _convert_steps() that don't depend on the
+        # range of steps being converted.
+        n_steps = intensity.shape[0]
+        n_channels = intensity.shape[3]
+        params = self._get_led_parameters(led_sets, dc, gcal)
+        n_leds = len(params['factor'])
+        if isinstance(intensity, VirtualIntensity):
+            # Values are calculated when each chunk is accessed
+            intensity_2d = _FlatSteps(intensity)
         else:
-            gcal = measured_gcal
-        # Calculate dc value
-        # We calculate the dot correction value required to achieve the desired
-        # intensity with 4095 grayscale, and then round up.
-        dc = measured_dc * (intensity/measured_intensity) * \
-                           (measured_gcal/gcal)
-        dc = numpy.ceil(dc).astype(numpy.uint16)
-        # Saturate
-        dc = numpy.maximum(dc, min_dc)
-        # Make uniform if necessary
-        if uniform:
-            dc.fill(numpy.max(dc))
-        # Verify that the dc values are feasible
-        if numpy.any(dc > 63):
-            raise ValueError("not possible to generate requested intensity")
+            intensity_2d = numpy.ascontiguousarray(
+                intensity.reshape(n_steps, n_leds),
+                dtype=float)
+        chunk_steps = min(self.get_chunk_steps(n_leds), max(n_steps, 1))
+        return {'intensity_2d': intensity_2d,
+                'chunk_steps': chunk_steps,
+                'params': params,
+                'n_channels': n_channels}
+
+    def _convert_steps(self,
+                       intensity_2d,
+                       out_2d,
+                       out_start,
+                       range_start,
+                       range_stop,
+                       chunk_steps,
+                       params,
+                       n_channels,
+                       step_offset=0):
+        # Convert steps ``range_start`` to ``range_stop`` of a
+        # (n_steps, n_leds) intensity array, writing the grayscale values
+        # in ``out_2d``, whose first row corresponds to step ``out_start``.
+        # ``step_offset`` is added to step numbers in error messages.
+        n_leds = out_2d.shape[1]
+        # Preallocate temporary arrays for one chunk
+        gs_buffer = numpy.empty(chunk_steps*n_leds)
+        rounded_buffer = numpy.empty(chunk_steps*n_leds)
+        mask_buffer = numpy.empty(chunk_steps*n_leds, dtype=bool)
+        error_buffer = numpy.empty(chunk_steps*n_leds, dtype=bool)
+        channels = numpy.arange(n_leds) % n_channels
+        # Factors are repeated for every step in a chunk, so that they can
+        # be multiplied with intensities without broadcasting.
+        factor_buffer = numpy.tile(params['factor'], chunk_steps)
+
+        for start in range(range_start, range_stop, chunk_steps):
+            stop = min(start + chunk_steps, range_stop)
+            intensity_chunk = intensity_2d[start:stop]
+            # Views of temporary arrays with the current size
+            shape = (stop - start, n_leds)
+            size = shape[0]*shape[1]
+            gs = gs_buffer[:size].reshape(shape)
+            rounded = rounded_buffer[:size].reshape(shape)
+            mask = mask_buffer[:size].reshape(shape)
+            error = error_buffer[:size].reshape(shape)
+            factor = factor_buffer[:size].reshape(shape)
+            # Unrounded and rounded grayscale values
+            numpy.multiply(intensity_chunk, factor, out=gs)
+            numpy.rint(gs, out=rounded)
+            # Find values close to a rounding boundary, and recalculate them
+            # as in LEDSet.get_grayscale()
+            numpy.subtract(gs, rounded, out=gs)
+            numpy.absolute(gs, out=gs)
+            numpy.subtract(gs, 0.5, out=gs)
+            numpy.absolute(gs, out=gs)
+            numpy.less(gs, self.tie_tolerance, out=mask)
+            if numpy.any(mask):
+                steps, cols = numpy.nonzero(mask)
+                exact = 4095. * (intensity_chunk[steps, cols]/
+                                 params['measured_intensity'][cols]) * \
+                                (params['measured_dc'][cols]/
+                                 params['dc'][cols]) * \
+                                (params['measured_gcal'][cols]/
+                                 params['gcal'][cols])
+                rounded[steps, cols] = numpy.rint(exact)
+                instrumentation.count('ConversionEngine.ties', len(exact))
+            rounded[:, params['missing']] = 0
+            # Check that all values can be generated
+            numpy.greater(rounded, 4095, out=error)
+            numpy.less(rounded, 0, out=mask)
+            numpy.logical_or(error, mask, out=error)
+            if numpy.any(error):
+                steps, cols = numpy.nonzero(error)
+                step = steps[0]
+                channel = channels[cols[steps == step]].min()
+                raise ValueError("step {}, channel {}: ".format(
+                    start + step + step_offset,
+                    channel) + "not possible to generate requested " + \
+                    "intensity with provided dc value. ")
+            # Write grayscale values of all LEDs
+            numpy.copyto(out_2d[start - out_start:stop - out_start],
+                         rounded,
+                         casting='unsafe')
+
+    def _map_steps(self, function, first_step, last_step, chunk_steps):
+        # Call ``function(start, stop)`` for consecutive ranges of steps
+        # covering steps ``first_step`` to ``last_step``. If n_workers is
+        # greater than one, ranges are processed in a thread pool. Ranges
+        # are multiples of ``chunk_steps`` long, so results do not depend on
+        # the number of workers. Returns a list with the results of each
+        # range. If calls raise exceptions, the one from the earliest range
+        # is raised.
+        n_workers = self.n_workers
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        n_chunks = -(-(last_step - first_step)//chunk_steps)
+        if n_workers <= 1 or n_chunks <= 1:
+            return [function(first_step, last_step)]
+        # Several ranges per worker allow for some load balancing
+        range_steps = -(-n_chunks//(4*n_workers))*chunk_steps
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(function,
+                                       start,
+                                       min(start + range_steps, last_step))
+                       for start in range(first_step, last_step, range_steps)]
+            try:
+                return [future.result() for future in futures]
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    @_instrumented('ConversionEngine.get_grayscale')
+    def get_grayscale(self, intensity, led_sets, dc, gcal, out=None):
+        """
+        Convert intensities to grayscale values.
 
-        return dc
+        If `intensity` is a `PeriodicIntensity` object, the steps of its
+        prefix, cycle, and suffix are converted only once. If `intensity`
+        is a `RunLengthIntensity` object, each run of constant intensity
+        is converted once.
+
+        Parameters
+        ----------
+        intensity : array
+            Array of size (n_steps, n_rows, n_cols, n_channels) with light
+            intensity values, in µmol/(m^2*s).
+        led_sets : list
+            LEDSet objects for each channel. Grayscale values of channels
+            with an LEDSet of None are set to zero.
+        dc : array
+            Array of size (n_rows, n_cols, n_channels) with dot correction
+            values.
+        gcal : array
+            Array of size (n_rows, n_cols, n_channels) with grayscale
+            calibration values.
+        out : array, optional
+            C-contiguous array of size (n_steps, n_rows, n_cols,
+            n_channels) in which to write the grayscale values. If None, a
+            new uint16 array is created.
+
+        Returns
+        -------
+        array
+            Array of size (n_steps, n_rows, n_cols, n_channels) with
+            grayscale values.
+
+        Raises
+        ------
+        ValueError
+            If an intensity value cannot be generated with the provided dc
+            and gcal values. The message starts with the first step and
+            channel in which this happens.
+
+        """
+        if out is None:
+            out = numpy.empty(intensity.shape, dtype=numpy.uint16)
+        elif not out.flags['C_CONTIGUOUS']:
+            raise ValueError("out should be a C-contiguous array")
+        if isinstance(intensity, PeriodicIntensity) and \
+                intensity.dense is None:
+            # Convert each distinct part once, and repeat the results
+            for steps, first_step, n_repeats in intensity.segments:
+                gs = self._convert(steps,
+                                   led_sets,
+                                   dc,
+                                   gcal,
+                                   step_offset=first_step)
+                out_segment = out[first_step:
+                                  first_step + n_repeats*len(steps)]
+                out_segment.reshape((n_repeats,) + gs.shape)[...] = gs
+            return out
+        if isinstance(intensity, RunLengthIntensity) and \
+                intensity.dense is None:
+            # Convert each run once, and expand the results
+            gs = self._convert_runs(intensity, led_sets, dc, gcal)
+            chunk_steps = self.get_chunk_steps(
+                int(numpy.prod(gs.shape[1:])))
+            for start in range(0, len(out), chunk_steps):
+                out[start:start + chunk_steps] = \
+                    gs[start:start + chunk_steps]
+            return out
+
+        return self._convert(intensity, led_sets, dc, gcal, out=out)
+
+    def _convert(self, intensity, led_sets, dc, gcal, out=None, step_offset=0):
+        # Convert all steps of an intensity array, as in get_grayscale().
+        # ``step_offset`` is added to step numbers in error messages.
+        if out is None:
+            out = numpy.empty(intensity.shape, dtype=numpy.uint16)
+        conversion = self._prepare(intensity, led_sets, dc, gcal)
+        self._map_steps(
+            lambda start, stop: self._convert_steps(
+                out_2d=out.reshape(conversion['intensity_2d'].shape),
+                out_start=0,
+                range_start=start,
+                range_stop=stop,
+                step_offset=step_offset,
+                **conversion),
+            0,
+            intensity.shape[0],
+            conversion['chunk_steps'])
+        instrumentation.count('ConversionEngine.values', intensity.size)
+
+        return out
+
+    def iter_grayscale(self, intensity, led_sets, dc, gcal, block_steps=None):
+        """
+        Convert intensities to grayscale values, in blocks of time steps.
+
+        This allows grayscale values to be used, for example written to a
+        file, while later steps are still being converted. Each block is
+        converted as in `get_grayscale()`.
+
+        If `intensity` is a `PeriodicIntensity` object, the steps of its
+        prefix, cycle, and suffix are converted once before yielding any
+        block. Blocks are then the prefix, the suffix, and groups of
+        repeated cycles about `block_steps` long. The same array is
+        yielded for every group of cycles, and should not be modified.
+        If `intensity` is a `RunLengthIntensity` object, each run of
+        constant intensity is converted once before yielding any block.
+
+        Parameters
+        ----------
+        intensity : array
+            Array of size (n_steps, n_rows, n_cols, n_channels) with light
+            intensity values, in µmol/(m^2*s).
+        led_sets : list
+            LEDSet objects for each channel. Grayscale values of channels
+            with an LEDSet of None are set to zero.
+        dc : array
+            Array of size (n_rows, n_cols, n_channels) with dot correction
+            values.
+        gcal : array
+            Array of size (n_rows, n_cols, n_channels) with grayscale
+            calibration values.
+        block_steps : int, optional
+            Number of time steps in each block. If None, use 16 times the
+            number of steps converted at a time.
+
+        Yields
+        ------
+        start : int
+            Number of the first step in the block.
+        gs : array
+            Array of size (block_steps, n_rows, n_cols, n_channels) with
+            grayscale values as unsigned 16-bit integers. The last block
+            may be shorter.
+
+        Raises
+        ------
+        ValueError
+            If an intensity value cannot be generated with the provided dc
+            and gcal values. The message starts with the first step and
+            channel in which this happens. Blocks before this step are
+            yielded before raising.
+
+        """
+        if isinstance(intensity, PeriodicIntensity) and \
+                intensity.dense is None:
+            for block in self._iter_periodic_grayscale(intensity,
+                                                       led_sets,
+                                                       dc,
+                                                       gcal,
+                                                       block_steps):
+                yield block
+            return
+        if isinstance(intensity, RunLengthIntensity) and \
+                intensity.dense is None:
+            # Convert each run once, and expand the results of each block.
+            # If a value cannot be generated, steps are converted in order
+            # below, so that blocks before the error are yielded.
+            try:
+                gs = self._convert_runs(intensity, led_sets, dc, gcal)
+            except ValueError:
+                gs = None
+            if gs is not None:
+                if block_steps is None:
+                    block_steps = 16*self.get_chunk_steps(
+                        int(numpy.prod(gs.shape[1:])))
+                for start in range(0, len(gs), block_steps):
+                    yield start, gs[start:start + block_steps].astype(
+                        numpy.uint16)
+                return
+
+        n_steps = intensity.shape[0]
+        conversion = self._prepare(intensity, led_sets, dc, gcal)
+        if block_steps is None:
+            block_steps = 16*conversion['chunk_steps']
+        for block_start in range(0, n_steps, block_steps):
+            block_stop = min(block_start + block_steps, n_steps)
+            out = numpy.empty((block_stop - block_start,) + intensity.shape[1:],
+                              dtype=numpy.uint16)
+            with instrumentation.stage('ConversionEngine.iter_grayscale'):
+                self._map_steps(
+                    lambda start, stop: self._convert_steps(
+                        out_2d=out.reshape(block_stop - block_start, -1),
+                        out_start=block_start,
+                        range_start=start,
+                        range_stop=stop,
+                        **conversion),
+                    block_start,
+                    block_stop,
+                    conversion['chunk_steps'])
+            instrumentation.count('ConversionEngine.values', out.size)
+            yield block_start, out
+
+    def _iter_periodic_grayscale(self,
+                                 intensity,
+                                 led_sets,
+                                 dc,
+                                 gcal,
+                                 block_steps):
+        # Yield blocks of grayscale values of a PeriodicIntensity object, as
+        # in iter_grayscale(), converting each distinct part only once
+        if block_steps is None:
+            block_steps = 16*self.get_chunk_steps(
+                int(numpy.prod(intensity.shape[1:])))
+        segments = []
+        with instrumentation.stage('ConversionEngine.iter_grayscale'):
+            for steps, first_step, n_repeats in intensity.segments:
+                gs = self._convert(steps,
+                                   led_sets,
+                                   dc,
+                                   gcal,
+                                   step_offset=first_step)
+                segments.append((gs, first_step, n_repeats))
+        for gs, first_step, n_repeats in segments:
+            # Group repetitions into blocks of about block_steps steps
+            repeats_per_block = min(max(block_steps//len(gs), 1), n_repeats)
+            block = numpy.tile(gs, (repeats_per_block, 1, 1, 1))
+            for repeat in range(0, n_repeats, repeats_per_block):
+                n_block_repeats = min(repeats_per_block, n_repeats - repeat)
+                yield (first_step + repeat*len(gs),
+                       block[:n_block_repeats*len(gs)])
+
+    def discretize_intensity(self,
+                             intensity,
+                             led_sets,
+                             dc,
+                             gcal,
+                             method='round'):
+        """
+        Discretize intensity values.
+
+        Intensities are converted to grayscale values, and then back to
+        intensities with `LEDSet.get_intensity()`.
+
+        With ``method='round'``, grayscale values are obtained with
+        `get_grayscale()`, by rounding each step independently. If
+        `intensity` is a `PeriodicIntensity` object, its prefix, cycle,
+        and suffix are discretized, and a new `PeriodicIntensity` object
+        is returned. If `intensity` is a `RunLengthIntensity` object, the
+        intensity of each run is discretized, and a new
+        `RunLengthIntensity` object is returned. If `intensity` is a
+        `WaveformIntensity` object, all steps are converted a block at a
+        time to check that they can be generated, and a `LazyIntensity`
+        object is returned, which converts steps again when they are
+        accessed. None of these create an array with all steps.
+
+        With ``method='error_diffusion'``, the rounding error of each LED
+        is carried over to its next step. Grayscale values are the
+        differences between consecutive rounded values of the cumulative
+        unrounded grayscale value, such that the cumulative light dose of
+        each LED never differs from the requested one by more than half a
+        grayscale unit, however long the program is. Steps are processed
+        a few at a time, and all LEDs at once. The result is always a
+        regular array.
+
+        Parameters
+        ----------
+        intensity : array
+            Array of size (n_steps, n_rows, n_cols, n_channels) with light
+            intensity values, in µmol/(m^2*s).
+        led_sets : list
+            LEDSet objects for each channel. Intensities of channels with
+            an LEDSet of None are set to zero.
+        dc : array
+            Array of size (n_rows, n_cols, n_channels) with dot correction
+            values.
+        gcal : array
+            Array of size (n_rows, n_cols, n_channels) with grayscale
+            calibration values.
+        method : {'round', 'error_diffusion'}, optional
+            Discretization method.
+
+        Returns
+        -------
+        array, PeriodicIntensity, RunLengthIntensity, or LazyIntensity
+            Array of size (n_steps, n_rows, n_cols, n_channels) with
+            discretized intensity values.
+
+        Raises
+        ------
+        ValueError
+            If an intensity value cannot be generated with the provided dc
+            and gcal values. The message starts with the first step and
+            channel in which this happens.
+
+        """
+        if method == 'error_diffusion':
+            if len(intensity) == 0:
+                return numpy.zeros(intensity.shape)
+            gs = self._diffuse(intensity, led_sets, dc, gcal)
+            return self._lookup_intensity(gs, led_sets, dc, gcal)
+        elif method != 'round':
+            raise ValueError("discretization method {} not recognized".format(
+                method))
+
+        if isinstance(intensity, PeriodicIntensity) and \
+                intensity.dense is None:
+            # Discretize each part, in order. The cycle is not used if it is
+            # not repeated.
+            n_prefix = len(intensity.prefix)
+            prefix = self._discretize(intensity.prefix, led_sets, dc, gcal)
+            if intensity.n_repeats:
+                cycle = self._discretize(intensity.cycle,
+                                         led_sets,
+                                         dc,
+                                         gcal,
+                                         step_offset=n_prefix)
+            else:
+                cycle = intensity.cycle
+            suffix = self._discretize(
+                intensity.suffix,
+                led_sets,
+                dc,
+                gcal,
+                step_offset=n_prefix + intensity.n_repeats*len(cycle))
+            return PeriodicIntensity(cycle=cycle,
+                                     n_repeats=intensity.n_repeats,
+                                     prefix=prefix,
+                                     suffix=suffix)
+        if isinstance(intensity, RunLengthIntensity) and \
+                intensity.dense is None:
+            # Look up the intensity of each run's grayscale value
+            gs = self._convert_runs(intensity, led_sets, dc, gcal)
+            n_channels = intensity.shape[3]
+            wells = gs.run_leds//n_channels
+            channels = gs.run_leds % n_channels
+            values = numpy.zeros(len(gs.run_values))
+            for channel, lut in enumerate(self._get_luts(led_sets, dc, gcal)):
+                if lut is not None:
+                    mask = channels == channel
+                    values[mask] = lut[wells[mask],
+                                       gs.run_values[mask].astype(int)]
+            return RunLengthIntensity(intensity.shape,
+                                      gs.run_leds,
+                                      gs.run_steps,
+                                      values)
+        if isinstance(intensity, WaveformIntensity) and \
+                intensity.dense is None:
+            # Keep a copy of the waveform array, which can be modified
+            intensity = WaveformIntensity(intensity.shape[0],
+                                          intensity.waveforms)
+            for start, gs in self.iter_grayscale(intensity,
+                                                 led_sets,
+                                                 dc,
+                                                 gcal):
+                pass
+            return LazyIntensity(
+                grayscale=_LazyGrayscale(self, intensity, led_sets, dc, gcal),
+                led_sets=led_sets,
+                dc=dc,
+                gcal=gcal)
+
+        return self._discretize(intensity, led_sets, dc, gcal)
+
+    def _discretize(self, intensity, led_sets, dc, gcal, step_offset=0):
+        # Discretize all steps of an intensity array, as in
+        # discretize_intensity(). ``step_offset`` is added to step numbers in
+        # error messages.
+        if len(intensity) == 0:
+            return numpy.zeros(intensity.shape)
+        gs = self._convert(intensity,
+                           led_sets,
+                           dc,
+                           gcal,
+                           step_offset=step_offset)
+        return self._lookup_intensity(gs, led_sets, dc, gcal)
+
+    @_instrumented('ConversionEngine.diffuse')
+    def _diffuse(self, intensity, led_sets, dc, gcal):
+        # Convert intensities to grayscale values, carrying the rounding
+        # error of each LED over to its next step. Returns an array of size
+        # (n_steps, n_rows, n_cols, n_channels).
+        n_steps = intensity.shape[0]
+        n_channels = intensity.shape[3]
+        params = self._get_led_parameters(led_sets, dc, gcal)
+        n_leds = len(params['factor'])
+        if isinstance(intensity, VirtualIntensity):
+            intensity_2d = _FlatSteps(intensity)
+        else:
+            intensity_2d = intensity.reshape(n_steps, n_leds)
+        chunk_steps = min(self.get_chunk_steps(n_leds), n_steps)
+        out = numpy.empty(intensity.shape, dtype=numpy.uint16)
+        out_2d = out.reshape(n_steps, n_leds)
+        # Difference between the cumulative unrounded and rounded grayscale
+        # values of each LED, at the end of the last chunk
+        residual = numpy.zeros(n_leds)
+        for start in range(0, n_steps, chunk_steps):
+            stop = min(start + chunk_steps, n_steps)
+            gs = numpy.asarray(intensity_2d[start:stop], dtype=float) * \
+                params['factor']
+            gs[:, params['missing']] = 0
+            rounded = numpy.rint(gs)
+            # Check that all values can be generated
+            error = (rounded > 4095) | (rounded < 0)
+            if numpy.any(error):
+                steps, leds = numpy.nonzero(error)
+                step = steps[0]
+                channel = (leds[steps == step] % n_channels).min()
+                raise ValueError("step {}, channel {}: ".format(
+                    start + step,
+                    channel) + "not possible to generate requested " + \
+                    "intensity with provided dc value. ")
+            # Values close to an integer are taken as exact, so that
+            # constant intensities don't accumulate errors in the last bits
+            exact = numpy.abs(gs - rounded) < self.tie_tolerance
+            gs[exact] = rounded[exact]
+            # Values within rounding distance of the limits are clipped, so
+            # that differences of rounded cumulative values stay in range
+            numpy.clip(gs, 0, 4095, out=gs)
+            cumulative = numpy.cumsum(gs, axis=0)
+            cumulative += residual
+            # Round half up, so that adding an integer to a cumulative value
+            # increases its rounded value by the same integer
+            rounded = numpy.floor(cumulative + 0.5)
+            out_2d[start] = rounded[0]
+            out_2d[start + 1:stop] = numpy.diff(rounded, axis=0)
+            residual = cumulative[-1] - rounded[-1]
+        instrumentation.count('ConversionEngine.values', intensity.size)
+        return out
+
+    def _lookup_intensity(self, gs, led_sets, dc, gcal):
+        # Get the intensities of an array of grayscale values of size
+        # (n_steps, n_rows, n_cols, n_channels)
+        n_steps, n_rows, n_cols, n_channels = gs.shape
+        discretized = numpy.zeros(gs.shape)
+        luts = self._get_luts(led_sets, dc, gcal)
+        # Position of each well's table in a flattened lookup table
+        offsets = numpy.arange(n_rows*n_cols)*4096
+
+        def lookup(start, stop):
+            for channel, lut in enumerate(luts):
+                if lut is not None:
+                    gs_ch = gs[start:stop, :, :, channel].reshape(
+                        stop - start, -1)
+                    discretized[start:stop, :, :, channel] = numpy.take(
+                        lut.ravel(),
+                        gs_ch + offsets).reshape(stop - start, n_rows, n_cols)
+
+        self._map_steps(lookup,
+                        0,
+                        n_steps,
+                        self.get_chunk_steps(gs[0].size))
+        return discretized
+
+    def _get_luts(self, led_sets, dc, gcal):
+        # Intensities are obtained from lookup tables, which are built here
+        # to avoid modifying the LEDSets' caches from several threads.
+        return [None if led_set is None else
+                led_set.get_lut(dc=dc[:, :, channel].flatten(),
+                                gcal=gcal[:, :, channel].flatten())
+                for channel, led_set in enumerate(led_sets)]
+
+    def _convert_runs(self, intensity, led_sets, dc, gcal):
+        # Convert the intensity of each run of a RunLengthIntensity object
+        # to grayscale, with the same results as _convert_steps(). Returns a
+        # RunLengthIntensity object with the grayscale value of each run.
+        n_channels = intensity.shape[3]
+        params = self._get_led_parameters(led_sets, dc, gcal)
+        leds = intensity.run_leds
+        values = intensity.run_values
+        gs = values*params['factor'][leds]
+        rounded = numpy.rint(gs)
+        # Find values close to a rounding boundary, and recalculate them as
+        # in LEDSet.get_grayscale()
+        ties = numpy.abs(numpy.abs(gs - rounded) - 0.5) < self.tie_tolerance
+        if numpy.any(ties):
+            tie_leds = leds[ties]
+            exact = 4095. * (values[ties]/
+                             params['measured_intensity'][tie_leds]) * \
+                            (params['measured_dc'][tie_leds]/
+                             params['dc'][tie_leds]) * \
+                            (params['measured_gcal'][tie_leds]/
+                             params['gcal'][tie_leds])
+            rounded[ties] = numpy.rint(exact)
+            instrumentation.count('ConversionEngine.ties', len(exact))
+        rounded[params['missing'][leds]] = 0
+        # Check that all values can be generated. The first infeasible step
+        # is the start of a run.
+        error = (rounded > 4095) | (rounded < 0)
+        if numpy.any(error):
+            step = intensity.run_steps[error].min()
+            channel = (leds[error & (intensity.run_steps == step)] %
+                       n_channels).min()
+            raise ValueError("step {}, channel {}: ".format(step, channel) +
+                "not possible to generate requested intensity with " +
+                "provided dc value. ")
+        instrumentation.count('ConversionEngine.values', len(values))
+        return RunLengthIntensity(intensity.shape,
+                                  leds,
+                                  intensity.run_steps,
+                                  rounded)
 
 class LPA(object):
     """
@@ -538,6 +4316,11 @@ class LPA(object):
     file named ``LED_LAYOUT_FILENAME`` contained in
     ``LED_CALIBRATION_PATH``.
 
+    A `CalibrationRepository` can be specified to read calibration data
+    from a different folder, and to cache loaded LED sets across LPA
+    objects. A `SharedCalibration` object can be used instead to read
+    calibration data from shared memory.
+
     Note that intensity calculations with dot correction values different
     from the ones specified in the calibration data files are only
     approximate, and therefore it is recommended to maintain the original
@@ -562,6 +4345,13 @@ class LPA(object):
         LED set names for each channel.
     layout_names : list, optional
         Layout names for each channel.
+    calibration : CalibrationRepository or SharedCalibration, optional
+        Source of LED set calibration data. If None, calibration data is
+        read from files in ``LED_CALIBRATION_PATH`` every time LED sets
+        are loaded.
+    engine : ConversionEngine, optional
+        Object used to convert intensities to grayscale values. If None,
+        a ConversionEngine with default settings is created.
 
     Attributes
     ----------
@@ -576,6 +4366,12 @@ class LPA(object):
         Number of cols in the LPA.
     n_channels : int
         Number of channels (LEDs per well) in the LPA.
+    calibration : CalibrationRepository, SharedCalibration, or None
+        Source of LED set calibration data. If None, calibration data is
+        read from files in ``LED_CALIBRATION_PATH`` every time LED sets
+        are loaded.
+    engine : ConversionEngine
+        Object used to convert intensities to grayscale values.
     dc_lock : bool, optional
         Whether to allow direct modification of dot correction values. If
         True, the `dc` attribute cannot be directly modified, and functions
@@ -603,11 +4399,21 @@ class LPA(object):
                  n_channels=2,
                  dc_lock=True,
                  led_set_names=None,
-                 layout_names=None):
+                 layout_names=None,
+                 calibration=None,
+                 engine=None):
 
         # Store name
         self.name = name
 
+        # Source of calibration data
+        self.calibration = calibration
+
+        # Object used to convert intensities to grayscale values
+        if engine is None:
+            engine = ConversionEngine()
+        self.engine = engine
+
         # Store dimensions
         self.n_rows = n_rows
         self.n_cols = n_cols
@@ -629,6 +4435,12 @@ class LPA(object):
                                  self.n_cols,
                                  self.n_channels), dtype=int)*255
         # Intensity is a 4D array with dimensions [step, row, col, channel]
+        self._intensity = None
+        self._intensity_version = 0
+        self._dose_index = None
+        self._dose_index_version = None
+        # Steps per chunk used to index change points, if enabled
+        self._change_points_chunk_steps = None
         self.intensity = numpy.zeros((1,
                                       self.n_rows,
                                       self.n_cols,
@@ -639,6 +4451,32 @@ class LPA(object):
         if (layout_names is not None) or (led_set_names is not None):
             self.load_led_sets(led_set_names, layout_names)
 
+    @property
+    def intensity(self):
+        """
+        Light intensity values, in µmol/(m^2*s).
+
+        `intensity` is a (n_steps, n_rows, n_cols, n_channels)-sized array.
+        It can also be a `VirtualIntensity` object, for example after
+        calling ``load_lpf(file_name, lazy=True)``, in which case values
+        are calculated when accessed. Once any value is modified, the
+        virtual intensity array is replaced by a regular array, except for
+        `RunLengthIntensity` objects, which update their runs. Programs
+        that repeat a cycle of steps can be specified by setting
+        `intensity` to a `PeriodicIntensity` object, and programs made of
+        waveforms with `set_waveform()`.
+
+        """
+        if isinstance(self._intensity, VirtualIntensity) and \
+                self._intensity.dense is not None:
+            self._intensity = self._intensity.dense
+        return self._intensity
+
+    @intensity.setter
+    def intensity(self, intensity):
+        self._intensity = intensity
+        self._intensity_version += 1
+
     @property
     def dc(self):
         """
@@ -672,7 +4510,8 @@ class LPA(object):
         associated LEDSet objects, and the dc and gcal arrays. Setting this
         property populates the intensity array using dc and gcal values.
         `grayscale` is a , (n_steps, n_rows, n_cols, n_channels)-sized
-        array.
+        array of unsigned 16-bit integers, calculated by the object's
+        `engine`.
 
         Raises
         ------
@@ -691,34 +4530,17 @@ class LPA(object):
                     "{}. Will write all grayscale values as zero.".format(
                         channel))
 
-        n_steps = self.intensity.shape[0]
-        # Initialize grayscale array
-        gs = numpy.zeros((n_steps,
-                          self.n_rows,
-                          self.n_cols,
-                          self.n_channels), dtype=int)
-        # Convert intensities to grayscale values
-        for step in range(n_steps):
-            for channel in range(self.n_channels):
-                if self.led_sets[channel] is not None:
-                    try:
-                        gs[step, :, :, channel] = numpy.resize(
-                            self.led_sets[channel].\
-                                get_grayscale(
-                                    row=None,
-                                    col=None,
-                                    intensity=self.intensity[step,:,:,channel].\
-                                        flatten(),
-                                    dc=self.dc[:,:,channel].flatten(),
-                                    gcal=self.gcal[:,:,channel].flatten(),
-                                    ),
-                            (self.n_rows, self.n_cols))
-                    except ValueError as e:
-                        e.args = ("on LPA {}, step {}, channel {}: ".format(
-                            self.name,
-                            step,
-                            channel) + e.args[0],)
-                        raise
+        with instrumentation.stage('LPA.grayscale'):
+            self._update_change_points()
+            # Convert intensities to grayscale values
+            try:
+                gs = self.engine.get_grayscale(intensity=self.intensity,
+                                               led_sets=self.led_sets,
+                                               dc=self._dc,
+                                               gcal=self.gcal)
+            except ValueError as e:
+                e.args = ("on LPA {}, ".format(self.name) + e.args[0],)
+                raise
 
         return gs
 
@@ -749,23 +4571,22 @@ class LPA(object):
         if numpy.any(gs>4095):
             raise ValueError("grayscale values should not be greater than 4095")
 
-        # Populate intensity array
-        self.set_n_steps(gs.shape[0])
-        for step in range(gs.shape[0]):
-            for channel in range(self.n_channels):
-                if self.led_sets[channel] is None:
-                    # Set intensity as zero
-                    intensity_sch = numpy.zeros(self.n_rows*self.n_cols)
-                else:
-                    # Get intensities from LED set
-                    intensity_sch = self.led_sets[channel].get_intensity(
-                        gs=gs[step,:,:,channel].flatten(),
-                        dc=self.dc[:,:,channel].flatten(),
-                        gcal=self.gcal[:,:,channel].flatten())
-                # Resize and add to intensity array
-                intensity_sch.resize(self.n_rows, self.n_cols)
-                self.intensity[step, :, :, channel] = intensity_sch
-
+        # Populate intensity array, converting all steps at once
+        self.intensity = numpy.zeros(gs.shape)
+        for channel in range(self.n_channels):
+            if self.led_sets[channel] is None:
+                # Set intensity as zero
+                self.intensity[:, :, :, channel] = 0.
+            else:
+                # Get intensities from LED set
+                intensity_ch = self.led_sets[channel].get_intensity(
+                    gs=gs[:,:,:,channel].reshape(gs.shape[0], -1),
+                    dc=self.dc[:,:,channel].flatten(),
+                    gcal=self.gcal[:,:,channel].flatten())
+                self.intensity[:, :, :, channel] = intensity_ch.reshape(
+                    gs.shape[0], self.n_rows, self.n_cols)
+
+    @_instrumented('LPA.load_led_sets')
     def load_led_sets(self, led_set_names=None, layout_names=None):
         """
         Load data from specified LED sets.
@@ -811,49 +4632,35 @@ class LPA(object):
             raise ValueError('exactly {} LED set names should be specified'.\
                 format(self.n_channels))
 
+        # If no source of calibration data has been specified, use files in
+        # LED_CALIBRATION_PATH
+        calibration = self.calibration
+        if calibration is None:
+            calibration = CalibrationRepository()
+
         # Obtain LED set names from layout names
         if layout_names is not None:
-            # Load layout table
-            layout_table = pandas.read_excel(os.path.join(LED_CALIBRATION_PATH,
-                                                          LED_LAYOUT_FILENAME))
-            # Obtain led set names
             led_set_names = []
-            for i, layout in enumerate(layout_names):
+            for channel, layout in enumerate(layout_names):
                 # If layout is intentionally not specified, propagate to
                 # LED set name
                 if layout is None:
                     led_set_names.append(None)
-                    continue
-                # Get data for corresponding row in layout table
-                channel = i + 1
-                layout_row = layout_table[(layout_table['LPA']==self.name) &\
-                                          (layout_table['Channel']==channel) &\
-                                          (layout_table['Layout']==layout)]
-                # Check for more or less than one hit
-                if len(layout_row) > 1:
-                    raise ValueError("more than one rows with LPA name {},"
-                        " Channel {}, Layout {} in {}".format(
-                            self.name, channel, layout, LED_LAYOUT_FILENAME))
-                elif len(layout_row) < 1:
-                    raise ValueError("no layout data for LPA name {},"
-                        " Channel {}, Layout {} in {}".format(
-                            self.name, channel, layout, LED_LAYOUT_FILENAME))
-                # Accumulate
-                led_set_names.append(layout_row.iloc[0]['LED Set'])
+                else:
+                    led_set_names.append(calibration.get_led_set_name(
+                        self.name,
+                        channel,
+                        layout))
 
         # Initialize led sets
         self.led_sets = []
-        for i, led_set_name in enumerate(led_set_names):
+        for channel, led_set_name in enumerate(led_set_names):
             if led_set_name is None:
                 self.led_sets.append(None)
             else:
-                file_name = os.path.join(
-                    LED_CALIBRATION_PATH,
-                    led_set_name,
-                    "{}_c{}".format(self.name, i+1),
-                    "{}_{}_c{}.xlsx".format(led_set_name, self.name, i+1))
-                self.led_sets.append(LEDSet(name=led_set_name,
-                                            file_name=file_name))
+                self.led_sets.append(calibration.get_led_set(led_set_name,
+                                                             self.name,
+                                                             channel))
 
         # Consistency checks on all led sets
         for led_set in self.led_sets:
@@ -879,13 +4686,11 @@ class LPA(object):
             if led_set is None:
                 continue
             # Set dot correction from calibration data
-            dc_channel = led_set.calibration_data['DC'].values
-            dc_channel.resize((self.n_rows, self.n_cols))
-            self._dc[:,:,led_channel] = dc_channel
+            self._dc[:,:,led_channel] = led_set.measured_dc.reshape(
+                (self.n_rows, self.n_cols))
             # Set grayscale calibration from calibration data
-            gcal_channel = led_set.calibration_data['GS Cal'].values
-            gcal_channel.resize((self.n_rows, self.n_cols))
-            self.gcal[:,:,led_channel] = gcal_channel
+            self.gcal[:,:,led_channel] = led_set.measured_gcal.reshape(
+                (self.n_rows, self.n_cols))
 
     def set_all_dc(self, value, channel=None):
         """
@@ -941,10 +4746,16 @@ class LPA(object):
             Number of steps to resize the intensity array to. If `n_steps`
             is lower than the current length of `intensity`, the latter
             values will be discarded. If `n_steps` is larger, the last
-            timepoint of `intensity` will be repeated.
+            timepoint of `intensity` will be repeated, unless `intensity`
+            is a `WaveformIntensity` object, in which case waveforms are
+            evaluated at the new steps.
 
         """
-        if n_steps > self.intensity.shape[0]:
+        if isinstance(self.intensity, WaveformIntensity):
+            # Waveforms are defined at all times
+            self.intensity = WaveformIntensity(n_steps,
+                                               self.intensity.waveforms)
+        elif n_steps > self.intensity.shape[0]:
             # To add steps, repeat the last intensity value
             steps = numpy.expand_dims(self.intensity[-1,:,:,:], axis=0)
             steps = numpy.repeat(steps,
@@ -987,7 +4798,8 @@ class LPA(object):
                                 dtype=int)
         self.gcal.resize(self.n_rows, self.n_cols, self.n_channels)
 
-    def load_lpf(self, file_name):
+    @_instrumented('LPA.load_lpf')
+    def load_lpf(self, file_name, lazy=False):
         """
         Load intensity values from a binary .lpf file.
 
@@ -999,20 +4811,49 @@ class LPA(object):
         ----------
         file_name : str
             Name of the file to load.
+        lazy : bool, optional
+            If True, the file is memory-mapped and `intensity` is set to a
+            `LazyIntensity` object, such that grayscale values are only
+            read and converted when intensities are accessed. A regular
+            array is only created if intensities are modified. The file
+            can be saved again with `save_lpf()`, which replaces it instead
+            of writing into it. Note that on some systems, the file cannot
+            be replaced or deleted while being memory-mapped.
 
         """
         # Load light program file
-        lpf = LPF(file_name)
+        lpf = LPF()
+        lpf.load(file_name, memmap=lazy)
         # Check dimensions
         if lpf.n_channels != self.n_rows*self.n_cols*self.n_channels:
             raise ValueError("unexpected number of channels in light program "
                 "file")
-        # Populate grayscale array
-        # This automatically updates the intensity array.
-        self.grayscale = numpy.resize(lpf.grayscale, (lpf.n_steps,
-                                                      self.n_rows,
-                                                      self.n_cols,
-                                                      self.n_channels))
+        if lazy:
+            # Check that LED set information has been loaded
+            if self.led_sets is None:
+                raise Exception("LED sets have not been loaded. "
+                    "Call load_led_sets().")
+            # Throw warning if one of the led sets is not present
+            for channel, led_set in enumerate(self.led_sets):
+                if led_set is None:
+                    warnings.warn("No LEDSet loaded for channel "
+                        "{}. Will read all intensities as zero.".format(
+                            channel))
+            self.intensity = LazyIntensity(
+                grayscale=lpf.grayscale.reshape((lpf.n_steps,
+                                                 self.n_rows,
+                                                 self.n_cols,
+                                                 self.n_channels)),
+                led_sets=self.led_sets,
+                dc=self._dc,
+                gcal=self.gcal)
+        else:
+            # Populate grayscale array
+            # This automatically updates the intensity array.
+            self.grayscale = numpy.resize(lpf.grayscale, (lpf.n_steps,
+                                                          self.n_rows,
+                                                          self.n_cols,
+                                                          self.n_channels))
         # Set step size
         self.step_size = lpf.step_size
 
@@ -1055,6 +4896,7 @@ class LPA(object):
         f = open(file_name, "w")
         f.write(s)
         f.close()
+        instrumentation.add_bytes('LPA.save_dc', len(s))
 
     def save_gcal(self, file_name):
         """
@@ -1079,8 +4921,10 @@ class LPA(object):
         f = open(file_name, "w")
         f.write(s)
         f.close()
+        instrumentation.add_bytes('LPA.save_gcal', len(s))
 
-    def save_lpf(self, file_name):
+    @_instrumented('LPA.save_lpf')
+    def save_lpf(self, file_name, queue_depth=4):
         """
         Save grayscale values in a binary .lpf file.
 
@@ -1088,26 +4932,96 @@ class LPA(object):
         associated LEDSet objects, and the dc and gcal arrays. The
         resulting file is ready to be used by an LPA.
 
+        Grayscale values are calculated by the object's `engine` in blocks
+        of time steps. Each block is passed to a separate thread that
+        writes it to the file while the next blocks are calculated, such
+        that calculations and disk writes overlap. Values are written into
+        a temporary file in the same folder, which replaces `file_name`
+        once complete. If an intensity value cannot be generated, an
+        existing file is left unchanged.
+
         Parameters
         ----------
         file_name : str
             Name of the file to save.
+        queue_depth : int, optional
+            Maximum number of calculated blocks waiting to be written. If
+            zero, all grayscale values are calculated before writing.
 
         """
-        # Get grayscale values from grayscale property
-        gs = self.grayscale
-        # Flatten dimension corresponding to channels
+        self._update_change_points()
+        # Create LPF object with file information
         n_steps = self.intensity.shape[0]
-        gs.resize(n_steps, self.n_rows*self.n_cols*self.n_channels)
-        # Create LPF object and save
         lpf = LPF()
         lpf.n_channels = self.n_channels*self.n_rows*self.n_cols
         lpf.step_size = self.step_size
         lpf.n_steps = n_steps
-        lpf.grayscale = gs
-        lpf.save(file_name)
 
-    def save_files(self, path='.'):
+        if not queue_depth:
+            # Get grayscale values from grayscale property
+            gs = self.grayscale
+            # Flatten dimension corresponding to channels
+            gs.resize(n_steps, self.n_rows*self.n_cols*self.n_channels)
+            lpf.grayscale = gs
+            lpf.save(file_name)
+            return
+
+        # Check that LED set information has been loaded
+        if self.led_sets is None:
+            raise Exception("LED sets have not been loaded. "
+                "Call load_led_sets().")
+        # Throw warning if one of the led sets is not present
+        for channel, led_set in enumerate(self.led_sets):
+            if led_set is None:
+                warnings.warn("No LEDSet loaded for channel "
+                    "{}. Will write all grayscale values as zero.".format(
+                        channel))
+
+        # Blocks are written by a separate thread. Errors while writing are
+        # stored and raised at the end.
+        blocks = queue.Queue(maxsize=queue_depth)
+        write_errors = []
+
+        def write_blocks(f):
+            with instrumentation.stage('LPF.save'):
+                while True:
+                    gs = blocks.get()
+                    if gs is None:
+                        break
+                    # Keep emptying the queue after errors
+                    if write_errors:
+                        continue
+                    try:
+                        f.write(gs.data)
+                        instrumentation.add_bytes('LPF.save', gs.nbytes)
+                    except Exception as e:
+                        write_errors.append(e)
+
+        with _ReplacedFile(file_name) as f:
+            lpf._write_header(f)
+            instrumentation.add_bytes('LPF.save', 32)
+            writer = threading.Thread(target=write_blocks, args=(f,))
+            writer.start()
+            try:
+                for start, gs in self.engine.iter_grayscale(
+                        intensity=self.intensity,
+                        led_sets=self.led_sets,
+                        dc=self._dc,
+                        gcal=self.gcal):
+                    if write_errors:
+                        break
+                    blocks.put(gs)
+            except ValueError as e:
+                e.args = ("on LPA {}, ".format(self.name) + e.args[0],)
+                raise
+            finally:
+                blocks.put(None)
+                writer.join()
+            if write_errors:
+                raise write_errors[0]
+
+    @_instrumented('LPA.save_files')
+    def save_files(self, path='.', cache=None):
         """
         Save dc, gcal, and .lpf files from the contents of this object.
 
@@ -1121,6 +5035,10 @@ class LPA(object):
         path : str, optional
             A folder with the name of this object containing all files will
             be created in the directory specified by `path`.
+        cache : BuildCache, optional
+            If specified, files previously generated from identical inputs
+            are taken from this cache instead of being generated again.
+            Newly generated files are added to the cache.
 
         """
         # Check that `name` attribute is set
@@ -1132,9 +5050,18 @@ class LPA(object):
         if not os.path.exists(path):
             os.makedirs(path)
         # Save dc, gcal, and lpf files
-        self.save_dc(os.path.join(path, 'dc.txt'))
-        self.save_gcal(os.path.join(path, 'gcal.txt'))
-        self.save_lpf(os.path.join(path, 'program.lpf'))
+        key = None if cache is None else cache.get_key(self)
+        if (cache is None) or (not cache.restore(key, path)):
+            # Existing files may be hard-linked to files in a cache, and
+            # should not be overwritten in place.
+            for file_name in BuildCache.file_names:
+                if os.path.exists(os.path.join(path, file_name)):
+                    os.remove(os.path.join(path, file_name))
+            self.save_dc(os.path.join(path, 'dc.txt'))
+            self.save_gcal(os.path.join(path, 'gcal.txt'))
+            self.save_lpf(os.path.join(path, 'program.lpf'))
+            if cache is not None:
+                cache.store(key, path)
         # Save additional empty file with LPA's name
         open(os.path.join(path, self.name + ".txt"), 'w').close()
 
@@ -1203,7 +5130,200 @@ class LPA(object):
             intensity_well[start_step:] = intensity[:n_steps - start_step]
             self.intensity[:, row, col, channel] = intensity_well
 
-    def discretize_intensity(self):
+    def set_waveform(self,
+                     waveform,
+                     channel,
+                     rows=None,
+                     cols=None,
+                     sampling='point'):
+        """
+        Set the intensity of many wells to a waveform.
+
+        The first time this function is called, `intensity` is replaced
+        by a `WaveformIntensity` object with the same values, in which
+        intensities are calculated from waveforms only when accessed, for
+        example when converting to grayscale, saving files, or plotting.
+        Modifying any value of `intensity` directly replaces it with a
+        regular array.
+
+        Parameters
+        ----------
+        waveform : Waveform or float
+            Waveform to use, or a constant intensity in µmol/(m^2*s).
+        channel : int
+            LED channel to use.
+        rows, cols : array, optional
+            Row and column indices of the wells to use. The length of these
+            should be the same. If any of these is None, use all wells.
+        sampling : {'point', 'average'}, optional
+            How to obtain the intensity of each step from the waveform.
+            'point' uses the waveform's value at the start of each step.
+            'average' uses its average value over each step, which
+            delivers the same light dose as the waveform even if it
+            changes faster than the step size. See `StepAverage`.
+
+        """
+        if not isinstance(waveform, Waveform):
+            waveform = Constant(waveform)
+        # Check sampling method
+        if sampling == 'average':
+            waveform = StepAverage(waveform)
+        elif sampling != 'point':
+            raise ValueError("sampling method {} not recognized".format(
+                sampling))
+        # Populate row and col arrays if necessary
+        if (rows is None) or (cols is None):
+            rows = numpy.repeat(numpy.arange(self.n_rows), self.n_cols)
+            cols = numpy.tile(numpy.arange(self.n_cols), self.n_rows)
+        rows = numpy.atleast_1d(rows)
+        cols = numpy.atleast_1d(cols)
+        # Check matching dimensions
+        if len(rows) != len(cols):
+            raise ValueError("rows and cols should have the same length")
+        # Replace intensity array if necessary
+        if not isinstance(self.intensity, WaveformIntensity):
+            self.intensity = WaveformIntensity.from_array(self.intensity)
+        for row, col in zip(rows, cols):
+            self.intensity.waveforms[row, col, channel] = waveform
+        self._intensity_version += 1
+
+    def set_events(self, events, initial=0., run_length=False):
+        """
+        Set all intensities from a table of intensity change events.
+
+        Each event sets the intensity of one LED from one step onwards,
+        until the next event of the same LED. The current number of steps
+        and step size are used. See `compile_events()` for details.
+
+        Parameters
+        ----------
+        events : dict or DataFrame
+            Table with columns "row", "col", "channel", "intensity", and
+            either "step" or "time" (in milliseconds).
+        initial : float, optional
+            Intensity of each LED before its first event.
+        run_length : bool, optional
+            If True, `intensity` is set to a `RunLengthIntensity` object,
+            which stores one value per event instead of one per step.
+
+        """
+        self.intensity = compile_events(events,
+                                        n_steps=self.intensity.shape[0],
+                                        n_rows=self.n_rows,
+                                        n_cols=self.n_cols,
+                                        n_channels=self.n_channels,
+                                        step_size=self.step_size,
+                                        initial=initial,
+                                        run_length=run_length)
+
+    def index_change_points(self, chunk_steps=65536):
+        """
+        Store intensities as the steps at which each LED changes.
+
+        `intensity` is replaced by a `RunLengthIntensity` object with the
+        same values, which works as an index of each LED's change points.
+        Intensities at any time are then found by binary search with
+        `get_intensity_at()`, `get_segments()` takes time proportional to
+        the number of changes, and `grayscale`, `discretize_intensity()`,
+        `save_lpf()`, and `plot_intensity()` convert or plot each segment
+        of constant intensity once instead of every step.
+
+        The index is maintained from then on. Modifying values with
+        ``lpa.intensity[key] = value`` updates the runs of the LEDs
+        written. If `intensity` is replaced by a regular array, for
+        example after in-place operators such as ``lpa.intensity *= 2``,
+        `set_n_steps()`, or error diffusion with `discretize_intensity()`,
+        change points are found again the next time any of the functions
+        above is called.
+
+        Parameters
+        ----------
+        chunk_steps : int, optional
+            Number of steps processed at a time when finding changes.
+
+        Returns
+        -------
+        RunLengthIntensity
+            The new intensity object.
+
+        """
+        self._change_points_chunk_steps = chunk_steps
+        if not isinstance(self.intensity, RunLengthIntensity):
+            self.intensity = RunLengthIntensity.from_array(
+                self.intensity,
+                chunk_steps=chunk_steps)
+        return self.intensity
+
+    def _update_change_points(self):
+        # Index change points again if they were indexed with
+        # index_change_points(), and intensity has since been replaced by a
+        # regular array
+        if self._change_points_chunk_steps is not None and \
+                isinstance(self.intensity, numpy.ndarray):
+            self.intensity = RunLengthIntensity.from_array(
+                self.intensity,
+                chunk_steps=self._change_points_chunk_steps)
+
+    def get_intensity_at(self, time):
+        """
+        Get the intensity of every LED at a given time.
+
+        Parameters
+        ----------
+        time : float
+            Time, in milliseconds.
+
+        Returns
+        -------
+        array
+            Array of size (n_rows, n_cols, n_channels) with the intensity
+            of each LED, in µmol/(m^2*s).
+
+        """
+        self._update_change_points()
+        step = int(time//self.step_size)
+        if step < 0 or step >= self.intensity.shape[0]:
+            raise IndexError("time {} out of range".format(time))
+        return self.intensity[step]
+
+    def get_segments(self, row, col, channel):
+        """
+        Get the segments of constant intensity of one LED.
+
+        If `intensity` is a `RunLengthIntensity` object, for example after
+        calling `index_change_points()`, segments are obtained without
+        reading every step.
+
+        Parameters
+        ----------
+        row, col, channel : int
+            Position of the LED.
+
+        Returns
+        -------
+        list
+            List of tuples ``(step_start, step_stop, intensity)``, one per
+            segment in order of steps, with `step_stop` excluded and
+            `intensity` in µmol/(m^2*s).
+
+        """
+        self._update_change_points()
+        if isinstance(self.intensity, RunLengthIntensity):
+            step_start, step_stop, values = self.intensity.get_runs(row,
+                                                                    col,
+                                                                    channel)
+        else:
+            values = numpy.asarray(self.intensity[:, row, col, channel])
+            step_start = numpy.flatnonzero(
+                numpy.concatenate([[True], values[1:] != values[:-1]]))
+            step_stop = numpy.append(step_start[1:], len(values))
+            values = values[step_start]
+        return list(zip(step_start.tolist(),
+                        step_stop.tolist(),
+                        values.tolist()))
+
+    @_instrumented('LPA.discretize_intensity')
+    def discretize_intensity(self, method='round'):
         """
         Discretize the values in the intensity array.
 
@@ -1214,6 +5334,18 @@ class LPA(object):
         to convert the object's intensity values to the closest values that
         are possible at the current dc and gcal values.
 
+        Rounding each step independently can bias the total light dose,
+        for example if an intensity close to the lowest nonzero value is
+        kept for many steps. With ``method='error_diffusion'``, the
+        rounding error of each well is carried over to the next step, such
+        that its cumulative dose follows the requested one. See
+        `ConversionEngine.discretize_intensity()`.
+
+        Parameters
+        ----------
+        method : {'round', 'error_diffusion'}, optional
+            Discretization method.
+
         Raises
         ------
         Exception
@@ -1232,34 +5364,168 @@ class LPA(object):
                         channel))
         # A separate array will be created and populated. This way, if something
         # goes wrong, we will not overwrite the object's intensity array.
-        intensity = numpy.zeros_like(self.intensity)
-
-        for step in range(self.intensity.shape[0]):
-            for channel in range(self.n_channels):
-                if self.led_sets[channel] is not None:
-                    intensity_sch = self.intensity[step, :, :, channel].\
-                        flatten()
-                    # Call to LEDSet.discretize_intensity is inside a try block
-                    # in case the specified intensity is not possible.
-                    try:
-                        intensity_sch = self.led_sets[channel].\
-                            discretize_intensity(
-                                intensity=intensity_sch,
-                                dc=self.dc[:,:,channel].flatten(),
-                                gcal=self.gcal[:,:,channel].flatten(),
-                                )
-                    except ValueError as e:
-                        e.args = ("on step {}, channel {}: ".format(
-                            step,
-                            channel) + e.args[0],)
-                        raise
-                    intensity_sch.resize(self.n_rows, self.n_cols)
-                    intensity[step, :, :, channel] = intensity_sch
+        # Call to ConversionEngine.discretize_intensity is inside a try block
+        # in case the specified intensity is not possible.
+        self._update_change_points()
+        try:
+            intensity = self.engine.discretize_intensity(
+                intensity=self.intensity,
+                led_sets=self.led_sets,
+                dc=self._dc,
+                gcal=self.gcal,
+                method=method)
+        except ValueError as e:
+            e.args = ("on " + e.args[0],)
+            raise
 
         # At this point assume that everything worked, and replace the intensity
         # array
         self.intensity = intensity
 
+    def check_feasibility(self, chunk_steps=65536):
+        """
+        Find all intensities that cannot be generated with current settings.
+
+        At constant dc and gcal values, the intensity of each LED cannot
+        exceed the one produced at grayscale 4095. `grayscale` and
+        `discretize_intensity()` raise an error on the first intensity
+        above this limit. This function instead checks the whole intensity
+        array and reports every offending range of steps, along with the
+        dot correction that would be required to make it feasible.
+
+        Parameters
+        ----------
+        chunk_steps : int, optional
+            Number of steps processed at a time. This limits the amount of
+            temporary memory used.
+
+        Returns
+        -------
+        FeasibilityReport
+            Report with all infeasible step ranges.
+
+        Raises
+        ------
+        Exception
+            If LED set information has not been loaded.
+
+        """
+        # Check that LED set information has been loaded
+        if self.led_sets is None:
+            raise Exception("LED sets have not been loaded. "
+                "Call load_led_sets().")
+
+        n_steps = self.intensity.shape[0]
+        n_wells = self.n_rows*self.n_cols
+        violations = []
+        for channel, led_set in enumerate(self.led_sets):
+            # Channels without an LED set are always written as zero
+            if led_set is None:
+                continue
+            gcal = self.gcal[:,:,channel].flatten()
+            factor = led_set.get_grayscale_factor(
+                dc=self._dc[:,:,channel].flatten(),
+                gcal=gcal)
+            # Find violations on each chunk of steps. Comparisons with NaN,
+            # resulting from zero intensity at zero dc, are always False.
+            runs = []
+            for start in range(0, n_steps, chunk_steps):
+                intensity = self.intensity[start:start + chunk_steps,
+                                           :, :, channel]
+                intensity = intensity.reshape(-1, n_wells)
+                with numpy.errstate(invalid='ignore'):
+                    gs = intensity*factor
+                    mask = (gs >= 4095.5) | (gs < -0.5)
+                for well in numpy.flatnonzero(mask.any(axis=0)):
+                    # Find start and end of each range of violations
+                    edges = numpy.diff(numpy.concatenate(
+                        ([0], mask[:, well].astype(numpy.int8), [0])))
+                    run_starts = numpy.flatnonzero(edges==1)
+                    run_stops = numpy.flatnonzero(edges==-1)
+                    for run_start, run_stop in zip(run_starts, run_stops):
+                        intensity_run = intensity[run_start:run_stop, well]
+                        runs.append([well,
+                                     start + run_start,
+                                     start + run_stop,
+                                     intensity_run.max(),
+                                     intensity_run.min()])
+            # Merge ranges split between chunks
+            runs.sort()
+            merged_runs = []
+            for run in runs:
+                if merged_runs and (merged_runs[-1][0] == run[0]) and \
+                        (merged_runs[-1][2] == run[1]):
+                    merged_runs[-1][2] = run[2]
+                    merged_runs[-1][3] = max(merged_runs[-1][3], run[3])
+                    merged_runs[-1][4] = min(merged_runs[-1][4], run[4])
+                else:
+                    merged_runs.append(run)
+            # Generate report entries
+            for well, step_start, step_stop, i_max, i_min in merged_runs:
+                max_grayscale = i_max*factor[well]
+                if max_grayscale >= 4095.5:
+                    reason = 'above maximum'
+                    excess = max_grayscale - 4095
+                    # Same calculation as in LEDSet.optimize_dc()
+                    required_dc = int(numpy.ceil(
+                        led_set.measured_dc[well] *
+                        (i_max/led_set.measured_intensity[well]) *
+                        (led_set.measured_gcal[well]/gcal[well])))
+                    if required_dc > 63:
+                        required_dc = None
+                else:
+                    reason = 'negative'
+                    excess = -i_min*factor[well]
+                    required_dc = None
+                violations.append({'channel': channel,
+                                   'row': well//self.n_cols,
+                                   'col': well%self.n_cols,
+                                   'step_start': int(step_start),
+                                   'step_stop': int(step_stop),
+                                   'max_intensity': float(i_max),
+                                   'max_grayscale': float(max_grayscale),
+                                   'excess': float(excess),
+                                   'required_dc': required_dc,
+                                   'reason': reason})
+
+        violations.sort(key=lambda v: (v['channel'],
+                                       v['row'],
+                                       v['col'],
+                                       v['step_start']))
+        return FeasibilityReport(self.name, violations)
+
+    def get_dose_index(self):
+        """
+        Get an index of the light dose of every LED.
+
+        The index is created on the first call, and updated on later
+        calls with the current intensities and step size. Only chunks of
+        steps whose intensities changed are summed again.
+
+        Regular arrays can be modified in place, so their values are read
+        on every call to find changed chunks. Virtual intensity arrays
+        are replaced by a regular array when modified, and are only read
+        again if `intensity` was set or `set_waveform()` was called since
+        the last call. Attributes of virtual intensity objects, such as
+        `PeriodicIntensity.cycle`, should not be modified directly.
+
+        Returns
+        -------
+        DoseIndex
+            Index of the light dose of every LED.
+
+        """
+        intensity = self.intensity
+        if self._dose_index is None:
+            self._dose_index = DoseIndex(intensity, self.step_size)
+        elif isinstance(intensity, VirtualIntensity) and \
+                self._dose_index_version == self._intensity_version:
+            self._dose_index.step_size = self.step_size
+        else:
+            self._dose_index.update(intensity, self.step_size)
+        self._dose_index_version = self._intensity_version
+        return self._dose_index
+
     def optimize_dc(self, channel, min_dc=1, uniform=False):
         """
         Get the lowest dc value so that a specified intensity is possible.
@@ -1315,6 +5581,105 @@ class LPA(object):
         dc.resize(self.n_rows, self.n_cols)
         self.dc[:, :, channel] = dc
 
+    def optimize_dc_gcal(self,
+                         channel=None,
+                         min_dc=1,
+                         max_dc=63,
+                         min_gcal=1,
+                         max_gcal=255):
+        """
+        Set dc and gcal values that minimize the discretization error.
+
+        For each LED, every feasible pair of dot correction and grayscale
+        calibration values is evaluated against the LED's full intensity
+        timecourse, and the pair that minimizes the sum of squared
+        discretization errors is selected. See
+        `LEDSet.optimize_dc_gcal()` for details.
+
+        Parameters
+        ----------
+        channel : int, optional
+            Channel on which to optimize. If None, optimize all channels
+            with a loaded LED set.
+        min_dc, max_dc : int, optional
+            Range of dot correction values to consider.
+        min_gcal, max_gcal : int, optional
+            Range of grayscale calibration values to consider.
+
+        Returns
+        -------
+        dict
+            Dictionary with keys "error_before" and "error_after", each one
+            an array of size (n_rows, n_cols, n_channels) with the sum of
+            squared discretization errors of each LED, in
+            (µmol/(m^2*s))^2, before and after optimization. Errors before
+            optimization are infinite if intensities were not feasible.
+            Channels not optimized have NaN values.
+
+        Raises
+        ------
+        Exception
+            If LED set information has not been loaded.
+        TypeError
+            If dot correction lock is active.
+
+        """
+        if self.dc_lock:
+            raise TypeError("dc attribute is locked")
+        # Check that LED set information has been loaded
+        if self.led_sets is None:
+            raise Exception("LED sets have not been loaded. "
+                "Call load_led_sets().")
+        if channel is None:
+            channels = range(self.n_channels)
+        else:
+            channels = [channel]
+
+        error_before = numpy.zeros((self.n_rows,
+                                    self.n_cols,
+                                    self.n_channels))*numpy.nan
+        error_after = error_before.copy()
+        n_wells = self.n_rows*self.n_cols
+        for channel in channels:
+            led_set = self.led_sets[channel]
+            if led_set is None:
+                warnings.warn("No LEDSet loaded for channel {}. ".format(
+                    channel) + "DC and GCAL optimization not performed.")
+                continue
+            intensity = self.intensity[:, :, :, channel].reshape(-1, n_wells)
+            # Error at current values
+            factor = led_set.get_grayscale_factor(
+                dc=self.dc[:, :, channel].flatten(),
+                gcal=self.gcal[:, :, channel].flatten())
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                gs = numpy.round(intensity*factor)
+                d = intensity - gs/factor
+            d[intensity == 0] = 0.
+            error = numpy.sum(d*d, axis=0)
+            error[numpy.any((gs > 4095) | (gs < 0), axis=0)] = numpy.inf
+            error_before[:, :, channel] = error.reshape(self.n_rows,
+                                                        self.n_cols)
+            # Optimize
+            try:
+                dc, gcal, error = led_set.optimize_dc_gcal(
+                    intensity,
+                    min_dc=min_dc,
+                    max_dc=max_dc,
+                    min_gcal=min_gcal,
+                    max_gcal=max_gcal)
+            except ValueError as e:
+                e.args = ("on LPA {}, channel {}: ".format(
+                    self.name,
+                    channel) + e.args[0],)
+                raise
+            self.dc[:, :, channel] = dc.reshape(self.n_rows, self.n_cols)
+            self.gcal[:, :, channel] = gcal.reshape(self.n_rows, self.n_cols)
+            error_after[:, :, channel] = error.reshape(self.n_rows,
+                                                       self.n_cols)
+
+        return {'error_before': error_before, 'error_after': error_after}
+
+    @_instrumented('LPA.plot_intensity')
     def plot_intensity(self,
                        channel,
                        file_name=None,
@@ -1346,6 +5711,8 @@ class LPA(object):
             Size of the figure to make.
 
         """
+        from matplotlib import pyplot
+        self._update_change_points()
         pyplot.figure(figsize=figsize)
         for row in range(self.n_rows):
             for col in range(self.n_cols):
@@ -1353,23 +5720,33 @@ class LPA(object):
                 pyplot.subplot(self.n_rows,
                                self.n_cols,
                                row*self.n_cols + col + 1)
+                # Steps to plot. If intensities are stored as runs, the
+                # first and last step of each run result in the same plot
+                # as all steps.
+                if isinstance(self.intensity, RunLengthIntensity):
+                    step_start, step_stop, values = self.intensity.get_runs(
+                        row, col, channel)
+                    steps = numpy.unique(numpy.concatenate(
+                        [step_start, step_stop - 1]))
+                    intensity = values[numpy.searchsorted(step_start,
+                                                          steps,
+                                                          side='right') - 1]
+                else:
+                    steps = numpy.arange(self.intensity.shape[0])
+                    intensity = self.intensity[:, row, col, channel]
                 # Calculate x axis data based on units
                 if xunits=='step':
-                    time = numpy.arange(self.intensity.shape[0])
+                    time = steps
                 elif xunits=='ms':
-                    time = numpy.arange(self.intensity.shape[0]) * \
-                        self.step_size
+                    time = steps*self.step_size
                 elif xunits=='s':
-                    time = numpy.arange(self.intensity.shape[0]) * \
-                        self.step_size/1000.
+                    time = steps*self.step_size/1000.
                 elif xunits=='min':
-                    time = numpy.arange(self.intensity.shape[0]) * \
-                        self.step_size/60000.
+                    time = steps*self.step_size/60000.
                 else:
                     raise ValueError('units for x axis not recognized')
                 # Plot
-                pyplot.step(time,
-                            self.intensity[:, row, col, channel])
+                pyplot.step(time, intensity)
                 # Set labels, scales, lims
                 pyplot.xlim(time[0], time[-1])
                 pyplot.xlabel('Time ({})'.format(xunits))
@@ -1382,3 +5759,1272 @@ class LPA(object):
             pyplot.tight_layout()
             pyplot.savefig(file_name, dpi=200)
             pyplot.close()
+
+def dc_table_summary(lpas, gcal=None, dc=None):
+    """
+    Summarize the capabilities of many LPAs at each dot correction value.
+
+    Parameters
+    ----------
+    lpas : list
+        LPA objects with loaded LED sets.
+    gcal : int, optional
+        Grayscale calibration value to use. If None, use each LPA's
+        current gcal values.
+    dc : list, optional
+        Dot correction values to include. If None, include all values from
+        1 to 63.
+
+    Returns
+    -------
+    DataFrame
+        Table with one row per LPA, channel, and dot correction value, and
+        columns "LPA", "Channel", "LED Set", "DC", "Min Max Intensity",
+        "Median Max Intensity", "Max Max Intensity" (statistics across
+        wells of the intensity at grayscale 4095), and "Max Resolution"
+        (the largest intensity step across wells), with intensities in
+        µmol/(m^2*s).
+
+    """
+    import pandas
+    if dc is None:
+        dc = numpy.arange(1, 64)
+    dc = numpy.asarray(dc)
+    columns = ['LPA',
+               'Channel',
+               'LED Set',
+               'DC',
+               'Min Max Intensity',
+               'Median Max Intensity',
+               'Max Max Intensity',
+               'Max Resolution']
+    tables = []
+    for lpa in lpas:
+        for channel, led_set in enumerate(lpa.led_sets):
+            if led_set is None:
+                continue
+            if gcal is None:
+                gcal_channel = lpa.gcal[:, :, channel].flatten()
+            else:
+                gcal_channel = gcal
+            table = led_set.get_dc_table(gcal_channel)
+            max_intensity = table['max_intensity'].reshape(-1, 64)[:, dc]
+            resolution = table['resolution'].reshape(-1, 64)[:, dc]
+            tables.append(pandas.DataFrame({
+                'LPA': lpa.name,
+                'Channel': channel,
+                'LED Set': led_set.name,
+                'DC': dc,
+                'Min Max Intensity': max_intensity.min(axis=0),
+                'Median Max Intensity': numpy.median(max_intensity, axis=0),
+                'Max Max Intensity': max_intensity.max(axis=0),
+                'Max Resolution': resolution.max(axis=0)},
+                columns=columns))
+    if not tables:
+        return pandas.DataFrame(columns=columns)
+    return pandas.concat(tables, ignore_index=True)
+
+class FeasibilityReport(object):
+    """
+    Report of intensities that cannot be generated by an LPA.
+
+    Returned by `LPA.check_feasibility()`. Each violation corresponds to a
+    contiguous range of steps in which one LED requires a grayscale value
+    above 4095, or a negative grayscale value.
+
+    Attributes
+    ----------
+    lpa_name : str
+        Name of the LPA.
+    violations : list
+        List of dictionaries, one per violation, sorted by channel, row,
+        column, and step. Keys are "channel", "row", and "col" (the
+        LED's position, zero-indexed), "step_start" and "step_stop" (the
+        range of steps, with `step_stop` excluded), "max_intensity" (the
+        highest intensity requested in the range, in µmol/(m^2*s)),
+        "max_grayscale" (the unrounded grayscale value corresponding to
+        `max_intensity` at the current dc and gcal), "excess" (the amount
+        by which `max_grayscale` exceeds 4095, or by which the lowest
+        grayscale value is below zero), "required_dc" (the lowest dot
+        correction value that makes all intensities in the range
+        possible at the current gcal, or None if not possible with any
+        dot correction), and "reason" ("above maximum" or "negative").
+
+    """
+    columns = ['channel',
+               'row',
+               'col',
+               'step_start',
+               'step_stop',
+               'max_intensity',
+               'max_grayscale',
+               'excess',
+               'required_dc',
+               'reason']
+
+    def __init__(self, lpa_name, violations):
+        self.lpa_name = lpa_name
+        self.violations = violations
+
+    @property
+    def feasible(self):
+        """
+        Whether all intensities can be generated.
+
+        """
+        return len(self.violations) == 0
+
+    def __len__(self):
+        return len(self.violations)
+
+    def __iter__(self):
+        return iter(self.violations)
+
+    def __str__(self):
+        if self.feasible:
+            return "LPA {}: all intensities are feasible".format(self.lpa_name)
+        lines = ["LPA {}: {} infeasible step ranges".format(
+            self.lpa_name, len(self.violations))]
+        for v in self.violations:
+            lines.append("channel {}, row {}, col {}, steps {}-{}: {}, "
+                "grayscale {:.1f} (excess {:.1f}), required dc {}".format(
+                    v['channel'],
+                    v['row'],
+                    v['col'],
+                    v['step_start'],
+                    v['step_stop'] - 1,
+                    v['reason'],
+                    v['max_grayscale'],
+                    v['excess'],
+                    v['required_dc']))
+        return "\n".join(lines)
+
+    def to_dataframe(self):
+        """
+        Get violations as a table.
+
+        Returns
+        -------
+        DataFrame
+            Table with one row per violation, and one column per
+            violation key.
+
+        """
+        import pandas
+        return pandas.DataFrame(self.violations, columns=self.columns)
+
+class DoseIndex(object):
+    """
+    Cumulative light dose of every LED, for fast dose queries.
+
+    The index stores the cumulative sum of each LED's intensity over
+    steps. The dose received by any LED between two steps is then the
+    difference of two stored values, and can be calculated for all LEDs
+    and many windows at once without reading the intensity array.
+
+    Sums are stored per chunk of `chunk_steps` steps, relative to the
+    start of the chunk, along with each chunk's total. A digest of each
+    chunk's intensities is also kept, such that `update()` only sums
+    chunks that changed.
+
+    Parameters
+    ----------
+    intensity : array
+        Array of size (n_steps, n_rows, n_cols, n_channels) with light
+        intensity values, in µmol/(m^2*s). Can also be a
+        `VirtualIntensity` object.
+    step_size : int
+        Step size, in milliseconds.
+    chunk_steps : int, optional
+        Number of steps per chunk.
+
+    Attributes
+    ----------
+    shape : tuple
+        Size of the indexed intensity array.
+    step_size : int
+        Step size, in milliseconds.
+    chunk_steps : int
+        Number of steps per chunk.
+
+    """
+    columns = ['row', 'col', 'channel', 'dose', 'mean_intensity']
+
+    def __init__(self, intensity, step_size, chunk_steps=4096):
+        self.chunk_steps = int(chunk_steps)
+        self.shape = None
+        self.update(intensity, step_size)
+
+    def update(self, intensity, step_size=None):
+        """
+        Update the index after intensities have changed.
+
+        Parameters
+        ----------
+        intensity : array
+            New intensity array.
+        step_size : int, optional
+            New step size, in milliseconds. If None, keep the current one.
+
+        Returns
+        -------
+        int
+            Number of chunks whose sums were recalculated.
+
+        """
+        if step_size is not None:
+            self.step_size = step_size
+        shape = tuple(intensity.shape)
+        n_steps = shape[0]
+        n_leds = int(numpy.prod(shape[1:]))
+        n_chunks = -(-n_steps//self.chunk_steps)
+        # Start over if the size of the array changed
+        if shape != self.shape:
+            self.shape = shape
+            self._sums = numpy.empty((n_steps, n_leds))
+            self._chunk_totals = numpy.zeros((n_chunks, n_leds))
+            self._digests = [None]*n_chunks
+        n_updated = 0
+        for chunk in range(n_chunks):
+            start = chunk*self.chunk_steps
+            stop = min(start + self.chunk_steps, n_steps)
+            values = numpy.ascontiguousarray(intensity[start:stop],
+                                             dtype=float)
+            digest = hashlib.sha256(values).digest()
+            if digest == self._digests[chunk]:
+                continue
+            numpy.cumsum(values.reshape(stop - start, n_leds),
+                         axis=0,
+                         out=self._sums[start:stop])
+            self._chunk_totals[chunk] = self._sums[stop - 1]
+            self._digests[chunk] = digest
+            n_updated += 1
+        # Sum of all chunks before each chunk
+        self._chunk_offsets = numpy.concatenate(
+            [numpy.zeros((1, n_leds)), numpy.cumsum(self._chunk_totals,
+                                                   axis=0)])
+        return n_updated
+
+    def _get_cumulative(self, steps):
+        # Sum of intensities of all LEDs before each step in ``steps``, an
+        # integer array with values from 0 to n_steps
+        steps = numpy.asarray(steps, dtype=numpy.int64)
+        if numpy.any((steps < 0) | (steps > self.shape[0])):
+            raise IndexError("steps out of range")
+        cumulative = numpy.zeros(steps.shape + (self._sums.shape[1],))
+        after_first = steps > 0
+        last = steps[after_first] - 1
+        cumulative[after_first] = \
+            self._chunk_offsets[last//self.chunk_steps] + self._sums[last]
+        return cumulative
+
+    def _get_cumulative_time(self, time):
+        # Sum of intensities of all LEDs before each time in ``time``, in
+        # steps. Intensities are constant within a step, so the sum is
+        # interpolated linearly.
+        time = numpy.clip(numpy.asarray(time, dtype=float),
+                          0,
+                          self.shape[0])
+        if self.shape[0] == 0:
+            # Nothing to interpolate
+            return self._get_cumulative(time.astype(numpy.int64))
+        steps = numpy.minimum(numpy.floor(time), self.shape[0] - 1)
+        steps = steps.astype(numpy.int64)
+        cumulative = self._get_cumulative(steps)
+        fraction = (time - steps)[..., numpy.newaxis]
+        return cumulative + fraction * \
+            (self._get_cumulative(steps + 1) - cumulative)
+
+    def get_dose(self, start=0, stop=None, time=False):
+        """
+        Get the light dose received by all LEDs within windows of time.
+
+        Parameters
+        ----------
+        start, stop : int or array, optional
+            Start and end of each window. If `time` is False, these are
+            step numbers, with `stop` excluded. If `time` is True, these
+            are times in milliseconds, and windows can start or end within
+            a step. Default: from the first to the last step.
+        time : bool, optional
+            Whether `start` and `stop` are times instead of step numbers.
+
+        Returns
+        -------
+        array
+            Array of size ``shape + (n_rows, n_cols, n_channels)`` with
+            the light dose of each window and LED, in µmol/m^2, where
+            ``shape`` is the broadcasted size of `start` and `stop`.
+
+        """
+        if stop is None:
+            stop = self.shape[0]*(self.step_size if time else 1)
+        start, stop = numpy.broadcast_arrays(start, stop)
+        if time:
+            cumulative_start = self._get_cumulative_time(
+                start.ravel()/float(self.step_size))
+            cumulative_stop = self._get_cumulative_time(
+                stop.ravel()/float(self.step_size))
+        else:
+            cumulative_start = self._get_cumulative(start.ravel())
+            cumulative_stop = self._get_cumulative(stop.ravel())
+        dose = (cumulative_stop - cumulative_start)*self.step_size/1000.
+        return dose.reshape(start.shape + self.shape[1:])
+
+    def exceeds(self, budget, start=0, stop=None, time=False):
+        """
+        Find LEDs whose light dose within a window exceeds a budget.
+
+        Parameters
+        ----------
+        budget : float or array
+            Maximum light dose, in µmol/m^2. Can be an array that
+            broadcasts to (n_rows, n_cols, n_channels), for example with
+            one value per channel.
+        start, stop : int or array, optional
+            Window of time, as in `get_dose()`.
+        time : bool, optional
+            Whether `start` and `stop` are times instead of step numbers.
+
+        Returns
+        -------
+        array
+            Boolean array of size ``shape + (n_rows, n_cols,
+            n_channels)``, True for LEDs that receive more than `budget`.
+            ``numpy.argwhere()`` can be used to obtain their positions.
+
+        """
+        return self.get_dose(start, stop, time) > budget
+
+    def to_dataframe(self, start=0, stop=None, time=False):
+        """
+        Get the light dose of every LED within a window as a table.
+
+        Parameters
+        ----------
+        start, stop : int, optional
+            Window of time, as in `get_dose()`.
+        time : bool, optional
+            Whether `start` and `stop` are times instead of step numbers.
+
+        Returns
+        -------
+        DataFrame
+            Table with one row per LED, and columns "row", "col",
+            "channel", "dose" (in µmol/m^2), and "mean_intensity" (in
+            µmol/(m^2*s)).
+
+        """
+        import pandas
+        dose = self.get_dose(start, stop, time)
+        if stop is None:
+            stop = self.shape[0]*(self.step_size if time else 1)
+        duration = (stop - start)*(1 if time else self.step_size)/1000.
+        rows, cols, channels = numpy.indices(self.shape[1:])
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            mean_intensity = dose/float(duration)
+        return pandas.DataFrame({'row': rows.ravel(),
+                                 'col': cols.ravel(),
+                                 'channel': channels.ravel(),
+                                 'dose': dose.ravel(),
+                                 'mean_intensity': mean_intensity.ravel()},
+                                columns=self.columns)
+
+def dose_summary(lpas, start=0, stop=None, time=False):
+    """
+    Tabulate the light dose of every LED of many LPAs.
+
+    Doses are obtained from each LPA's `DoseIndex`, see
+    `LPA.get_dose_index()`.
+
+    Parameters
+    ----------
+    lpas : list
+        LPA objects.
+    start, stop : int, optional
+        Window of time, as in `DoseIndex.get_dose()`. Default: the whole
+        program of each LPA.
+    time : bool, optional
+        Whether `start` and `stop` are times instead of step numbers.
+
+    Returns
+    -------
+    DataFrame
+        Table with one row per LPA and LED, and columns "lpa", "row",
+        "col", "channel", "dose" (in µmol/m^2), and "mean_intensity" (in
+        µmol/(m^2*s)).
+
+    """
+    import pandas
+    tables = []
+    for lpa in lpas:
+        table = lpa.get_dose_index().to_dataframe(start, stop, time)
+        table.insert(0, 'lpa', lpa.name)
+        tables.append(table)
+    return pandas.concat(tables, ignore_index=True)
+
+class BuildCache(object):
+    """
+    Content-addressed store of files generated by `LPA.save_files()`.
+
+    The effective inputs of an LPA object (dimensions, step size, dot
+    correction, grayscale calibration, intensity, and a fingerprint of the
+    calibration data of each LED set) are hashed into a key. The first
+    time a key is seen, files are generated normally and then added to the
+    store under that key. Afterwards, ``LPA.save_files(path, cache)``
+    skips all conversions and writes, and instead hard-links (or copies)
+    the stored files into the output folder. If the output folder already
+    contains the stored files, nothing is done.
+
+    Files are always copied into the store, so that stored files never
+    share their contents with files in an output folder that could later
+    be modified. `LPA.save_files()` replaces existing output files instead
+    of writing into them, so hard-linked files are not modified either.
+
+    Parameters
+    ----------
+    path : str
+        Folder where generated files are stored. Created if necessary.
+    link : bool, optional
+        Whether to hard-link files from the store into output folders.
+        If False, or if hard-linking is not possible (e.g. the output
+        folder is on a different file system), files are copied.
+
+    Attributes
+    ----------
+    path : str
+        Folder where generated files are stored.
+    link : bool
+        Whether to hard-link files from the store into output folders.
+    hits : int
+        Number of calls to `LPA.save_files()` served from the store.
+    misses : int
+        Number of calls to `LPA.save_files()` that generated new files.
+
+    """
+    # Files generated by LPA.save_files() that are stored
+    file_names = ['dc.txt', 'gcal.txt', 'program.lpf']
+
+    # Increase when the contents of generated files change for the same
+    # inputs, to invalidate existing stores.
+    version = 1
+
+    def __init__(self, path, link=True):
+        self.path = path
+        self.link = link
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    @property
+    def stats(self):
+        """
+        Dictionary with the number of hits, misses, and the hit rate.
+
+        """
+        with self._lock:
+            n_total = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits/float(n_total) if n_total else 0.}
+
+    def get_key(self, lpa):
+        """
+        Calculate the key of an LPA object's generated files.
+
+        Parameters
+        ----------
+        lpa : LPA
+            LPA object.
+
+        Returns
+        -------
+        str
+            Hexadecimal SHA-256 digest of the LPA's effective inputs.
+
+        """
+        h = hashlib.sha256()
+        h.update(repr((self.version,
+                       lpa.n_rows,
+                       lpa.n_cols,
+                       lpa.n_channels,
+                       int(lpa.step_size),
+                       lpa.intensity.shape)).encode())
+        h.update(numpy.ascontiguousarray(lpa._dc, dtype=numpy.int64))
+        h.update(numpy.ascontiguousarray(lpa.gcal, dtype=numpy.int64))
+        intensity = lpa.intensity
+        if isinstance(intensity, PeriodicIntensity):
+            # Hash the stored steps without expanding the array
+            h.update(repr(('periodic',
+                           intensity.n_repeats,
+                           intensity.prefix.shape,
+                           intensity.cycle.shape,
+                           intensity.suffix.shape)).encode())
+            for steps in [intensity.prefix, intensity.cycle, intensity.suffix]:
+                h.update(numpy.ascontiguousarray(steps, dtype=float))
+        elif isinstance(intensity, VirtualIntensity):
+            # Hash a few steps at a time to avoid creating the full array.
+            # The digest is the same as if hashing the full array.
+            chunk_steps = max(2**20//max(intensity[0].size, 1), 1)
+            for start in range(0, intensity.shape[0], chunk_steps):
+                h.update(numpy.ascontiguousarray(
+                    intensity[start:start + chunk_steps], dtype=float))
+        else:
+            h.update(numpy.ascontiguousarray(intensity, dtype=float))
+        for led_set in lpa.led_sets:
+            if led_set is None:
+                h.update(b'None')
+            else:
+                h.update(led_set.fingerprint().encode())
+        return h.hexdigest()
+
+    def _get_entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def _place(self, source, destination, link):
+        # Hard-link or copy a file
+        if os.path.exists(destination):
+            os.remove(destination)
+        if link:
+            try:
+                os.link(source, destination)
+                return
+            except (OSError, AttributeError):
+                pass
+        shutil.copyfile(source, destination)
+
+    def restore(self, key, path):
+        """
+        Place stored files with a specified key in a folder.
+
+        Parameters
+        ----------
+        key : str
+            Key of the stored files.
+        path : str
+            Folder where to place the files.
+
+        Returns
+        -------
+        bool
+            True if files were found in the store, False otherwise.
+
+        """
+        entry_path = self._get_entry_path(key)
+        if not os.path.isdir(entry_path):
+            with self._lock:
+                self.misses += 1
+            instrumentation.count('BuildCache.misses')
+            return False
+        for file_name in self.file_names:
+            source = os.path.join(entry_path, file_name)
+            destination = os.path.join(path, file_name)
+            # Skip files that are already in place
+            if os.path.exists(destination) and \
+                    os.path.samefile(source, destination):
+                continue
+            if (not self.link) and os.path.exists(destination) and \
+                    filecmp.cmp(source, destination, shallow=False):
+                continue
+            self._place(source, destination, self.link)
+        with self._lock:
+            self.hits += 1
+        instrumentation.count('BuildCache.hits')
+        return True
+
+    def store(self, key, path):
+        """
+        Add files in a folder to the store under a specified key.
+
+        Parameters
+        ----------
+        key : str
+            Key of the files.
+        path : str
+            Folder containing the files to store.
+
+        """
+        entry_path = self._get_entry_path(key)
+        if os.path.isdir(entry_path):
+            return
+        # Files are placed in a temporary folder first, which is then
+        # renamed. This way, other processes never see incomplete entries.
+        parent_path = os.path.dirname(entry_path)
+        if not os.path.exists(parent_path):
+            try:
+                os.makedirs(parent_path)
+            except OSError:
+                # Created by another thread or process
+                pass
+        temp_path = tempfile.mkdtemp(dir=parent_path)
+        for file_name in self.file_names:
+            self._place(os.path.join(path, file_name),
+                        os.path.join(temp_path, file_name),
+                        link=False)
+        try:
+            os.rename(temp_path, entry_path)
+        except OSError:
+            # Stored by another thread or process
+            shutil.rmtree(temp_path)
+
+    def clear(self):
+        """
+        Remove all stored files and reset statistics.
+
+        """
+        shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+# Keys of an experiment spec that can be specified for each LPA, or at the
+# top level as a default for all LPAs
+_SPEC_LPA_KEYS = ['n_rows',
+                  'n_cols',
+                  'n_channels',
+                  'led_set_names',
+                  'layout_names',
+                  'step_size',
+                  'n_steps',
+                  'gcal',
+                  'dc',
+                  'discretize']
+
+# Calibration repositories used by this process, by (absolute path, layout
+# file name)
+_spec_repositories = {}
+
+def load_spec(file_name):
+    """
+    Load an experiment spec from a JSON or YAML file.
+
+    YAML files, with extension ".yaml" or ".yml", require PyYAML. Relative
+    paths in the spec ("calibration_path", "output_path", and
+    "cache_path") are interpreted relative to the folder containing the
+    spec file.
+
+    Parameters
+    ----------
+    file_name : str
+        Name of the file to load.
+
+    Returns
+    -------
+    dict
+        The experiment spec. See `compile_spec()` for a description.
+
+    """
+    with open(file_name, 'r') as f:
+        if os.path.splitext(file_name)[1].lower() in ['.yaml', '.yml']:
+            import yaml
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    spec_path = os.path.dirname(os.path.abspath(file_name))
+    for key in ['calibration_path', 'output_path', 'cache_path']:
+        if spec.get(key) is not None:
+            spec[key] = os.path.join(spec_path, spec[key])
+    return spec
+
+def _evaluate_waveform_spec(waveform, n_steps):
+    """
+    Get an array of intensities, one per step, from a waveform spec.
+
+    """
+    if isinstance(waveform, (int, float)):
+        return numpy.ones(n_steps)*waveform
+    if isinstance(waveform, list):
+        return numpy.array(waveform, dtype=float)
+    waveform_type = waveform['type']
+    if waveform_type == 'constant':
+        return numpy.ones(waveform.get('n_steps', n_steps))*waveform['value']
+    elif waveform_type == 'linspace':
+        return numpy.linspace(waveform['start'],
+                              waveform['stop'],
+                              waveform.get('n_steps', n_steps))
+    elif waveform_type == 'logspace':
+        return numpy.logspace(numpy.log10(waveform['start']),
+                              numpy.log10(waveform['stop']),
+                              waveform.get('n_steps', n_steps))
+    else:
+        raise ValueError("waveform type {} not recognized".format(
+            waveform_type))
+
+def _get_spec_wells(lpa, channel_spec):
+    """
+    Get row and column indices of the wells selected in a channel spec.
+
+    """
+    if ('rows' in channel_spec) and ('cols' in channel_spec):
+        return (numpy.array(channel_spec['rows'], dtype=int),
+                numpy.array(channel_spec['cols'], dtype=int))
+    return (numpy.repeat(numpy.arange(lpa.n_rows), lpa.n_cols),
+            numpy.tile(numpy.arange(lpa.n_cols), lpa.n_rows))
+
+def _populate_lpa_from_spec(lpa, lpa_spec):
+    """
+    Set step size, intensities, gcal, and dc according to an LPA spec.
+
+    """
+    dc_policy = lpa_spec.get('dc', 'calibration')
+    lpa.step_size = lpa_spec.get('step_size', lpa.step_size)
+    lpa.set_n_steps(lpa_spec.get('n_steps', 1))
+    # Grayscale calibration
+    gcal = lpa_spec.get('gcal')
+    if isinstance(gcal, list):
+        for channel, gcal_channel in enumerate(gcal):
+            if gcal_channel is not None:
+                lpa.set_all_gcal(gcal_channel, channel=channel)
+    elif gcal is not None:
+        lpa.set_all_gcal(gcal)
+    # Intensities
+    n_steps = lpa.intensity.shape[0]
+    for channel_spec in lpa_spec.get('channels', []):
+        channel = channel_spec['channel']
+        rows, cols = _get_spec_wells(lpa, channel_spec)
+        if 'staggered' in channel_spec:
+            staggered = channel_spec['staggered']
+            sampling_steps = staggered['sampling_steps']
+            if isinstance(sampling_steps, dict):
+                sampling_steps = sampling_steps.get('start', 0) + \
+                    numpy.arange(len(rows))*sampling_steps['step']
+            lpa.set_timecourse_staggered(
+                intensity=_evaluate_waveform_spec(staggered['intensity'],
+                                                  n_steps),
+                intensity_pre=staggered.get('intensity_pre', 0.),
+                sampling_steps=numpy.array(sampling_steps, dtype=int),
+                channel=channel,
+                rows=rows,
+                cols=cols)
+        else:
+            intensity = _evaluate_waveform_spec(channel_spec['intensity'],
+                                                n_steps)
+            if len(intensity) != n_steps:
+                raise ValueError("intensity for LPA {}, channel {} should "
+                    "have {} steps".format(lpa.name, channel, n_steps))
+            lpa.intensity[:, rows, cols, channel] = intensity[:, None]
+    # Dot correction
+    if dc_policy == 'optimize':
+        for channel in range(lpa.n_channels):
+            lpa.optimize_dc(channel)
+    elif isinstance(dc_policy, list):
+        for channel, dc_channel in enumerate(dc_policy):
+            if dc_channel is not None:
+                lpa.set_all_dc(dc_channel, channel=channel)
+    elif dc_policy != 'calibration':
+        lpa.set_all_dc(dc_policy)
+
+def compile_lpa_spec(lpa_spec,
+                     output_path='.',
+                     calibration_path=None,
+                     layout_file_name=None,
+                     cache_path=None,
+                     dry_run=False):
+    """
+    Generate the files of one LPA described in an experiment spec.
+
+    See `compile_spec()` for a description of the parameters. Calibration
+    repositories are cached by this function, so that calling it
+    repeatedly in the same process reads each calibration file once.
+
+    Parameters
+    ----------
+    lpa_spec : dict
+        LPA spec, with top-level defaults already applied.
+
+    Returns
+    -------
+    dict
+        Dictionary with the name of the LPA, the number of steps, the
+        folder where files were saved (None in a dry run), and the time in
+        seconds taken to load LED sets ("load"), set intensities ("set"),
+        discretize intensities ("discretize"), and convert to grayscale or
+        save files ("save").
+
+    """
+    times = {}
+    t = time.perf_counter()
+    # Get calibration repository. Default values are resolved here, so
+    # that later changes to the module-level defaults are taken into
+    # account.
+    if calibration_path is None:
+        calibration_path = LED_CALIBRATION_PATH
+    if layout_file_name is None:
+        layout_file_name = LED_LAYOUT_FILENAME
+    key = (os.path.abspath(calibration_path), layout_file_name)
+    if key not in _spec_repositories:
+        _spec_repositories[key] = CalibrationRepository(
+            path=calibration_path,
+            layout_file_name=layout_file_name)
+    calibration = _spec_repositories[key]
+    # Create LPA object and load LED sets
+    lpa = LPA(name=lpa_spec['name'],
+              n_rows=lpa_spec.get('n_rows', 4),
+              n_cols=lpa_spec.get('n_cols', 6),
+              n_channels=lpa_spec.get('n_channels', 2),
+              dc_lock=(lpa_spec.get('dc', 'calibration') == 'calibration'),
+              led_set_names=lpa_spec.get('led_set_names'),
+              layout_names=lpa_spec.get('layout_names'),
+              calibration=calibration)
+    times['load'] = time.perf_counter() - t
+    # Populate LPA object
+    t = time.perf_counter()
+    _populate_lpa_from_spec(lpa, lpa_spec)
+    times['set'] = time.perf_counter() - t
+    # Discretize
+    t = time.perf_counter()
+    discretize = lpa_spec.get('discretize', True)
+    if discretize:
+        lpa.discretize_intensity(
+            method=discretize if isinstance(discretize, str) else 'round')
+    times['discretize'] = time.perf_counter() - t
+    # Save
+    t = time.perf_counter()
+    if dry_run:
+        # Convert to grayscale to detect infeasible intensities
+        lpa.grayscale
+        path = None
+    else:
+        cache = BuildCache(cache_path) if cache_path is not None else None
+        lpa.save_files(output_path, cache=cache)
+        path = os.path.join(output_path, lpa.name)
+    times['save'] = time.perf_counter() - t
+
+    return {'name': lpa.name,
+            'n_steps': lpa.intensity.shape[0],
+            'path': path,
+            'times': times}
+
+def compile_spec(spec, jobs=1, dry_run=False):
+    """
+    Generate the files of all LPAs described in an experiment spec.
+
+    An experiment spec is a dictionary with the following keys:
+
+    - "lpas": list of LPA specs (see below).
+    - "calibration_path", optional: folder with calibration data. If not
+      specified, use ``LED_CALIBRATION_PATH``.
+    - "layout_file_name", optional: name of the LED layout file. If not
+      specified, use ``LED_LAYOUT_FILENAME``.
+    - "output_path", optional: folder where a subfolder with each LPA's
+      files is created. Default: current folder.
+    - "cache_path", optional: if specified, use a `BuildCache` in this
+      folder.
+    - Any LPA spec key other than "name" and "channels", used as default
+      for all LPAs.
+
+    Each LPA spec is a dictionary with the following keys:
+
+    - "name": name of the LPA.
+    - "layout_names" or "led_set_names": list with one name per channel.
+    - "n_rows", "n_cols", "n_channels", optional: LPA dimensions.
+    - "step_size", optional: step size in milliseconds.
+    - "n_steps", optional: number of steps.
+    - "gcal", optional: grayscale calibration value, or list with one
+      value per channel. If not specified, use values from calibration
+      data.
+    - "dc", optional: "calibration" (default) to use dot correction
+      values from calibration data, "optimize" to call
+      `LPA.optimize_dc()` on every channel, or a value, or a list with
+      one value per channel.
+    - "discretize", optional: whether to discretize intensities before
+      saving, or the discretization method ("round" or
+      "error_diffusion"). Default: True, which uses "round".
+    - "channels", optional: list of intensity assignments, applied in
+      order. Each one is a dictionary with a "channel" key, optional
+      "rows" and "cols" lists selecting wells (default: all wells), and
+      either an "intensity" waveform or a "staggered" dictionary with
+      keys "intensity" (waveform), "intensity_pre" (number, default 0),
+      and "sampling_steps" (list with one step per well, or a
+      dictionary with keys "start" and "step"). Staggered assignments
+      call `LPA.set_timecourse_staggered()`.
+
+    Waveforms can be a number (constant intensity), a list with one
+    intensity per step, or a dictionary with a "type" key. Supported
+    types are "constant" (key "value"), "linspace" and "logspace" (keys
+    "start" and "stop"). Dictionaries can optionally specify "n_steps";
+    otherwise, the LPA's number of steps is used.
+
+    Parameters
+    ----------
+    spec : dict
+        Experiment spec.
+    jobs : int, optional
+        Number of LPAs to compile in parallel, in separate processes.
+    dry_run : bool, optional
+        If True, intensities are converted to grayscale to check that
+        they are feasible, but no files are written.
+
+    Returns
+    -------
+    list
+        Results of `compile_lpa_spec()` for each LPA, in the same order as
+        in the spec.
+
+    """
+    # Apply top-level defaults to each LPA spec
+    lpa_specs = []
+    for lpa_spec in spec['lpas']:
+        lpa_spec_full = dict((key, spec[key])
+                             for key in _SPEC_LPA_KEYS if key in spec)
+        lpa_spec_full.update(lpa_spec)
+        lpa_specs.append(lpa_spec_full)
+    kwargs = {'output_path': spec.get('output_path', '.'),
+              'calibration_path': spec.get('calibration_path'),
+              'layout_file_name': spec.get('layout_file_name'),
+              'cache_path': spec.get('cache_path'),
+              'dry_run': dry_run}
+
+    if jobs == 1:
+        return [compile_lpa_spec(lpa_spec, **kwargs)
+                for lpa_spec in lpa_specs]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(compile_lpa_spec, lpa_spec, **kwargs)
+                       for lpa_spec in lpa_specs]
+            return [future.result() for future in futures]
+
+def _load_text_values(file_name):
+    # Load all integers in a whitespace-separated text file, such as
+    # "dc.txt" and "gcal.txt", as a flat array
+    with open(file_name, 'r') as f:
+        return numpy.array([int(si) for si in f.read().split()], dtype=int)
+
+def _audit_plate(plate, path, reference_path, n_cols, n_channels, chunk_steps):
+    # Compare the files of one plate folder against its reference folder,
+    # and return a list of mismatches
+    plate_path = os.path.join(path, plate)
+    plate_reference_path = os.path.join(reference_path, plate)
+    if not os.path.isdir(plate_path):
+        return [{'plate': plate, 'reason': 'missing plate'}]
+    if not os.path.isdir(plate_reference_path):
+        return [{'plate': plate, 'reason': 'unexpected plate'}]
+
+    def get_position(led):
+        # LEDs are ordered by row, column, and channel
+        return {'channel': led%n_channels,
+                'row': led//(n_cols*n_channels),
+                'col': (led//n_channels)%n_cols}
+
+    mismatches = []
+    for file_name in ['dc.txt', 'gcal.txt', 'program.lpf']:
+        file_path = os.path.join(plate_path, file_name)
+        reference_file_path = os.path.join(plate_reference_path, file_name)
+        if not os.path.isfile(file_path):
+            mismatches.append({'plate': plate,
+                               'file': file_name,
+                               'reason': 'missing file'})
+            continue
+        if not os.path.isfile(reference_file_path):
+            mismatches.append({'plate': plate,
+                               'file': file_name,
+                               'reason': 'unexpected file'})
+            continue
+
+        if file_name.endswith('.txt'):
+            values = _load_text_values(file_path)
+            values_reference = _load_text_values(reference_file_path)
+            if len(values) != len(values_reference):
+                mismatches.append({'plate': plate,
+                                   'file': file_name,
+                                   'reason': 'different number of values'})
+                continue
+            leds = numpy.flatnonzero(values != values_reference)
+            for led in leds.tolist():
+                mismatch = {'plate': plate,
+                            'file': file_name,
+                            'max_delta': int(abs(values[led] -
+                                                 values_reference[led])),
+                            'reason': 'different value'}
+                mismatch.update(get_position(led))
+                mismatches.append(mismatch)
+            continue
+
+        # Compare light program files without reading them fully
+        lpf = LPF()
+        lpf.load(file_path, memmap=True)
+        lpf_reference = LPF()
+        lpf_reference.load(reference_file_path, memmap=True)
+        if lpf.n_channels != lpf_reference.n_channels:
+            mismatches.append({'plate': plate,
+                               'file': file_name,
+                               'reason': 'different number of channels'})
+            continue
+        if lpf.step_size != lpf_reference.step_size:
+            mismatches.append({'plate': plate,
+                               'file': file_name,
+                               'reason': 'different step size'})
+        # Steps present in only one file are reported as one range
+        n_steps = min(lpf.n_steps, lpf_reference.n_steps)
+        if lpf.n_steps != lpf_reference.n_steps:
+            mismatches.append({'plate': plate,
+                               'file': file_name,
+                               'step_start': n_steps,
+                               'step_stop': max(lpf.n_steps,
+                                                lpf_reference.n_steps),
+                               'reason': 'different number of steps'})
+        runs = _find_differences(lpf.grayscale[:n_steps],
+                                 lpf_reference.grayscale[:n_steps],
+                                 chunk_steps=chunk_steps)
+        for led, step_start, step_stop, max_delta in runs:
+            mismatch = {'plate': plate,
+                        'file': file_name,
+                        'step_start': step_start,
+                        'step_stop': step_stop,
+                        'max_delta': max_delta,
+                        'reason': 'different value'}
+            mismatch.update(get_position(led))
+            mismatches.append(mismatch)
+
+    return mismatches
+
+class AuditReport(object):
+    """
+    Report of differences between LPA files and their reference.
+
+    Returned by `audit_fleet()`. Each mismatch corresponds to a missing
+    plate or file, a difference in an .lpf file header, a dc or gcal
+    value that differs from the reference, or a contiguous range of steps
+    in which the grayscale values of one LED differ from the reference.
+
+    Attributes
+    ----------
+    mismatches : list
+        List of dictionaries, one per mismatch, sorted by plate, file,
+        channel, row, column, and step. Keys are "plate" (name of the
+        plate's folder), "file" ("dc.txt", "gcal.txt", or "program.lpf"),
+        "channel", "row", and "col" (the LED's position, zero-indexed),
+        "step_start" and "step_stop" (the range of steps, with
+        `step_stop` excluded), "max_delta" (the largest absolute
+        difference with the reference value), and "reason" ("missing
+        plate", "unexpected plate", "missing file", "unexpected file",
+        "different number of values", "different number of channels",
+        "different step size", "different number of steps", or
+        "different value"). Keys that do not apply to a mismatch are
+        None.
+
+    """
+    columns = ['plate',
+               'file',
+               'channel',
+               'row',
+               'col',
+               'step_start',
+               'step_stop',
+               'max_delta',
+               'reason']
+
+    def __init__(self, mismatches):
+        self.mismatches = mismatches
+
+    @property
+    def passed(self):
+        """
+        Whether all files match their reference.
+
+        """
+        return len(self.mismatches) == 0
+
+    def __len__(self):
+        return len(self.mismatches)
+
+    def __iter__(self):
+        return iter(self.mismatches)
+
+    def __str__(self):
+        if self.passed:
+            return "All plates match their reference"
+        lines = ["{} mismatches".format(len(self.mismatches))]
+        for m in self.mismatches:
+            line = "plate {}".format(m['plate'])
+            if m['file'] is not None:
+                line += ", {}".format(m['file'])
+            if m['channel'] is not None:
+                line += ", channel {}, row {}, col {}".format(m['channel'],
+                                                             m['row'],
+                                                             m['col'])
+            if m['step_start'] is not None:
+                line += ", steps {}-{}".format(m['step_start'],
+                                               m['step_stop'] - 1)
+            line += ": {}".format(m['reason'])
+            if m['max_delta'] is not None:
+                line += " (max delta {})".format(m['max_delta'])
+            lines.append(line)
+        return "\n".join(lines)
+
+    def to_dataframe(self):
+        """
+        Get mismatches as a table.
+
+        Returns
+        -------
+        DataFrame
+            Table with one row per mismatch, and one column per mismatch
+            key.
+
+        """
+        import pandas
+        return pandas.DataFrame(self.mismatches, columns=self.columns)
+
+def audit_fleet(path,
+                reference,
+                plates=None,
+                n_cols=6,
+                n_channels=2,
+                jobs=None,
+                chunk_steps=65536):
+    """
+    Compare the files of many LPAs against their expected contents.
+
+    `path` should contain one folder per plate, named after the LPA, with
+    files "dc.txt", "gcal.txt", and "program.lpf", as generated by
+    `LPA.save_files()` or `compile_spec()`. Each plate folder is compared
+    file by file against the folder with the same name in the reference.
+    Light program files are memory-mapped and compared a chunk of steps
+    at a time, and plates are compared in parallel threads.
+
+    Parameters
+    ----------
+    path : str
+        Folder with the plate folders to check.
+    reference : str or dict
+        Folder with the reference plate folders, or experiment spec (a
+        dictionary, or the name of a JSON or YAML spec file) that is
+        compiled into a temporary folder with `compile_spec()` and used
+        as reference.
+    plates : list, optional
+        Names of the plates to check. If None, check all plate folders
+        found in `path` or in the reference.
+    n_cols, n_channels : int, optional
+        Number of columns and channels of the LPAs, used to report the
+        position of each LED.
+    jobs : int, optional
+        Number of plates to compare in parallel. If None, use the number
+        of processors.
+    chunk_steps : int, optional
+        Number of steps of each light program file compared at a time.
+        This limits the amount of memory used.
+
+    Returns
+    -------
+    AuditReport
+        Report with all mismatches.
+
+    """
+    temp_path = None
+    try:
+        if not isinstance(reference, dict) and os.path.isfile(reference):
+            reference = load_spec(reference)
+        if isinstance(reference, dict):
+            # Compile spec into a temporary folder
+            temp_path = tempfile.mkdtemp()
+            spec = dict(reference)
+            spec['output_path'] = temp_path
+            compile_spec(spec, jobs=jobs or 1)
+            reference_path = temp_path
+        else:
+            reference_path = reference
+
+        if plates is None:
+            plates = set()
+            for p in [path, reference_path]:
+                plates.update(d for d in os.listdir(p)
+                              if os.path.isdir(os.path.join(p, d)))
+            plates = sorted(plates)
+
+        # Compare plates in parallel
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) \
+                as executor:
+            futures = [executor.submit(_audit_plate,
+                                       plate,
+                                       path,
+                                       reference_path,
+                                       n_cols,
+                                       n_channels,
+                                       chunk_steps)
+                       for plate in plates]
+            mismatches = [mismatch
+                          for future in futures
+                          for mismatch in future.result()]
+
+    finally:
+        if temp_path is not None:
+            shutil.rmtree(temp_path)
+
+    # Fill in keys that do not apply with None, and sort
+    mismatches = [dict((key, m.get(key)) for key in AuditReport.columns)
+                  for m in mismatches]
+    mismatches.sort(key=lambda m: tuple((m[key] is not None, m[key])
+                                        for key in AuditReport.columns[:6]))
+    return AuditReport(mismatches)
+
+def main(argv=None):
+    """
+    Generate LPA files from an experiment spec file.
+
+    This is the entry point of the ``lpaprogram`` console command. Run
+    ``lpaprogram --help`` for usage information.
+
+    Parameters
+    ----------
+    argv : list, optional
+        Command line arguments, not including the program name. If None,
+        use ``sys.argv[1:]``.
+
+    Returns
+    -------
+    int
+        Exit status.
+
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='lpaprogram',
+        description='Generate LPA files from an experiment spec file.')
+    parser.add_argument('spec',
+                        help='experiment spec file (JSON or YAML)')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='number of LPAs to compile in parallel')
+    parser.add_argument('-n', '--dry-run',
+                        action='store_true',
+                        help='check all programs without writing files')
+    parser.add_argument('-o', '--output',
+                        help='output folder, overrides the spec')
+    parser.add_argument('--cache',
+                        help='build cache folder, overrides the spec')
+    args = parser.parse_args(argv)
+
+    spec = load_spec(args.spec)
+    if args.output is not None:
+        spec['output_path'] = args.output
+    if args.cache is not None:
+        spec['cache_path'] = args.cache
+
+    t = time.perf_counter()
+    results = compile_spec(spec, jobs=args.jobs, dry_run=args.dry_run)
+    t = time.perf_counter() - t
+
+    # Print timing summary
+    stages = ['load', 'set', 'discretize', 'save']
+    print("{:<16}{:>10}".format('LPA', 'Steps') +
+          "".join("{:>16}".format(stage + " (s)") for stage in stages))
+    for result in results:
+        print("{:<16}{:>10}".format(result['name'], result['n_steps']) +
+              "".join("{:>16.3f}".format(result['times'][stage])
+                      for stage in stages))
+    print("Compiled {} LPAs in {:.3f} s{}".format(
+        len(results),
+        t,
+        " (dry run, no files written)" if args.dry_run else ""))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""
+Unit tests for auditing LPA files
+
+"""
+
+import os
+import shutil
+import unittest
+
+import numpy
+
+import lpaprogram
+
+class TestAudit(unittest.TestCase):
+    """
+    Tests for audit_fleet and the AuditReport class.
+
+    """
+    def setUp(self):
+        lpaprogram.LED_CALIBRATION_PATH = "test/test_lpa_files/led-calibration"
+        # Directory where to save temporary files
+        self.temp_dir = "test/temp_audit"
+        if not os.path.exists(self.temp_dir):
+            os.makedirs(self.temp_dir)
+        # Reference files for three plates
+        self.reference_path = os.path.join(self.temp_dir, 'reference')
+        self.path = os.path.join(self.temp_dir, 'returned')
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'])
+        lpa.step_size = 60000
+        lpa.set_n_steps(100)
+        lpa.intensity[:,:,:,0] = 5.
+        lpa.intensity[:,:,:,1] = numpy.linspace(0, 10, 100)[:, None, None]
+        lpa.save_files(self.temp_dir)
+        for plate in ['plate_1', 'plate_2', 'plate_3']:
+            shutil.copytree(os.path.join(self.temp_dir, 'Jennie'),
+                            os.path.join(self.reference_path, plate))
+            shutil.copytree(os.path.join(self.temp_dir, 'Jennie'),
+                            os.path.join(self.path, plate))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def modify_lpf(self, plate, function):
+        file_name = os.path.join(self.path, plate, 'program.lpf')
+        lpf = lpaprogram.LPF(file_name)
+        lpf.grayscale = lpf.grayscale.copy()
+        function(lpf)
+        lpf.save(file_name)
+
+    def test_find_differences(self):
+        a = numpy.random.randint(0, 4096, size=(100, 10))
+        b = a.copy()
+        b[10:30, 3] += 5
+        b[20, 3] += 10
+        b[90:, 3] -= 2
+        b[0, 0] += 1
+        b[31:33, 9] += 1
+        for chunk_steps in [1, 7, 20, 65536]:
+            runs = lpaprogram._find_differences(a, b, chunk_steps=chunk_steps)
+            self.assertEqual(runs, [[0, 0, 1, 1],
+                                    [3, 10, 30, 15],
+                                    [3, 90, 100, 2],
+                                    [9, 31, 33, 1]])
+
+    def test_audit_fleet_match(self):
+        report = lpaprogram.audit_fleet(self.path, self.reference_path)
+        self.assertTrue(report.passed)
+        self.assertEqual(len(report), 0)
+        self.assertEqual(str(report), "All plates match their reference")
+        self.assertEqual(len(report.to_dataframe()), 0)
+
+    def test_audit_fleet_mismatches(self):
+        # Missing and unexpected plates
+        shutil.rmtree(os.path.join(self.path, 'plate_1'))
+        shutil.copytree(os.path.join(self.path, 'plate_2'),
+                        os.path.join(self.path, 'plate_4'))
+        # Different dc value, missing gcal file
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'],
+                             dc_lock=False)
+        lpa.dc[1, 2, 1] += 3
+        lpa.save_dc(os.path.join(self.path, 'plate_2', 'dc.txt'))
+        os.remove(os.path.join(self.path, 'plate_2', 'gcal.txt'))
+        # Different grayscale values and number of steps
+        def modify(lpf):
+            lpf.grayscale[40:60, 2*12 + 5*2 + 1] += 7
+        self.modify_lpf('plate_3', modify)
+        self.modify_lpf('plate_4', modify)
+        def truncate(lpf):
+            lpf.grayscale = lpf.grayscale[:90]
+            lpf.n_steps = 90
+        self.modify_lpf('plate_4', truncate)
+
+        report = lpaprogram.audit_fleet(self.path,
+                                        self.reference_path,
+                                        jobs=2)
+        self.assertFalse(report.passed)
+        table = report.to_dataframe()
+        self.assertEqual(list(table.columns), report.columns)
+        mismatches = [(m['plate'],
+                       m['file'],
+                       m['channel'],
+                       m['row'],
+                       m['col'],
+                       m['step_start'],
+                       m['step_stop'],
+                       m['max_delta'],
+                       m['reason']) for m in report]
+        self.assertEqual(mismatches, [
+            ('plate_1', None, None, None, None, None, None, None,
+             'missing plate'),
+            ('plate_2', 'dc.txt', 1, 1, 2, None, None, 3,
+             'different value'),
+            ('plate_2', 'gcal.txt', None, None, None, None, None, None,
+             'missing file'),
+            ('plate_3', 'program.lpf', 1, 2, 5, 40, 60, 7,
+             'different value'),
+            ('plate_4', None, None, None, None, None, None, None,
+             'unexpected plate'),
+            ])
+        self.assertIn("plate_3, program.lpf, channel 1, row 2, col 5, "
+                      "steps 40-59: different value (max delta 7)",
+                      str(report))
+
+    def test_audit_fleet_lpf_header(self):
+        def truncate(lpf):
+            lpf.grayscale = lpf.grayscale[:90]
+            lpf.n_steps = 90
+            lpf.step_size = 1000
+        self.modify_lpf('plate_1', truncate)
+        report = lpaprogram.audit_fleet(self.path,
+                                        self.reference_path,
+                                        plates=['plate_1'])
+        self.assertEqual([(m['reason'], m['step_start'], m['step_stop'])
+                          for m in report],
+                         [('different step size', None, None),
+                          ('different number of steps', 90, 100)])
+
+    def test_audit_fleet_spec(self):
+        spec = {
+            'calibration_path': os.path.abspath(
+                "test/test_lpa_files/led-calibration"),
+            'step_size': 60000,
+            'n_steps': 100,
+            'layout_names': ['520-2-KB', '660-LS'],
+            'lpas': [
+                {'name': 'Jennie',
+                 'channels': [
+                    {'channel': 0, 'intensity': 5},
+                    {'channel': 1,
+                     'intensity': {'type': 'linspace',
+                                   'start': 0,
+                                   'stop': 10}},
+                    ]},
+                ],
+            }
+        report = lpaprogram.audit_fleet(self.temp_dir,
+                                        spec,
+                                        plates=['Jennie'])
+        self.assertTrue(report.passed)
+        spec['lpas'][0]['channels'][0]['intensity'] = 4
+        report = lpaprogram.audit_fleet(self.temp_dir,
+                                        spec,
+                                        plates=['Jennie'])
+        self.assertEqual(len(report), 24)
+        self.assertEqual(set(m['channel'] for m in report), set([0]))
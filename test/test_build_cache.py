@@ -0,0 +1,150 @@
+"""
+Unit tests for the BuildCache class
+
+"""
+
+import filecmp
+import os
+import shutil
+import unittest
+
+import numpy
+
+import lpaprogram
+
+class TestBuildCache(unittest.TestCase):
+    """
+    Tests for the BuildCache class.
+
+    """
+    def setUp(self):
+        lpaprogram.LED_CALIBRATION_PATH = "test/test_lpa_files/led-calibration"
+        # Directory where to save temporary files
+        self.temp_dir = "test/temp_build_cache"
+        if not os.path.exists(self.temp_dir):
+            os.makedirs(self.temp_dir)
+        self.cache_dir = os.path.join(self.temp_dir, 'cache')
+        self.output_dir = os.path.join(self.temp_dir, 'output')
+        self.reference_dir = os.path.join(self.temp_dir, 'reference')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def create_lpa(self):
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'])
+        lpa.set_n_steps(20)
+        lpa.intensity[:,:,:,0] = numpy.linspace(0, 10, 20)[:,None,None]
+        lpa.intensity[:,:,:,1] = 5.
+        return lpa
+
+    def assert_same_files(self, path_1, path_2):
+        for file_name in ['dc.txt', 'gcal.txt', 'program.lpf', 'Jennie.txt']:
+            self.assertTrue(filecmp.cmp(os.path.join(path_1, file_name),
+                                        os.path.join(path_2, file_name),
+                                        shallow=False))
+
+    def test_key(self):
+        cache = lpaprogram.BuildCache(self.cache_dir)
+        lpa_1 = self.create_lpa()
+        lpa_2 = self.create_lpa()
+        self.assertEqual(cache.get_key(lpa_1), cache.get_key(lpa_2))
+        # Changing any input should change the key
+        lpa_2.intensity[5, 1, 1, 1] = 6.
+        self.assertNotEqual(cache.get_key(lpa_1), cache.get_key(lpa_2))
+        lpa_2 = self.create_lpa()
+        lpa_2.set_all_gcal(200, channel=0)
+        self.assertNotEqual(cache.get_key(lpa_1), cache.get_key(lpa_2))
+        lpa_2 = self.create_lpa()
+        lpa_2.step_size = 60000
+        self.assertNotEqual(cache.get_key(lpa_1), cache.get_key(lpa_2))
+        lpa_2 = self.create_lpa()
+        lpa_2.led_sets[1] = None
+        self.assertNotEqual(cache.get_key(lpa_1), cache.get_key(lpa_2))
+
+    def test_save_files(self):
+        cache = lpaprogram.BuildCache(self.cache_dir)
+        lpa = self.create_lpa()
+        lpa.save_files(self.reference_dir)
+        # First call should generate files
+        lpa.save_files(self.output_dir, cache=cache)
+        self.assertEqual(cache.stats, {'hits': 0,
+                                       'misses': 1,
+                                       'hit_rate': 0.})
+        self.assert_same_files(os.path.join(self.output_dir, 'Jennie'),
+                               os.path.join(self.reference_dir, 'Jennie'))
+        # Second call should be served from the cache
+        lpa = self.create_lpa()
+        lpa.save_files(self.output_dir, cache=cache)
+        self.assertEqual(cache.stats, {'hits': 1,
+                                       'misses': 1,
+                                       'hit_rate': 0.5})
+        self.assert_same_files(os.path.join(self.output_dir, 'Jennie'),
+                               os.path.join(self.reference_dir, 'Jennie'))
+        # A different folder should get the same files
+        other_dir = os.path.join(self.temp_dir, 'other')
+        lpa.save_files(other_dir, cache=cache)
+        self.assertEqual(cache.hits, 2)
+        self.assert_same_files(os.path.join(other_dir, 'Jennie'),
+                               os.path.join(self.reference_dir, 'Jennie'))
+
+    def test_save_files_changed(self):
+        cache = lpaprogram.BuildCache(self.cache_dir)
+        lpa = self.create_lpa()
+        lpa.save_files(self.output_dir, cache=cache)
+        # Change inputs and save again
+        lpa.intensity[:,:,:,1] = 2.
+        lpa.save_files(self.output_dir, cache=cache)
+        lpa.save_files(self.reference_dir)
+        self.assertEqual(cache.misses, 2)
+        self.assert_same_files(os.path.join(self.output_dir, 'Jennie'),
+                               os.path.join(self.reference_dir, 'Jennie'))
+        # Originally stored files should not have been modified
+        lpa = self.create_lpa()
+        lpa.save_files(self.reference_dir)
+        lpa.save_files(self.output_dir, cache=cache)
+        self.assertEqual(cache.hits, 1)
+        self.assert_same_files(os.path.join(self.output_dir, 'Jennie'),
+                               os.path.join(self.reference_dir, 'Jennie'))
+
+    def test_save_files_no_cache(self):
+        cache = lpaprogram.BuildCache(self.cache_dir)
+        lpa = self.create_lpa()
+        lpa.save_files(self.reference_dir)
+        lpa.save_files(self.output_dir, cache=cache)
+        # Saving different files without the cache should not modify
+        # stored files
+        lpa_other = self.create_lpa()
+        lpa_other.intensity[:,:,:,1] = 2.
+        lpa_other.save_files(self.output_dir)
+        lpa.save_files(self.output_dir, cache=cache)
+        self.assertEqual(cache.hits, 1)
+        self.assert_same_files(os.path.join(self.output_dir, 'Jennie'),
+                               os.path.join(self.reference_dir, 'Jennie'))
+        # Same with files restored from the cache
+        lpa_other.save_files(self.output_dir)
+        other_dir = os.path.join(self.temp_dir, 'other')
+        lpa.save_files(other_dir, cache=cache)
+        self.assertEqual(cache.hits, 2)
+        self.assert_same_files(os.path.join(other_dir, 'Jennie'),
+                               os.path.join(self.reference_dir, 'Jennie'))
+
+    def test_save_files_copy(self):
+        cache = lpaprogram.BuildCache(self.cache_dir, link=False)
+        lpa = self.create_lpa()
+        lpa.save_files(self.reference_dir)
+        lpa.save_files(self.output_dir, cache=cache)
+        other_dir = os.path.join(self.temp_dir, 'other')
+        lpa.save_files(other_dir, cache=cache)
+        self.assertEqual(cache.hits, 1)
+        self.assert_same_files(os.path.join(other_dir, 'Jennie'),
+                               os.path.join(self.reference_dir, 'Jennie'))
+
+    def test_clear(self):
+        cache = lpaprogram.BuildCache(self.cache_dir)
+        lpa = self.create_lpa()
+        lpa.save_files(self.output_dir, cache=cache)
+        cache.clear()
+        self.assertEqual(cache.misses, 0)
+        lpa.save_files(self.output_dir, cache=cache)
+        self.assertEqual(cache.stats['misses'], 1)
@@ -0,0 +1,98 @@
+"""
+Unit tests for the CalibrationRepository class
+
+"""
+
+import threading
+import unittest
+
+import numpy
+import six
+
+import lpaprogram
+
+class TestCalibrationRepository(unittest.TestCase):
+    """
+    Tests for the CalibrationRepository class.
+
+    """
+    def setUp(self):
+        self.path = "test/test_lpa_files/led-calibration"
+        lpaprogram.LED_CALIBRATION_PATH = ""
+
+    def tearDown(self):
+        lpaprogram.LED_CALIBRATION_PATH = ""
+
+    def test_create_default(self):
+        lpaprogram.LED_CALIBRATION_PATH = self.path
+        repository = lpaprogram.CalibrationRepository()
+        self.assertEqual(repository.path, self.path)
+        self.assertEqual(repository.layout_file_name, "led_layouts.xlsx")
+
+    def test_get_led_set_name(self):
+        repository = lpaprogram.CalibrationRepository(self.path)
+        self.assertEqual(repository.get_led_set_name('Jennie', 0, '520-2-KB'),
+                         'EO_12')
+        self.assertEqual(repository.get_led_set_name('Jennie', 1, '660-LS'),
+                         'EO_20')
+        with six.assertRaisesRegex(self,
+                                   ValueError,
+                                   "no layout data for LPA name Jennie"):
+            repository.get_led_set_name('Jennie', 0, '660-LS')
+
+    def test_get_led_set_cached(self):
+        repository = lpaprogram.CalibrationRepository(self.path)
+        led_set = repository.get_led_set('EO_12', 'Jennie', 0)
+        self.assertEqual(led_set.name, 'EO_12')
+        self.assertEqual(led_set.lpa_name, 'Jennie')
+        self.assertIs(repository.get_led_set('EO_12', 'Jennie', 0), led_set)
+        self.assertEqual(len(repository.led_sets), 1)
+        # Clear cache
+        repository.clear_cache()
+        self.assertEqual(len(repository.led_sets), 0)
+        self.assertIsNot(repository.get_led_set('EO_12', 'Jennie', 0),
+                         led_set)
+
+    def test_separate_caches(self):
+        repository_1 = lpaprogram.CalibrationRepository(self.path)
+        repository_2 = lpaprogram.CalibrationRepository(self.path)
+        self.assertIsNot(repository_1.get_led_set('EO_12', 'Jennie', 0),
+                         repository_2.get_led_set('EO_12', 'Jennie', 0))
+
+    def test_lpa(self):
+        repository = lpaprogram.CalibrationRepository(self.path)
+        lpa_1 = lpaprogram.LPA(name='Jennie',
+                               layout_names=['520-2-KB', '660-LS'],
+                               calibration=repository)
+        lpa_2 = lpaprogram.LPA(name='Jennie',
+                               layout_names=['520-2-KB', '660-LS'],
+                               calibration=repository)
+        # LED sets should be shared
+        self.assertIs(lpa_1.led_sets[0], lpa_2.led_sets[0])
+        self.assertIs(lpa_1.led_sets[1], lpa_2.led_sets[1])
+        # Results should be the same as with module globals
+        lpaprogram.LED_CALIBRATION_PATH = self.path
+        lpa_3 = lpaprogram.LPA(name='Jennie',
+                               layout_names=['520-2-KB', '660-LS'])
+        numpy.testing.assert_array_equal(lpa_1.dc, lpa_3.dc)
+        numpy.testing.assert_array_equal(lpa_1.gcal, lpa_3.gcal)
+
+    def test_threads(self):
+        repositories = [lpaprogram.CalibrationRepository(self.path)
+                        for i in range(2)]
+        results = [None]*8
+        def create_lpa(i):
+            lpa = lpaprogram.LPA(name='Jennie',
+                                 layout_names=['520-2-KB', '660-LS'],
+                                 calibration=repositories[i%2])
+            results[i] = lpa
+        threads = [threading.Thread(target=create_lpa, args=(i,))
+                   for i in range(len(results))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # All LPAs using the same repository should share LED sets
+        for i, lpa in enumerate(results):
+            self.assertIs(lpa.led_sets[0], results[i%2].led_sets[0])
+        self.assertIsNot(results[0].led_sets[0], results[1].led_sets[0])
@@ -0,0 +1,254 @@
+"""
+Unit tests for change point queries and conversions of run-length intensities
+
+"""
+
+import filecmp
+import os
+import shutil
+import unittest
+
+import numpy
+import six
+
+import lpaprogram
+
+class TestChangePoints(unittest.TestCase):
+    """
+    Tests for LPA.index_change_points() and related functions.
+
+    """
+    def setUp(self):
+        lpaprogram.LED_CALIBRATION_PATH = "test/test_lpa_files/led-calibration"
+        # Directory where to save temporary files
+        self.temp_dir = "test/temp_change_points"
+        if not os.path.exists(self.temp_dir):
+            os.makedirs(self.temp_dir)
+        # Intensities that change rarely
+        self.lpa = lpaprogram.LPA(name='Jennie',
+                                  layout_names=['520-2-KB', '660-LS'])
+        self.lpa.step_size = 60000
+        self.lpa.set_n_steps(500)
+        n_events = 100
+        self.lpa.set_events({'step': numpy.random.randint(0, 500, n_events),
+                             'row': numpy.random.randint(0, 4, n_events),
+                             'col': numpy.random.randint(0, 6, n_events),
+                             'channel': numpy.random.randint(0, 2, n_events),
+                             'intensity': numpy.random.rand(n_events)*5},
+                            initial=1.)
+        self.intensity_exp = numpy.array(self.lpa.intensity)
+        self.lpa_exp = lpaprogram.LPA(name='Jennie',
+                                      layout_names=['520-2-KB', '660-LS'])
+        self.lpa_exp.step_size = 60000
+        self.lpa_exp.intensity = self.intensity_exp.copy()
+
+    def tearDown(self):
+        lpaprogram.instrumentation.disable()
+        lpaprogram.instrumentation.reset()
+        shutil.rmtree(self.temp_dir)
+
+    def test_index_change_points(self):
+        intensity = self.lpa.index_change_points(chunk_steps=64)
+        self.assertIsInstance(intensity, lpaprogram.RunLengthIntensity)
+        self.assertIs(self.lpa.intensity, intensity)
+        numpy.testing.assert_array_equal(numpy.asarray(intensity),
+                                         self.intensity_exp)
+        self.assertLessEqual(len(intensity.run_values), 48 + 100)
+
+    def test_set_items(self):
+        intensity = self.lpa.index_change_points()
+        edits = [((5, 0, 0, 0), 3.),
+                 ((slice(100, 200), 2, 3, 1), 2.5),
+                 ((slice(150, 250), 2, 3, 1), 1.),
+                 ((slice(450, None), 3, 5), 0.),
+                 ((slice(None), 1, slice(None), 0),
+                  numpy.arange(6)*0.5),
+                 (([10, 10, 20], 0, 1, 1), [1., 2., 3.]),
+                 ((-1,), 4.),
+                 ((slice(300, 310), 0, 0, 0),
+                  self.intensity_exp[299, 0, 0, 0])]
+        for key, value in edits:
+            self.lpa.intensity[key] = value
+            self.lpa_exp.intensity[key] = value
+        # Runs are updated without calculating all values
+        self.assertIs(self.lpa.intensity, intensity)
+        self.assertIsNone(intensity.dense)
+        numpy.testing.assert_array_equal(numpy.asarray(intensity),
+                                         self.lpa_exp.intensity)
+        # Runs with the same value are merged
+        intensity_exp = lpaprogram.RunLengthIntensity.from_array(
+            self.lpa_exp.intensity)
+        numpy.testing.assert_array_equal(intensity.run_leds,
+                                         intensity_exp.run_leds)
+        numpy.testing.assert_array_equal(intensity.run_steps,
+                                         intensity_exp.run_steps)
+        numpy.testing.assert_array_equal(intensity.run_values,
+                                         intensity_exp.run_values)
+        for row, col, channel in [(0, 0, 0), (2, 3, 1), (1, 4, 0), (3, 5, 1)]:
+            self.assertEqual(self.lpa.get_segments(row, col, channel),
+                             self.lpa_exp.get_segments(row, col, channel))
+        lpaprogram.instrumentation.enable()
+        gs = self.lpa.grayscale
+        counters = lpaprogram.instrumentation.summary()['counters']
+        self.assertEqual(counters['ConversionEngine.values'],
+                         len(intensity.run_values))
+        numpy.testing.assert_array_equal(gs, self.lpa_exp.grayscale)
+        self.assertIs(self.lpa.intensity, intensity)
+
+    def test_set_items_random(self):
+        intensity = self.lpa.index_change_points()
+        intensity_exp = self.intensity_exp.copy()
+        for i in range(50):
+            start = numpy.random.randint(0, 500)
+            stop = numpy.random.randint(start, 501)
+            row = numpy.random.randint(0, 4)
+            channel = numpy.random.randint(0, 2)
+            value = numpy.random.randint(0, 3, stop - start)[:, numpy.newaxis]
+            intensity[start:stop, row, :, channel] = value
+            intensity_exp[start:stop, row, :, channel] = value
+        self.assertIsNone(intensity.dense)
+        numpy.testing.assert_array_equal(numpy.asarray(intensity),
+                                         intensity_exp)
+        self.assertEqual(
+            len(intensity.run_values),
+            len(lpaprogram.RunLengthIntensity.from_array(
+                intensity_exp).run_values))
+
+    def test_index_updated(self):
+        self.lpa.index_change_points(chunk_steps=64)
+        # In-place operators replace intensity with a regular array
+        self.lpa.intensity *= 2
+        self.assertIsInstance(self.lpa.intensity, numpy.ndarray)
+        self.assertEqual(self.lpa.get_segments(2, 3, 1),
+                         [(start, stop, 2*value) for start, stop, value
+                          in self.lpa_exp.get_segments(2, 3, 1)])
+        self.assertIsInstance(self.lpa.intensity,
+                              lpaprogram.RunLengthIntensity)
+        # Error diffusion results in a regular array
+        self.lpa.intensity = self.intensity_exp.copy()
+        self.lpa.discretize_intensity('error_diffusion')
+        self.lpa_exp.discretize_intensity('error_diffusion')
+        self.assertIsInstance(self.lpa.intensity, numpy.ndarray)
+        numpy.testing.assert_array_equal(
+            self.lpa.get_intensity_at(1234567),
+            self.lpa_exp.intensity[20])
+        self.assertIsInstance(self.lpa.intensity,
+                              lpaprogram.RunLengthIntensity)
+        numpy.testing.assert_array_equal(self.lpa.grayscale,
+                                         self.lpa_exp.grayscale)
+        # Change points are not indexed unless requested
+        self.assertIsInstance(self.lpa_exp.intensity, numpy.ndarray)
+
+    def test_get_runs(self):
+        intensity = self.lpa.index_change_points()
+        step_start, step_stop, values = intensity.get_runs(2, 3, 1)
+        self.assertEqual(step_start[0], 0)
+        self.assertEqual(step_stop[-1], 500)
+        numpy.testing.assert_array_equal(step_start[1:], step_stop[:-1])
+        for start, stop, value in zip(step_start, step_stop, values):
+            numpy.testing.assert_array_equal(
+                self.intensity_exp[start:stop, 2, 3, 1],
+                value)
+
+    def test_get_intensity_at(self):
+        self.lpa.index_change_points()
+        for time in [0, 59999, 60000, 1234567, 500*60000 - 1]:
+            numpy.testing.assert_array_equal(
+                self.lpa.get_intensity_at(time),
+                self.intensity_exp[time//60000])
+            numpy.testing.assert_array_equal(
+                self.lpa_exp.get_intensity_at(time),
+                self.intensity_exp[time//60000])
+        with six.assertRaisesRegex(self, IndexError,
+                                   "time 30000000 out of range"):
+            self.lpa.get_intensity_at(500*60000)
+
+    def test_get_segments(self):
+        self.lpa.index_change_points()
+        for row, col, channel in [(0, 0, 0), (2, 3, 1), (3, 5, 1)]:
+            segments = self.lpa.get_segments(row, col, channel)
+            self.assertEqual(segments,
+                             self.lpa_exp.get_segments(row, col, channel))
+            intensity = numpy.concatenate(
+                [numpy.full(stop - start, value)
+                 for start, stop, value in segments])
+            numpy.testing.assert_array_equal(
+                intensity,
+                self.intensity_exp[:, row, col, channel])
+
+    def test_grayscale(self):
+        intensity = self.lpa.index_change_points()
+        lpaprogram.instrumentation.enable()
+        gs = self.lpa.grayscale
+        # Only one value per run is converted
+        counters = lpaprogram.instrumentation.summary()['counters']
+        self.assertEqual(counters['ConversionEngine.values'],
+                         len(intensity.run_values))
+        numpy.testing.assert_array_equal(gs, self.lpa_exp.grayscale)
+        self.assertIsNone(intensity.dense)
+
+    def test_grayscale_error(self):
+        self.intensity_exp[200:, 1, 2, 1] = 1e4
+        self.intensity_exp[300:, 0, 0, 0] = 1e4
+        self.lpa.intensity = self.intensity_exp.copy()
+        self.lpa.index_change_points()
+        errmsg = "step 200, channel 1: not possible to generate requested " +\
+            "intensity with provided dc value. "
+        with six.assertRaisesRegex(self, ValueError, errmsg):
+            self.lpa.grayscale
+        # Blocks before the error are yielded
+        blocks = []
+        with six.assertRaisesRegex(self, ValueError, errmsg):
+            for block in self.lpa.engine.iter_grayscale(
+                    intensity=self.lpa.intensity,
+                    led_sets=self.lpa.led_sets,
+                    dc=self.lpa.dc,
+                    gcal=self.lpa.gcal,
+                    block_steps=50):
+                blocks.append(block)
+        self.assertEqual([start for start, gs in blocks], [0, 50, 100, 150])
+
+    def test_iter_grayscale(self):
+        self.lpa.index_change_points()
+        gs_exp = self.lpa_exp.grayscale
+        for block_steps in [None, 1, 70]:
+            blocks = list(self.lpa.engine.iter_grayscale(
+                intensity=self.lpa.intensity,
+                led_sets=self.lpa.led_sets,
+                dc=self.lpa.dc,
+                gcal=self.lpa.gcal,
+                block_steps=block_steps))
+            self.assertEqual(blocks[0][1].dtype, numpy.uint16)
+            numpy.testing.assert_array_equal(
+                numpy.concatenate([gs for start, gs in blocks]),
+                gs_exp)
+
+    def test_discretize_intensity(self):
+        self.lpa.index_change_points()
+        self.lpa.discretize_intensity()
+        self.assertIsInstance(self.lpa.intensity,
+                              lpaprogram.RunLengthIntensity)
+        self.lpa_exp.discretize_intensity()
+        numpy.testing.assert_array_equal(numpy.asarray(self.lpa.intensity),
+                                         self.lpa_exp.intensity)
+
+    def test_save_lpf(self):
+        self.lpa.index_change_points()
+        file_name = os.path.join(self.temp_dir, 'program.lpf')
+        self.lpa.save_lpf(file_name)
+        file_name_exp = os.path.join(self.temp_dir, 'program_exp.lpf')
+        self.lpa_exp.save_lpf(file_name_exp)
+        self.assertTrue(filecmp.cmp(file_name, file_name_exp, shallow=False))
+
+    def test_plot_intensity(self):
+        from matplotlib import pyplot
+        intensity = self.lpa.index_change_points()
+        self.lpa.plot_intensity(channel=1, xunits='min')
+        # Only the first and last step of each run are plotted
+        line = pyplot.gcf().axes[2*6 + 3].lines[0]
+        step_start, step_stop, values = intensity.get_runs(2, 3, 1)
+        steps = numpy.unique(numpy.concatenate([step_start, step_stop - 1]))
+        numpy.testing.assert_array_equal(line.get_xdata(), steps)
+        numpy.testing.assert_array_equal(line.get_ydata(),
+                                         self.intensity_exp[steps, 2, 3, 1])
+        pyplot.close()
@@ -0,0 +1,250 @@
+"""
+Unit tests for the ConversionEngine class
+
+"""
+
+import six
+import unittest
+
+import numpy
+
+import lpaprogram
+
+class TestConversionEngine(unittest.TestCase):
+    """
+    Tests for the ConversionEngine class.
+
+    """
+    def setUp(self):
+        lpaprogram.LED_CALIBRATION_PATH = "test/test_lpa_files/led-calibration"
+        self.lpa = lpaprogram.LPA(name='Jennie',
+                                  layout_names=['520-2-KB', '660-LS'],
+                                  dc_lock=False)
+        self.lpa.set_all_dc(8, channel=0)
+        self.lpa.dc[3, 5, 0] = 9
+        self.lpa.set_all_gcal(225, channel=0)
+        self.lpa.set_all_dc(7, channel=1)
+        self.lpa.set_all_gcal(255, channel=1)
+
+    def get_grayscale_exp(self, intensity):
+        # Convert using LEDSet.get_grayscale, one step and channel at a time
+        gs = numpy.zeros(intensity.shape, dtype=int)
+        for step in range(intensity.shape[0]):
+            for channel in range(self.lpa.n_channels):
+                gs[step, :, :, channel] = self.lpa.led_sets[channel].\
+                    get_grayscale(
+                        intensity=intensity[step, :, :, channel].flatten(),
+                        dc=self.lpa.dc[:, :, channel].flatten(),
+                        gcal=self.lpa.gcal[:, :, channel].flatten(),
+                        ).reshape(self.lpa.n_rows, self.lpa.n_cols)
+        return gs
+
+    def test_create(self):
+        engine = lpaprogram.ConversionEngine()
+        self.assertIsNone(engine.chunk_steps)
+        self.assertEqual(engine.get_chunk_steps(48), 2**18//(8*48))
+        engine = lpaprogram.ConversionEngine(chunk_steps=10)
+        self.assertEqual(engine.get_chunk_steps(48), 10)
+
+    def test_get_grayscale(self):
+        intensity = numpy.random.rand(200, 4, 6, 2)*5
+        for chunk_steps in [None, 1, 7, 1000]:
+            engine = lpaprogram.ConversionEngine(chunk_steps=chunk_steps)
+            gs = engine.get_grayscale(intensity=intensity,
+                                      led_sets=self.lpa.led_sets,
+                                      dc=self.lpa.dc,
+                                      gcal=self.lpa.gcal)
+            self.assertEqual(gs.dtype, numpy.uint16)
+            numpy.testing.assert_array_equal(
+                gs,
+                self.get_grayscale_exp(intensity))
+
+    def test_get_grayscale_ties(self):
+        # Intensities that result in grayscale values very close to x.5
+        engine = lpaprogram.ConversionEngine()
+        factors = engine.get_factors(self.lpa.led_sets,
+                                     self.lpa.dc,
+                                     self.lpa.gcal)
+        gs_half = numpy.random.randint(0, 4095, size=(500, 4, 6, 2)) + 0.5
+        intensity = gs_half/factors
+        intensity[1::3] = numpy.nextafter(intensity[1::3], -numpy.inf)
+        intensity[2::3] = numpy.nextafter(intensity[2::3], numpy.inf)
+        gs = engine.get_grayscale(intensity=intensity,
+                                  led_sets=self.lpa.led_sets,
+                                  dc=self.lpa.dc,
+                                  gcal=self.lpa.gcal)
+        numpy.testing.assert_array_equal(gs, self.get_grayscale_exp(intensity))
+
+    def test_get_grayscale_out(self):
+        engine = lpaprogram.ConversionEngine()
+        intensity = numpy.random.rand(20, 4, 6, 2)*5
+        out = numpy.zeros((20, 4, 6, 2), dtype=numpy.uint16)
+        gs = engine.get_grayscale(intensity=intensity,
+                                  led_sets=self.lpa.led_sets,
+                                  dc=self.lpa.dc,
+                                  gcal=self.lpa.gcal,
+                                  out=out)
+        self.assertIs(gs, out)
+        numpy.testing.assert_array_equal(gs, self.get_grayscale_exp(intensity))
+
+    def test_get_grayscale_no_led_set(self):
+        engine = lpaprogram.ConversionEngine()
+        intensity = numpy.random.rand(20, 4, 6, 2)*5
+        gs = engine.get_grayscale(intensity=intensity,
+                                  led_sets=[self.lpa.led_sets[0], None],
+                                  dc=self.lpa.dc,
+                                  gcal=self.lpa.gcal)
+        numpy.testing.assert_array_equal(
+            gs[:, :, :, 0],
+            self.get_grayscale_exp(intensity)[:, :, :, 0])
+        numpy.testing.assert_array_equal(gs[:, :, :, 1], 0)
+
+    def test_get_grayscale_error(self):
+        engine = lpaprogram.ConversionEngine(chunk_steps=4)
+        intensity = numpy.ones((20, 4, 6, 2))
+        intensity[13, 2, 1, 1] = 1e4
+        intensity[13, 3, 5, 0] = -5
+        intensity[15, 0, 0, 0] = 1e4
+        errmsg = "step 13, channel 0: not possible to generate requested " +\
+            "intensity with provided dc value. "
+        with six.assertRaisesRegex(self, ValueError, errmsg):
+            engine.get_grayscale(intensity=intensity,
+                                 led_sets=self.lpa.led_sets,
+                                 dc=self.lpa.dc,
+                                 gcal=self.lpa.gcal)
+
+    def test_discretize_intensity(self):
+        intensity = numpy.random.rand(50, 4, 6, 2)*5
+        intensity[:, :, :3, :] = intensity[:, :, 3:, :]
+        engine = lpaprogram.ConversionEngine()
+        discretized = engine.discretize_intensity(intensity=intensity,
+                                                  led_sets=self.lpa.led_sets,
+                                                  dc=self.lpa.dc,
+                                                  gcal=self.lpa.gcal)
+        for step in [0, 25, 49]:
+            for channel in range(2):
+                numpy.testing.assert_array_equal(
+                    discretized[step, :, :, channel].flatten(),
+                    self.lpa.led_sets[channel].discretize_intensity(
+                        intensity=intensity[step, :, :, channel].flatten(),
+                        dc=self.lpa.dc[:, :, channel].flatten(),
+                        gcal=self.lpa.gcal[:, :, channel].flatten()))
+
+    def test_discretize_intensity_error_diffusion(self):
+        # Intensities close to the lowest nonzero value
+        intensity = numpy.random.rand(200, 4, 6, 2)*0.05
+        intensity[:, 1, 1, 0] = 0.012
+        factors = lpaprogram.ConversionEngine().get_factors(
+            led_sets=self.lpa.led_sets,
+            dc=self.lpa.dc,
+            gcal=self.lpa.gcal)
+        gs_unrounded = intensity*factors
+        results = []
+        for chunk_steps in [None, 1, 7]:
+            engine = lpaprogram.ConversionEngine(chunk_steps=chunk_steps)
+            discretized = engine.discretize_intensity(
+                intensity=intensity,
+                led_sets=self.lpa.led_sets,
+                dc=self.lpa.dc,
+                gcal=self.lpa.gcal,
+                method='error_diffusion')
+            gs = engine.get_grayscale(intensity=discretized,
+                                      led_sets=self.lpa.led_sets,
+                                      dc=self.lpa.dc,
+                                      gcal=self.lpa.gcal)
+            # Grayscale values are within one of the unrounded values, and
+            # cumulative values within one half
+            self.assertLess(numpy.max(numpy.abs(gs - gs_unrounded)), 1)
+            cumulative_error = numpy.cumsum(gs, axis=0) - \
+                numpy.cumsum(gs_unrounded, axis=0)
+            self.assertLessEqual(numpy.max(numpy.abs(cumulative_error)),
+                                 0.5 + 1e-9)
+            results.append(discretized)
+        # Results do not depend on the number of steps per chunk
+        for discretized in results[1:]:
+            numpy.testing.assert_array_equal(discretized, results[0])
+        # Rounding each step independently accumulates larger errors
+        gs = engine.get_grayscale(intensity=intensity,
+                                  led_sets=self.lpa.led_sets,
+                                  dc=self.lpa.dc,
+                                  gcal=self.lpa.gcal)
+        cumulative_error = numpy.cumsum(gs[:, 1, 1, 0]) - \
+            numpy.cumsum(gs_unrounded[:, 1, 1, 0])
+        self.assertGreater(numpy.max(numpy.abs(cumulative_error)), 1)
+
+    def test_discretize_intensity_error_diffusion_exact(self):
+        # Intensities that can be generated exactly are not modified
+        intensity = numpy.random.rand(50, 4, 6, 2)*5
+        engine = lpaprogram.ConversionEngine()
+        discretized = engine.discretize_intensity(intensity=intensity,
+                                                  led_sets=self.lpa.led_sets,
+                                                  dc=self.lpa.dc,
+                                                  gcal=self.lpa.gcal)
+        discretized_diffusion = engine.discretize_intensity(
+            intensity=discretized,
+            led_sets=self.lpa.led_sets,
+            dc=self.lpa.dc,
+            gcal=self.lpa.gcal,
+            method='error_diffusion')
+        numpy.testing.assert_array_equal(discretized_diffusion, discretized)
+
+    def test_discretize_intensity_error_diffusion_error(self):
+        engine = lpaprogram.ConversionEngine(chunk_steps=4)
+        intensity = numpy.ones((20, 4, 6, 2))
+        intensity[13, 2, 1, 1] = 1e4
+        intensity[13, 3, 5, 0] = -5
+        errmsg = "step 13, channel 0: not possible to generate requested " +\
+            "intensity with provided dc value. "
+        with six.assertRaisesRegex(self, ValueError, errmsg):
+            engine.discretize_intensity(intensity=intensity,
+                                        led_sets=self.lpa.led_sets,
+                                        dc=self.lpa.dc,
+                                        gcal=self.lpa.gcal,
+                                        method='error_diffusion')
+        with six.assertRaisesRegex(self, ValueError,
+                                   "discretization method floor not "
+                                   "recognized"):
+            engine.discretize_intensity(intensity=intensity,
+                                        led_sets=self.lpa.led_sets,
+                                        dc=self.lpa.dc,
+                                        gcal=self.lpa.gcal,
+                                        method='floor')
+
+    def test_get_grayscale_workers(self):
+        intensity = numpy.random.rand(1000, 4, 6, 2)*5
+        gs_exp = self.get_grayscale_exp(intensity)
+        for n_workers in [1, 2, 3, None]:
+            engine = lpaprogram.ConversionEngine(chunk_steps=32,
+                                                 n_workers=n_workers)
+            gs = engine.get_grayscale(intensity=intensity,
+                                      led_sets=self.lpa.led_sets,
+                                      dc=self.lpa.dc,
+                                      gcal=self.lpa.gcal)
+            numpy.testing.assert_array_equal(gs, gs_exp)
+            discretized = engine.discretize_intensity(
+                intensity=intensity,
+                led_sets=self.lpa.led_sets,
+                dc=self.lpa.dc,
+                gcal=self.lpa.gcal)
+            for channel in range(2):
+                numpy.testing.assert_array_equal(
+                    discretized[:, :, :, channel].reshape(1000, -1),
+                    self.lpa.led_sets[channel].get_intensity(
+                        gs=gs_exp[:, :, :, channel].reshape(1000, -1),
+                        dc=self.lpa.dc[:, :, channel].flatten(),
+                        gcal=self.lpa.gcal[:, :, channel].flatten()))
+
+    def test_get_grayscale_workers_error(self):
+        # The error on the earliest step should be reported
+        engine = lpaprogram.ConversionEngine(chunk_steps=8, n_workers=4)
+        intensity = numpy.ones((1000, 4, 6, 2))
+        intensity[900, 0, 0, 0] = 1e4
+        intensity[301, 2, 1, 1] = 1e4
+        intensity[302, 2, 1, 0] = 1e4
+        errmsg = "step 301, channel 1: not possible to generate requested " +\
+            "intensity with provided dc value. "
+        with six.assertRaisesRegex(self, ValueError, errmsg):
+            engine.get_grayscale(intensity=intensity,
+                                 led_sets=self.lpa.led_sets,
+                                 dc=self.lpa.dc,
+                                 gcal=self.lpa.gcal)
@@ -0,0 +1,170 @@
+"""
+Unit tests for the DoseIndex class
+
+"""
+
+import unittest
+
+import numpy
+
+import lpaprogram
+
+class TestDoseIndex(unittest.TestCase):
+    """
+    Tests for the DoseIndex class and dose_summary.
+
+    """
+    def setUp(self):
+        lpaprogram.LED_CALIBRATION_PATH = "test/test_lpa_files/led-calibration"
+        self.intensity = numpy.random.rand(100, 4, 6, 2)*5
+        self.index = lpaprogram.DoseIndex(self.intensity,
+                                          step_size=60000,
+                                          chunk_steps=7)
+
+    def test_get_dose(self):
+        numpy.testing.assert_allclose(self.index.get_dose(),
+                                      self.intensity.sum(axis=0)*60)
+        # Several windows, including ones across chunks
+        start = numpy.array([0, 5, 6, 7, 13, 99, 40])
+        stop = numpy.array([10, 7, 8, 100, 14, 100, 40])
+        dose = self.index.get_dose(start, stop)
+        self.assertEqual(dose.shape, (7, 4, 6, 2))
+        for i in range(len(start)):
+            numpy.testing.assert_allclose(
+                dose[i],
+                self.intensity[start[i]:stop[i]].sum(axis=0)*60,
+                atol=1e-9)
+        with self.assertRaises(IndexError):
+            self.index.get_dose(0, 101)
+
+    def test_get_dose_time(self):
+        numpy.testing.assert_allclose(self.index.get_dose(time=True),
+                                      self.intensity.sum(axis=0)*60)
+        # Windows within and across steps
+        numpy.testing.assert_allclose(
+            self.index.get_dose(90000, 100000, time=True),
+            self.intensity[1]*10)
+        numpy.testing.assert_allclose(
+            self.index.get_dose(30000, 150000, time=True),
+            self.intensity[0]*30 + self.intensity[1]*60 +
+            self.intensity[2]*30)
+
+    def test_exceeds(self):
+        budget = numpy.median(self.index.get_dose(), axis=(0, 1))
+        exceeds = self.index.exceeds(budget)
+        self.assertEqual(exceeds.shape, (4, 6, 2))
+        numpy.testing.assert_array_equal(exceeds.sum(axis=(0, 1)), [12, 12])
+
+    def test_update(self):
+        # Nothing changed
+        self.assertEqual(self.index.update(self.intensity), 0)
+        # Two chunks changed
+        self.intensity[10, 1, 2, 0] += 1
+        self.intensity[99, 3, 5, 1] += 1
+        self.assertEqual(self.index.update(self.intensity), 2)
+        numpy.testing.assert_allclose(self.index.get_dose(),
+                                      self.intensity.sum(axis=0)*60)
+        numpy.testing.assert_allclose(self.index.get_dose(0, 14),
+                                      self.intensity[:14].sum(axis=0)*60)
+        # New step size
+        self.assertEqual(self.index.update(self.intensity, step_size=1000),
+                         0)
+        numpy.testing.assert_allclose(self.index.get_dose(),
+                                      self.intensity.sum(axis=0))
+        # New number of steps
+        self.assertEqual(self.index.update(self.intensity[:50]), 8)
+        numpy.testing.assert_allclose(self.index.get_dose(),
+                                      self.intensity[:50].sum(axis=0))
+
+    def test_to_dataframe(self):
+        table = self.index.to_dataframe(10, 20)
+        self.assertEqual(list(table.columns),
+                         ['row', 'col', 'channel', 'dose', 'mean_intensity'])
+        self.assertEqual(len(table), 48)
+        row = table.iloc[13]
+        self.assertEqual((row['row'], row['col'], row['channel']), (1, 0, 1))
+        self.assertAlmostEqual(row['dose'],
+                               self.intensity[10:20, 1, 0, 1].sum()*60)
+        self.assertAlmostEqual(row['mean_intensity'],
+                               self.intensity[10:20, 1, 0, 1].mean())
+
+    def test_get_dose_index(self):
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'])
+        lpa.step_size = 60000
+        lpa.intensity = self.intensity.copy()
+        index = lpa.get_dose_index()
+        numpy.testing.assert_allclose(index.get_dose(),
+                                      self.intensity.sum(axis=0)*60)
+        # The same index is updated
+        lpa.intensity[:, 0, 0, 0] = 0
+        self.assertIs(lpa.get_dose_index(), index)
+        numpy.testing.assert_array_equal(index.get_dose()[0, 0, 0], 0)
+        # Virtual intensity arrays
+        lpa.set_waveform(lpaprogram.Constant(2), channel=1)
+        numpy.testing.assert_allclose(lpa.get_dose_index().get_dose()[:, :, 1],
+                                      2*100*60)
+
+    def test_get_dose_index_unchanged(self):
+        # Waveform that counts the times it is evaluated
+        class CountingWaveform(lpaprogram.Constant):
+            n_evaluations = 0
+            def evaluate(self, t):
+                CountingWaveform.n_evaluations += 1
+                return super(CountingWaveform, self).evaluate(t)
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'])
+        lpa.step_size = 60000
+        lpa.set_n_steps(100)
+        lpa.set_waveform(CountingWaveform(2), channel=0)
+        index = lpa.get_dose_index()
+        n_evaluations = CountingWaveform.n_evaluations
+        self.assertGreater(n_evaluations, 0)
+        # Unchanged virtual intensities are not read again
+        lpa.step_size = 1000
+        self.assertIs(lpa.get_dose_index(), index)
+        self.assertEqual(CountingWaveform.n_evaluations, n_evaluations)
+        numpy.testing.assert_allclose(index.get_dose()[:, :, 0], 2*100)
+        # Setting waveforms or intensities updates the index
+        lpa.set_waveform(3, channel=0, rows=[1], cols=[2])
+        lpa.get_dose_index()
+        self.assertGreater(CountingWaveform.n_evaluations, n_evaluations)
+        self.assertAlmostEqual(index.get_dose()[1, 2, 0], 3*100)
+        lpa.intensity = lpaprogram.WaveformIntensity.from_array(
+            self.intensity)
+        numpy.testing.assert_allclose(lpa.get_dose_index().get_dose(),
+                                      self.intensity.sum(axis=0))
+        # Modified virtual intensities are replaced by a regular array
+        lpa.intensity[:, 0, 0, 0] = 0
+        numpy.testing.assert_array_equal(
+            lpa.get_dose_index().get_dose()[0, 0, 0],
+            0)
+
+    def test_no_steps(self):
+        index = lpaprogram.DoseIndex(numpy.zeros((0, 4, 6, 2)),
+                                     step_size=60000)
+        numpy.testing.assert_array_equal(index.get_dose(), 0)
+        numpy.testing.assert_array_equal(index.get_dose(time=True), 0)
+        self.assertEqual(index.get_dose([0, 0], 0, time=True).shape,
+                         (2, 4, 6, 2))
+        with self.assertRaises(IndexError):
+            index.get_dose(0, 1)
+
+    def test_dose_summary(self):
+        lpas = []
+        for name in ['Jennie', 'Kirk']:
+            lpa = lpaprogram.LPA(name=name, n_rows=2, n_cols=3)
+            lpa.step_size = 500
+            lpa.set_n_steps(10)
+            lpa.intensity[:] = 4
+            lpas.append(lpa)
+        lpas[1].intensity[:, 1, 2, 1] = 6
+        table = lpaprogram.dose_summary(lpas)
+        self.assertEqual(list(table.columns),
+                         ['lpa', 'row', 'col', 'channel', 'dose',
+                          'mean_intensity'])
+        self.assertEqual(len(table), 24)
+        self.assertEqual(list(table['lpa'].unique()), ['Jennie', 'Kirk'])
+        numpy.testing.assert_allclose(table['dose'][:23], 20)
+        self.assertAlmostEqual(table['dose'][23], 30)
+        self.assertAlmostEqual(table['mean_intensity'][23], 6)
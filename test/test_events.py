@@ -0,0 +1,124 @@
+"""
+Unit tests for compiling intensity change events
+
+"""
+
+import unittest
+
+import numpy
+import pandas
+import six
+
+import lpaprogram
+
+class TestEvents(unittest.TestCase):
+    """
+    Tests for compile_events and the RunLengthIntensity class.
+
+    """
+    def setUp(self):
+        lpaprogram.LED_CALIBRATION_PATH = "test/test_lpa_files/led-calibration"
+        # Random events, applied one at a time in order of steps for
+        # comparison
+        n_events = 500
+        self.events = {'step': numpy.random.randint(0, 100, n_events),
+                       'row': numpy.random.randint(0, 4, n_events),
+                       'col': numpy.random.randint(0, 6, n_events),
+                       'channel': numpy.random.randint(0, 2, n_events),
+                       'intensity': numpy.random.rand(n_events)*5}
+        # Repeated LED and step
+        self.events['step'][1] = self.events['step'][0]
+        self.events['row'][1] = self.events['row'][0]
+        self.events['col'][1] = self.events['col'][0]
+        self.events['channel'][1] = self.events['channel'][0]
+        self.intensity_exp = numpy.ones((100, 4, 6, 2))*0.5
+        for i in numpy.argsort(self.events['step'], kind='stable'):
+            self.intensity_exp[self.events['step'][i]:,
+                               self.events['row'][i],
+                               self.events['col'][i],
+                               self.events['channel'][i]] = \
+                self.events['intensity'][i]
+
+    def test_compile_events(self):
+        intensity = lpaprogram.compile_events(self.events,
+                                              n_steps=100,
+                                              initial=0.5)
+        numpy.testing.assert_array_equal(intensity, self.intensity_exp)
+        # From a DataFrame
+        intensity = lpaprogram.compile_events(pandas.DataFrame(self.events),
+                                              n_steps=100,
+                                              initial=0.5)
+        numpy.testing.assert_array_equal(intensity, self.intensity_exp)
+
+    def test_compile_events_time(self):
+        events = dict(self.events)
+        events['time'] = events.pop('step')*60000 + 59999
+        intensity = lpaprogram.compile_events(events,
+                                              n_steps=100,
+                                              step_size=60000,
+                                              initial=0.5)
+        numpy.testing.assert_array_equal(intensity, self.intensity_exp)
+        with six.assertRaisesRegex(self, ValueError,
+                                   "step_size is required to use event "
+                                   "times"):
+            lpaprogram.compile_events(events, n_steps=100)
+
+    def test_compile_events_error(self):
+        self.events['col'][10] = 6
+        with six.assertRaisesRegex(self, ValueError,
+                                   "event col out of range"):
+            lpaprogram.compile_events(self.events, n_steps=100)
+        self.events['col'][10] = 0
+        with six.assertRaisesRegex(self, ValueError,
+                                   "event step out of range"):
+            lpaprogram.compile_events(self.events, n_steps=50)
+
+    def test_compile_events_run_length(self):
+        intensity = lpaprogram.compile_events(self.events,
+                                              n_steps=100,
+                                              initial=0.5,
+                                              run_length=True)
+        self.assertIsInstance(intensity, lpaprogram.RunLengthIntensity)
+        self.assertEqual(intensity.shape, (100, 4, 6, 2))
+        self.assertLessEqual(len(intensity.run_values), 500 + 48)
+        numpy.testing.assert_array_equal(numpy.asarray(intensity),
+                                         self.intensity_exp)
+        for key in [5,
+                    slice(10, 50, 3),
+                    (slice(None), 2, 3, 1),
+                    (Ellipsis, 1),
+                    (numpy.array([0, 4, 99]), numpy.array([1, 2, 3]))]:
+            numpy.testing.assert_array_equal(intensity[key],
+                                             self.intensity_exp[key])
+
+    def test_run_length_from_array(self):
+        for chunk_steps in [1, 7, 65536]:
+            intensity = lpaprogram.RunLengthIntensity.from_array(
+                self.intensity_exp,
+                chunk_steps=chunk_steps)
+            numpy.testing.assert_array_equal(numpy.asarray(intensity),
+                                             self.intensity_exp)
+            # One run per change, plus one per LED
+            n_runs = 48 + numpy.sum(numpy.diff(self.intensity_exp, axis=0)
+                                    != 0)
+            self.assertEqual(len(intensity.run_values), n_runs)
+
+    def test_run_length_error(self):
+        with six.assertRaisesRegex(self, ValueError,
+                                   "every LED should have one run starting "
+                                   "at step zero"):
+            lpaprogram.RunLengthIntensity((10, 1, 1, 2),
+                                          run_leds=[0, 1],
+                                          run_steps=[0, 5],
+                                          run_values=[1., 2.])
+
+    def test_set_events(self):
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'])
+        lpa.set_n_steps(100)
+        lpa.set_events(self.events, initial=0.5, run_length=True)
+        self.assertIsInstance(lpa.intensity, lpaprogram.RunLengthIntensity)
+        gs = lpa.grayscale
+        lpa.set_events(self.events, initial=0.5)
+        numpy.testing.assert_array_equal(lpa.intensity, self.intensity_exp)
+        numpy.testing.assert_array_equal(gs, lpa.grayscale)
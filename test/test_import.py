@@ -0,0 +1,29 @@
+"""
+Unit tests for importing lpaprogram
+
+"""
+
+import subprocess
+import sys
+import unittest
+
+class TestImport(unittest.TestCase):
+    """
+    Tests for dependencies loaded when importing lpaprogram.
+
+    """
+    def run_in_subprocess(self, code):
+        return subprocess.check_output([sys.executable, '-c', code]).decode()
+
+    def test_import_does_not_load_pandas_matplotlib(self):
+        output = self.run_in_subprocess(
+            "import sys; import lpaprogram; "
+            "print('pandas' in sys.modules, 'matplotlib' in sys.modules)")
+        self.assertEqual(output.split(), ['False', 'False'])
+
+    def test_lpf_does_not_load_pandas_matplotlib(self):
+        output = self.run_in_subprocess(
+            "import sys; import lpaprogram; "
+            "lpf = lpaprogram.LPF('test/test_lpf_files/program.lpf'); "
+            "print('pandas' in sys.modules, 'matplotlib' in sys.modules)")
+        self.assertEqual(output.split(), ['False', 'False'])
@@ -0,0 +1,116 @@
+"""
+Unit tests for the Instrumentation class
+
+"""
+
+import json
+import os
+import shutil
+import unittest
+
+import numpy
+
+import lpaprogram
+
+class TestInstrumentation(unittest.TestCase):
+    """
+    Tests for the Instrumentation class.
+
+    """
+    def setUp(self):
+        lpaprogram.LED_CALIBRATION_PATH = "test/test_lpa_files/led-calibration"
+        lpaprogram.instrumentation.reset()
+        # Directory where to save temporary files
+        self.temp_dir = "test/temp_instrumentation"
+        if not os.path.exists(self.temp_dir):
+            os.makedirs(self.temp_dir)
+
+    def tearDown(self):
+        lpaprogram.instrumentation.disable()
+        lpaprogram.instrumentation.reset()
+        shutil.rmtree(self.temp_dir)
+
+    def test_disabled_by_default(self):
+        instrumentation = lpaprogram.Instrumentation()
+        self.assertFalse(instrumentation.enabled)
+        # Nothing should be recorded
+        with instrumentation.stage('test'):
+            pass
+        instrumentation.count('test')
+        instrumentation.add_bytes('test', 10)
+        summary = instrumentation.summary()
+        self.assertEqual(summary, {'stages': {}, 'counters': {}, 'bytes': {}})
+
+    def test_stage_count_bytes(self):
+        instrumentation = lpaprogram.Instrumentation()
+        instrumentation.enable()
+        for i in range(3):
+            with instrumentation.stage('test'):
+                pass
+        instrumentation.count('values', 5)
+        instrumentation.count('values', 2)
+        instrumentation.add_bytes('file', 32)
+        summary = instrumentation.summary()
+        self.assertEqual(summary['stages']['test']['calls'], 3)
+        self.assertGreaterEqual(summary['stages']['test']['total'], 0)
+        self.assertLessEqual(summary['stages']['test']['min'],
+                             summary['stages']['test']['max'])
+        self.assertEqual(summary['counters'], {'values': 7})
+        self.assertEqual(summary['bytes'], {'file': 32})
+        # Reset
+        instrumentation.reset()
+        self.assertEqual(instrumentation.summary()['stages'], {})
+
+    def test_save_files_instrumented(self):
+        lpaprogram.instrumentation.enable()
+        lpa = lpaprogram.LPA(name='Jennie', layout_names=['520-2-KB', '660-LS'])
+        lpa.set_n_steps(10)
+        lpa.intensity[:,:,:,0] = 5.
+        lpa.save_files(self.temp_dir)
+        summary = lpaprogram.instrumentation.summary()
+        for stage in ['LEDSet.__init__',
+                      'LEDSet.read_excel',
+                      'ConversionEngine.iter_grayscale',
+                      'LPA.load_led_sets',
+                      'LPA.save_files',
+                      'LPA.save_lpf',
+                      'LPF.save']:
+            self.assertIn(stage, summary['stages'])
+        self.assertEqual(summary['stages']['LEDSet.__init__']['calls'], 2)
+        # 10 steps, 48 channels, 2 bytes per value, plus 32 byte header
+        self.assertEqual(summary['bytes']['LPF.save'], 32 + 10*48*2)
+        self.assertIn('LPA.save_dc', summary['bytes'])
+        self.assertIn('LPA.save_gcal', summary['bytes'])
+
+    def test_save_trace(self):
+        lpaprogram.instrumentation.enable()
+        lpf = lpaprogram.LPF("test/test_lpf_files/program.lpf")
+        file_name = os.path.join(self.temp_dir, 'trace.json')
+        lpaprogram.instrumentation.save_trace(file_name)
+        with open(file_name, 'r') as f:
+            trace = json.load(f)
+        self.assertEqual(len(trace['traceEvents']), 1)
+        event = trace['traceEvents'][0]
+        self.assertEqual(event['name'], 'LPF.load')
+        self.assertEqual(event['ph'], 'X')
+        self.assertEqual(trace['otherData']['bytes']['LPF.load'],
+                         32 + 61*48*2)
+        self.assertEqual(trace['otherData']['counters'], {})
+        self.assertEqual(trace['otherData']['dropped_events'], 0)
+
+    def test_max_events(self):
+        instrumentation = lpaprogram.Instrumentation()
+        instrumentation.max_events = 5
+        instrumentation.enable()
+        for i in range(8):
+            with instrumentation.stage('test'):
+                pass
+        # Statistics include all calls, but only some events are kept
+        self.assertEqual(instrumentation.summary()['stages']['test']['calls'],
+                         8)
+        file_name = os.path.join(self.temp_dir, 'trace.json')
+        instrumentation.save_trace(file_name)
+        with open(file_name, 'r') as f:
+            trace = json.load(f)
+        self.assertEqual(len(trace['traceEvents']), 5)
+        self.assertEqual(trace['otherData']['dropped_events'], 3)
@@ -0,0 +1,160 @@
+"""
+Unit tests for the LazyIntensity class
+
+"""
+
+import os
+import shutil
+import unittest
+import warnings
+
+import numpy
+
+import lpaprogram
+
+class TestLazyIntensity(unittest.TestCase):
+    """
+    Tests for the LazyIntensity class.
+
+    """
+    def setUp(self):
+        lpaprogram.LED_CALIBRATION_PATH = "test/test_lpa_files/led-calibration"
+        # Directory where to save temporary files
+        self.temp_dir = "test/temp_lazy_intensity"
+        if not os.path.exists(self.temp_dir):
+            os.makedirs(self.temp_dir)
+        # Save a light program file
+        self.file_name = os.path.join(self.temp_dir, 'program.lpf')
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'],
+                             dc_lock=False)
+        lpa.set_all_dc(8, channel=0)
+        lpa.set_all_gcal(225, channel=0)
+        lpa.set_all_dc(7, channel=1)
+        lpa.set_all_gcal(255, channel=1)
+        lpa.set_n_steps(100)
+        lpa.intensity[:] = numpy.random.rand(100, 4, 6, 2)*5
+        lpa.step_size = 500
+        lpa.save_lpf(self.file_name)
+        self.dc = lpa.dc
+        self.gcal = lpa.gcal
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def load_lpa(self, lazy):
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'],
+                             dc_lock=False)
+        lpa.dc = self.dc
+        lpa.gcal = self.gcal
+        lpa.load_lpf(self.file_name, lazy=lazy)
+        return lpa
+
+    def test_load_lpf_lazy(self):
+        lpa = self.load_lpa(lazy=True)
+        lpa_exp = self.load_lpa(lazy=False)
+        self.assertIsInstance(lpa.intensity, lpaprogram.LazyIntensity)
+        self.assertEqual(lpa.step_size, 500)
+        self.assertEqual(lpa.intensity.shape, (100, 4, 6, 2))
+        self.assertEqual(lpa.intensity.ndim, 4)
+        self.assertEqual(len(lpa.intensity), 100)
+        # Compare several slices
+        for key in [numpy.s_[:],
+                    numpy.s_[10:20],
+                    numpy.s_[:, 1, 2, 0],
+                    numpy.s_[5, :, :, 1],
+                    numpy.s_[-1],
+                    numpy.s_[3, 2, 1, 0],
+                    numpy.s_[::7, [0, 3], :, 1],
+                    numpy.s_[..., 1]]:
+            numpy.testing.assert_array_equal(lpa.intensity[key],
+                                             lpa_exp.intensity[key])
+        numpy.testing.assert_array_equal(numpy.asarray(lpa.intensity),
+                                         lpa_exp.intensity)
+        # Intensity should not have been replaced
+        self.assertIsInstance(lpa.intensity, lpaprogram.LazyIntensity)
+        # Derived quantities
+        numpy.testing.assert_array_equal(lpa.grayscale, lpa_exp.grayscale)
+        lpa.save_lpf(os.path.join(self.temp_dir, 'program_2.lpf'))
+        lpf = lpaprogram.LPF(os.path.join(self.temp_dir, 'program_2.lpf'))
+        numpy.testing.assert_array_equal(
+            lpf.grayscale,
+            lpaprogram.LPF(self.file_name).grayscale)
+
+    def test_lazy_intensity_modify(self):
+        lpa = self.load_lpa(lazy=True)
+        lpa_exp = self.load_lpa(lazy=False)
+        # Modifying values should create a regular array
+        lpa.intensity[3, :, :, 0] = 1.
+        self.assertIsInstance(lpa.intensity, numpy.ndarray)
+        lpa_exp.intensity[3, :, :, 0] = 1.
+        numpy.testing.assert_array_equal(lpa.intensity, lpa_exp.intensity)
+        # Changing the number of steps
+        lpa = self.load_lpa(lazy=True)
+        lpa_exp = self.load_lpa(lazy=False)
+        lpa.set_n_steps(120)
+        lpa_exp.set_n_steps(120)
+        numpy.testing.assert_array_equal(lpa.intensity, lpa_exp.intensity)
+
+    def test_lazy_intensity_array_methods(self):
+        lpa = self.load_lpa(lazy=True)
+        lpa_exp = self.load_lpa(lazy=False)
+        intensity = lpa.intensity
+        intensity_exp = lpa_exp.intensity
+        # Methods and operators should return regular arrays
+        copy = intensity.copy()
+        self.assertIsInstance(copy, numpy.ndarray)
+        numpy.testing.assert_array_equal(copy, intensity_exp)
+        self.assertEqual(intensity.astype(numpy.float32).dtype, numpy.float32)
+        self.assertEqual(intensity.max(), intensity_exp.max())
+        self.assertEqual(intensity.min(), intensity_exp.min())
+        numpy.testing.assert_array_equal(intensity.mean(axis=0),
+                                         intensity_exp.mean(axis=0))
+        numpy.testing.assert_array_equal(intensity.sum(axis=(1, 2)),
+                                         intensity_exp.sum(axis=(1, 2)))
+        numpy.testing.assert_array_equal(2*intensity + 1,
+                                         2*intensity_exp + 1)
+        numpy.testing.assert_array_equal(1 - intensity/2,
+                                         1 - intensity_exp/2)
+        numpy.testing.assert_array_equal(-intensity, -intensity_exp)
+        self.assertIsNone(intensity.dense)
+        # In-place operators should create a regular array
+        lpa.intensity *= 2
+        self.assertIsInstance(lpa.intensity, numpy.ndarray)
+        numpy.testing.assert_array_equal(lpa.intensity, intensity_exp*2)
+        lpa = self.load_lpa(lazy=True)
+        lpa.intensity += 1
+        lpa.intensity -= 2
+        lpa.intensity /= 4
+        numpy.testing.assert_array_equal(lpa.intensity,
+                                         (intensity_exp + 1 - 2)/4)
+
+    def test_save_lpf_lazy_same_file(self):
+        # Overwrite the memory-mapped file with modified values
+        lpa = self.load_lpa(lazy=True)
+        lpa_exp = self.load_lpa(lazy=False)
+        for queue_depth in [0, 4]:
+            lpa.save_lpf(self.file_name, queue_depth=queue_depth)
+            numpy.testing.assert_array_equal(lpa.intensity,
+                                             lpa_exp.intensity)
+        lpa.intensity[:, :, :, 1] = 0
+        lpa.save_lpf(self.file_name)
+        lpa_exp.intensity[:, :, :, 1] = 0
+        lpa = self.load_lpa(lazy=False)
+        numpy.testing.assert_array_equal(lpa.intensity, lpa_exp.intensity)
+
+    def test_lazy_intensity_missing_led_set(self):
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', None],
+                             dc_lock=False)
+        lpa.dc = self.dc
+        lpa.gcal = self.gcal
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            lpa.load_lpf(self.file_name, lazy=True)
+            self.assertEqual(len(w), 1)
+            self.assertIn("No LEDSet loaded for channel 1. Will read all " +\
+                "intensities as zero.", str(w[0].message))
+        numpy.testing.assert_array_equal(lpa.intensity[:, :, :, 1], 0)
+        self.assertGreater(lpa.intensity[:, :, :, 0].max(), 0)
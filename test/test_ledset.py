@@ -3,6 +3,8 @@ Unit tests for the LEDSet class
 
 """
 
+import pickle
+import threading
 import unittest
 
 import numpy
@@ -948,3 +950,255 @@ class TestLEDSet(unittest.TestCase):
                                      uniform=True)
         # Test
         numpy.testing.assert_array_equal(dc_opt, 7)
+
+    def test_calibration_arrays(self):
+        # Load
+        led_set = lpaprogram.LEDSet(name='TestLEDSet', file_name=self.file_name)
+        # Compare with contents of the Excel file
+        calibration_data = pandas.read_excel(self.file_name,
+                                             'Sheet1',
+                                             index_col='Well')
+        numpy.testing.assert_array_equal(led_set.measured_dc,
+                                         calibration_data['DC'].values)
+        numpy.testing.assert_array_equal(led_set.measured_gcal,
+                                         calibration_data['GS Cal'].values)
+        numpy.testing.assert_array_equal(
+            led_set.measured_intensity,
+            calibration_data['Intensity (umol/m2/s)'].values)
+
+    def test_calibration_data(self):
+        # Load
+        led_set = lpaprogram.LEDSet(name='TestLEDSet', file_name=self.file_name)
+        calibration_data = pandas.read_excel(self.file_name,
+                                             'Sheet1',
+                                             index_col='Well')
+        # Calibration data table should match the Excel file
+        pandas.testing.assert_frame_equal(led_set.calibration_data,
+                                          calibration_data)
+        # Calibration data table should be built on demand from arrays
+        led_set = pickle.loads(pickle.dumps(led_set))
+        self.assertEqual(len(led_set.calibration_data), 24)
+        for column in ['Row', 'Col', 'DC', 'GS Cal']:
+            numpy.testing.assert_array_equal(
+                led_set.calibration_data[column].values,
+                calibration_data[column].values)
+            self.assertEqual(led_set.calibration_data[column].dtype,
+                             calibration_data[column].dtype)
+        numpy.testing.assert_array_equal(led_set.calibration_data.index,
+                                         calibration_data.index)
+        self.assertTrue((led_set.calibration_data['LPA']=='Tiffani').all())
+
+    def test_from_arrays(self):
+        # Load
+        led_set = lpaprogram.LEDSet(name='TestLEDSet', file_name=self.file_name)
+        # Create from arrays
+        led_set_arrays = lpaprogram.LEDSet.from_arrays(
+            name='TestLEDSet',
+            lpa_name=led_set.lpa_name,
+            channel=led_set.channel,
+            n_rows=led_set.n_rows,
+            n_cols=led_set.n_cols,
+            measured_dc=led_set.measured_dc,
+            measured_gcal=led_set.measured_gcal,
+            measured_intensity=led_set.measured_intensity)
+        self.assertEqual(led_set_arrays.lpa_name, "Tiffani")
+        self.assertEqual(led_set_arrays.n_rows, 4)
+        self.assertEqual(led_set_arrays.n_cols, 6)
+        self.assertEqual(led_set_arrays.channel, 0)
+        # Conversions should give the same results
+        numpy.testing.assert_array_equal(
+            led_set_arrays.get_intensity(gs=1000., dc=8, gcal=215),
+            led_set.get_intensity(gs=1000., dc=8, gcal=215))
+
+    def test_from_arrays_wrong_dimensions(self):
+        with self.assertRaises(ValueError):
+            lpaprogram.LEDSet.from_arrays(name='TestLEDSet',
+                                          lpa_name='Tiffani',
+                                          channel=0,
+                                          n_rows=4,
+                                          n_cols=6,
+                                          measured_dc=numpy.ones(23),
+                                          measured_gcal=numpy.ones(24),
+                                          measured_intensity=numpy.ones(24))
+
+    def test_pickle(self):
+        # Load
+        led_set = lpaprogram.LEDSet(name='TestLEDSet', file_name=self.file_name)
+        # Build calibration data table, which should not be pickled
+        led_set.calibration_data
+        led_set_pickled = pickle.loads(pickle.dumps(led_set))
+        self.assertIsNone(led_set_pickled._calibration_data)
+        self.assertEqual(led_set_pickled.lpa_name, "Tiffani")
+        numpy.testing.assert_array_equal(led_set_pickled.measured_intensity,
+                                         led_set.measured_intensity)
+
+    def test_get_grayscale_factor(self):
+        # Load
+        led_set = lpaprogram.LEDSet(name='TestLEDSet', file_name=self.file_name)
+        intensity = numpy.array([7.92834328438,
+                                 21.961121594,
+                                 9.23805519165,
+                                 ])
+        dc = numpy.array([6, 4, 8])
+        gcal = numpy.array([199, 230, 150])
+        row = [0, 1, 3]
+        col = [3, 5, 5]
+        factor = led_set.get_grayscale_factor(dc=dc,
+                                              gcal=gcal,
+                                              row=row,
+                                              col=col)
+        # Rounded results should match get_grayscale
+        numpy.testing.assert_array_equal(
+            numpy.round(intensity*factor),
+            led_set.get_grayscale(intensity=intensity,
+                                  dc=dc,
+                                  gcal=gcal,
+                                  row=row,
+                                  col=col))
+        # Default dc and gcal
+        self.assertEqual(len(led_set.get_grayscale_factor()), 24)
+
+    def test_optimize_dc_gcal(self):
+        # Load
+        led_set = lpaprogram.LEDSet(name='TestLEDSet', file_name=self.file_name)
+        intensity = numpy.repeat(numpy.linspace(0.1, 20, 50)[:, numpy.newaxis],
+                                 24,
+                                 axis=1)
+        dc, gcal, error = led_set.optimize_dc_gcal(intensity)
+        self.assertEqual(dc.shape, (24,))
+        self.assertEqual(gcal.shape, (24,))
+        self.assertTrue(numpy.all((dc >= 1) & (dc <= 63)))
+        self.assertTrue(numpy.all((gcal >= 1) & (gcal <= 255)))
+        # Reported error should match the actual discretization error
+        discretized = numpy.array([
+            led_set.discretize_intensity(step_intensity, dc=dc, gcal=gcal)
+            for step_intensity in intensity])
+        numpy.testing.assert_almost_equal(
+            numpy.sum((discretized - intensity)**2, axis=0),
+            error)
+        # Error should not be higher than at calibration values
+        discretized = numpy.array([
+            led_set.discretize_intensity(step_intensity, dc=8)
+            for step_intensity in intensity])
+        self.assertTrue(numpy.all(
+            error <= numpy.sum((discretized - intensity)**2, axis=0)))
+
+    def test_optimize_dc_gcal_fixed_dc(self):
+        # Load
+        led_set = lpaprogram.LEDSet(name='TestLEDSet', file_name=self.file_name)
+        intensity = numpy.linspace(0, 5, 20)
+        dc, gcal, error = led_set.optimize_dc_gcal(intensity,
+                                                   min_dc=8,
+                                                   max_dc=8,
+                                                   row=1,
+                                                   col=2)
+        self.assertEqual(dc[0], 8)
+        self.assertEqual(len(gcal), 1)
+
+    def test_optimize_dc_gcal_error(self):
+        # Load
+        led_set = lpaprogram.LEDSet(name='TestLEDSet', file_name=self.file_name)
+        with self.assertRaises(ValueError):
+            led_set.optimize_dc_gcal(numpy.ones((5, 24))*1e4)
+        with self.assertRaises(ValueError):
+            led_set.optimize_dc_gcal(-numpy.ones((5, 24)))
+
+    def test_get_dc_table(self):
+        # Load
+        led_set = lpaprogram.LEDSet(name='TestLEDSet', file_name=self.file_name)
+        table = led_set.get_dc_table(gcal=215)
+        self.assertEqual(table['max_intensity'].shape, (4, 6, 64))
+        self.assertEqual(table['resolution'].shape, (4, 6, 64))
+        # Tables should be cached
+        self.assertIs(led_set.get_dc_table(gcal=215), table)
+        self.assertIsNot(led_set.get_dc_table(), table)
+        # Compare with get_intensity
+        for dc in [0, 1, 8, 63]:
+            numpy.testing.assert_almost_equal(
+                table['max_intensity'][:,:,dc].flatten(),
+                led_set.get_intensity(gs=4095, dc=dc, gcal=215),
+                decimal=12)
+            numpy.testing.assert_almost_equal(
+                table['resolution'][:,:,dc].flatten(),
+                led_set.get_intensity(gs=1, dc=dc, gcal=215),
+                decimal=12)
+
+    def test_get_max_intensity_resolution(self):
+        # Load
+        led_set = lpaprogram.LEDSet(name='TestLEDSet', file_name=self.file_name)
+        row = [0, 0, 3]
+        col = [4, 5, 0]
+        dc = numpy.array([8, 7, 4])
+        numpy.testing.assert_almost_equal(
+            led_set.get_max_intensity(dc=dc, gcal=215, row=row, col=col),
+            led_set.get_intensity(gs=4095, dc=dc, gcal=215, row=row, col=col),
+            decimal=12)
+        numpy.testing.assert_almost_equal(
+            led_set.get_resolution(dc=dc, row=row, col=col),
+            led_set.get_intensity(gs=1, dc=dc, row=row, col=col),
+            decimal=12)
+        # All wells
+        self.assertEqual(len(led_set.get_max_intensity(dc=8)), 24)
+
+    def test_get_lut(self):
+        # Load
+        led_set = lpaprogram.LEDSet(name='TestLEDSet', file_name=self.file_name)
+        dc = numpy.arange(24) % 8 + 1
+        lut = led_set.get_lut(dc=dc, gcal=215)
+        self.assertEqual(lut.shape, (24, 4096))
+        self.assertFalse(lut.flags.writeable)
+        # Tables should be cached
+        self.assertIs(led_set.get_lut(dc=dc, gcal=215), lut)
+        self.assertIsNot(led_set.get_lut(), lut)
+        # Values should be identical to the ones calculated arithmetically
+        gs = numpy.arange(4096, dtype=float)[:, numpy.newaxis]
+        numpy.testing.assert_array_equal(
+            lut.T,
+            led_set.get_intensity(gs=gs, dc=dc, gcal=215))
+        # Least recently used tables are discarded
+        for dc in range(1, led_set.lut_cache_size + 2):
+            led_set.get_lut(dc=dc)
+        self.assertEqual(len(led_set._luts), led_set.lut_cache_size)
+        self.assertIsNot(led_set.get_lut(dc=1), led_set.get_lut(dc=1.5))
+
+    def test_get_lut_threads(self):
+        # Load
+        led_set = lpaprogram.LEDSet(name='TestLEDSet', file_name=self.file_name)
+        errors = []
+        def get_luts():
+            try:
+                for i in range(200):
+                    dc = i % (2*led_set.lut_cache_size) + 1
+                    lut = led_set.get_lut(dc=dc)
+                    numpy.testing.assert_array_equal(
+                        lut[:, 4095],
+                        led_set.get_intensity(gs=4095., dc=dc))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=get_luts) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(led_set._luts), led_set.lut_cache_size)
+
+    def test_get_intensity_lut(self):
+        # Load
+        led_set = lpaprogram.LEDSet(name='TestLEDSet', file_name=self.file_name)
+        gs = numpy.random.randint(0, 4096, size=(100, 24)).astype(numpy.uint16)
+        dc = numpy.arange(24) % 8 + 1
+        # Integer grayscale values are looked up, which should give the same
+        # results as converting float values.
+        numpy.testing.assert_array_equal(
+            led_set.get_intensity(gs=gs, dc=dc, gcal=215),
+            led_set.get_intensity(gs=gs.astype(float), dc=dc, gcal=215))
+        self.assertEqual(len(led_set._luts), 1)
+        # Discretized values should not change when discretized again
+        intensity = led_set.get_intensity(gs=gs, dc=dc, gcal=215)
+        numpy.testing.assert_array_equal(
+            led_set.discretize_intensity(intensity, dc=dc, gcal=215),
+            intensity)
+        # Lookup tables should not be pickled
+        led_set_2 = pickle.loads(pickle.dumps(led_set))
+        self.assertIsNone(led_set_2._luts)
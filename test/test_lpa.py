@@ -1361,6 +1361,83 @@ class TestLPA(unittest.TestCase):
         self.assertEqual(lpf.n_steps, self.n_steps_to_save_exp)
         numpy.testing.assert_array_equal(lpf.grayscale, self.gs_to_save_exp)
 
+    def test_save_lpf_workers(self):
+        # Create object
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'],
+                             dc_lock=False,
+                             engine=lpaprogram.ConversionEngine(chunk_steps=2,
+                                                                n_workers=3))
+        lpa.dc = self.dc_to_save
+        lpa.gcal = self.gcal_to_save
+        lpa.intensity = self.intensity_to_save
+        lpa.step_size = self.step_size_to_save
+        # Save
+        lpa.save_lpf(os.path.join(self.temp_dir, 'program.lpf'))
+        # Load file and compare with expected contents
+        lpf_file_name = os.path.join(self.temp_dir, 'program.lpf')
+        lpf = lpaprogram.LPF(lpf_file_name)
+        self.assertEqual(lpf.n_steps, self.n_steps_to_save_exp)
+        numpy.testing.assert_array_equal(lpf.grayscale, self.gs_to_save_exp)
+
+    def test_save_lpf_pipelined(self):
+        # Create object
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'],
+                             dc_lock=False,
+                             engine=lpaprogram.ConversionEngine(chunk_steps=3))
+        lpa.set_all_dc(8)
+        lpa.set_all_gcal(255)
+        lpa.set_n_steps(500)
+        lpa.intensity[:] = numpy.random.rand(500, 4, 6, 2)*5
+        # Save with and without pipelining
+        for queue_depth in [0, 1, 4]:
+            lpa.save_lpf(os.path.join(self.temp_dir,
+                                      'program_{}.lpf'.format(queue_depth)),
+                         queue_depth=queue_depth)
+        for queue_depth in [1, 4]:
+            self.assertTrue(filecmp.cmp(
+                os.path.join(self.temp_dir, 'program_0.lpf'),
+                os.path.join(self.temp_dir,
+                             'program_{}.lpf'.format(queue_depth)),
+                shallow=False))
+        lpf = lpaprogram.LPF(os.path.join(self.temp_dir, 'program_4.lpf'))
+        self.assertEqual(lpf.n_steps, 500)
+        numpy.testing.assert_array_equal(lpf.grayscale,
+                                         lpa.grayscale.reshape(500, -1))
+
+    def test_save_lpf_pipelined_error(self):
+        # Create object
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'],
+                             dc_lock=False,
+                             engine=lpaprogram.ConversionEngine(chunk_steps=3))
+        lpa.set_all_dc(8)
+        lpa.set_all_gcal(255)
+        lpa.set_n_steps(500)
+        lpa.intensity[:] = 1.
+        lpa.intensity[400, 1, 2, 0] = 1e4
+        file_name = os.path.join(self.temp_dir, 'program.lpf')
+        errmsg = "on LPA Jennie, step 400, channel 0: not possible to " +\
+            "generate requested intensity with provided dc value. "
+        with six.assertRaisesRegex(self, ValueError, errmsg):
+            lpa.save_lpf(file_name, queue_depth=2)
+        # Partially written file should have been removed
+        self.assertFalse(os.path.exists(file_name))
+        self.assertEqual(os.listdir(self.temp_dir), [])
+        # An existing file should not be modified
+        lpa.intensity[400, 1, 2, 0] = 1.
+        lpa.save_lpf(file_name, queue_depth=2)
+        with open(file_name, 'rb') as f:
+            contents = f.read()
+        lpa.intensity[400, 1, 2, 0] = 1e4
+        for queue_depth in [0, 2]:
+            with six.assertRaisesRegex(self, ValueError, errmsg):
+                lpa.save_lpf(file_name, queue_depth=queue_depth)
+            with open(file_name, 'rb') as f:
+                self.assertEqual(f.read(), contents)
+            self.assertEqual(os.listdir(self.temp_dir), ['program.lpf'])
+
     def test_save_lpf_one_led_set(self):
         # Create object
         lpa = lpaprogram.LPA(name='Jennie',
@@ -1526,6 +1603,28 @@ class TestLPA(unittest.TestCase):
                                               self.discretize_intensity_exp_ch1,
                                               decimal=12)
 
+    def test_discretize_intensity_error_diffusion(self):
+        # Create object
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'])
+        # Set intensities between grayscale levels
+        lpa.set_n_steps(100)
+        lpa.intensity[:, :, :, 0] = 0.013
+        lpa.intensity[:, :, :, 1] = 2.37
+        total_exp = numpy.sum(lpa.intensity, axis=0)
+        # Discretize
+        lpa.discretize_intensity(method='error_diffusion')
+        # Each well alternates between the two closest possible values, such
+        # that the total dose is preserved
+        step_intensity = 1./lpa.engine.get_factors(led_sets=lpa.led_sets,
+                                                   dc=lpa.dc,
+                                                   gcal=lpa.gcal)
+        self.assertTrue(numpy.all(
+            numpy.abs(lpa.intensity - total_exp/100.) < step_intensity))
+        total = numpy.sum(lpa.intensity, axis=0)
+        self.assertTrue(numpy.all(
+            numpy.abs(total - total_exp) <= step_intensity/2.*(1 + 1e-9)))
+
     def test_discretize_intensity_one_led_set(self):
         # Create object
         lpa = lpaprogram.LPA(name='Jennie',
@@ -1566,6 +1665,56 @@ class TestLPA(unittest.TestCase):
                                               0,
                                               decimal=12)
 
+    def test_discretize_intensity_error_step(self):
+        # Create object
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'],
+                             dc_lock=False)
+        lpa.set_all_dc(8)
+        lpa.set_all_gcal(255)
+        lpa.set_n_steps(10)
+        lpa.intensity[:, :, :, 1] = 5.
+        # Intensity too high on step 6
+        lpa.intensity[6, 2, 3, 1] = 1e4
+        errmsg = "on step 6, channel 1: not possible to generate requested " +\
+            "intensity with provided dc value. "
+        with six.assertRaisesRegex(self, ValueError, errmsg):
+            lpa.discretize_intensity()
+        # The earliest step should be reported, regardless of channel
+        lpa.intensity[3, 1, 1, 0] = 1e4
+        lpa.intensity[3, 0, 0, 1] = 1e4
+        lpa.intensity[2, 3, 5, 1] = 1e4
+        errmsg = "on step 2, channel 1: not possible to generate requested " +\
+            "intensity with provided dc value. "
+        for n_workers in [1, 4]:
+            lpa.engine = lpaprogram.ConversionEngine(chunk_steps=1,
+                                                     n_workers=n_workers)
+            with six.assertRaisesRegex(self, ValueError, errmsg):
+                lpa.discretize_intensity()
+
+    def test_grayscale_round_trip(self):
+        # Create object
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'],
+                             dc_lock=False)
+        lpa.set_all_dc(8, channel=0)
+        lpa.set_all_gcal(225, channel=0)
+        lpa.set_all_dc(7, channel=1)
+        lpa.set_all_gcal(255, channel=1)
+        # Set random grayscale values
+        gs = numpy.random.randint(0, 4096, size=(20, 4, 6, 2))
+        lpa.grayscale = gs.astype(numpy.uint16)
+        self.assertEqual(lpa.intensity.shape, (20, 4, 6, 2))
+        numpy.testing.assert_array_equal(lpa.grayscale, gs)
+        # Values should be the same as those obtained from each LED set
+        for channel in range(2):
+            numpy.testing.assert_array_equal(
+                lpa.intensity[:,:,:,channel].reshape(20, -1),
+                lpa.led_sets[channel].get_intensity(
+                    gs=gs[:,:,:,channel].reshape(20, -1).astype(float),
+                    dc=lpa.dc[:,:,channel].flatten(),
+                    gcal=lpa.gcal[:,:,channel].flatten()))
+
     def test_optimize_dc_1(self):
         # Create object
         lpa = lpaprogram.LPA(name='Jennie',
@@ -1654,3 +1803,122 @@ class TestLPA(unittest.TestCase):
         # Test
         numpy.testing.assert_array_equal(lpa.dc[:,:,0], 8)
         numpy.testing.assert_array_equal(lpa.dc[:,:,1], 7)
+
+    def test_check_feasibility(self):
+        lpa = lpaprogram.LPA(name='Jennie', layout_names=['520-2-KB', '660-LS'])
+        lpa.set_n_steps(100)
+        lpa.intensity.fill(5.)
+        # No violations
+        report = lpa.check_feasibility()
+        self.assertTrue(report.feasible)
+        self.assertEqual(len(report), 0)
+        # Add violations
+        lpa.intensity[10:20, 1, 2, 0] = 100.
+        lpa.intensity[40:45, 1, 2, 0] = 50.
+        lpa.intensity[30:35, 0, 0, 1] = 1000.
+        lpa.intensity[50, 3, 5, 1] = -1.
+        # Small chunks test merging of ranges across chunks
+        report = lpa.check_feasibility(chunk_steps=15)
+        self.assertFalse(report.feasible)
+        self.assertEqual(
+            [(v['channel'], v['row'], v['col'], v['step_start'],
+              v['step_stop'], v['reason']) for v in report],
+            [(0, 1, 2, 10, 20, 'above maximum'),
+             (0, 1, 2, 40, 45, 'above maximum'),
+             (1, 0, 0, 30, 35, 'above maximum'),
+             (1, 3, 5, 50, 51, 'negative')])
+        violations = report.violations
+        self.assertEqual(violations[0]['max_intensity'], 100.)
+        self.assertGreater(violations[0]['excess'], 0)
+        numpy.testing.assert_almost_equal(
+            violations[0]['max_grayscale'] - violations[0]['excess'], 4095)
+        self.assertIsNone(violations[2]['required_dc'])
+        self.assertIsNone(violations[3]['required_dc'])
+        # Required dc should make the violation go away
+        lpa.dc_lock = False
+        lpa.dc[1, 2, 0] = violations[0]['required_dc']
+        report = lpa.check_feasibility()
+        self.assertEqual(len(report), 2)
+        self.assertEqual(report.violations[0]['channel'], 1)
+        # Table
+        table = report.to_dataframe()
+        self.assertEqual(len(table), 2)
+        self.assertEqual(list(table.columns),
+                         lpaprogram.FeasibilityReport.columns)
+
+    def test_check_feasibility_required_dc(self):
+        lpa = lpaprogram.LPA(name='Jennie', layout_names=['520-2-KB', '660-LS'])
+        lpa.set_n_steps(10)
+        lpa.intensity[:,:,:,0] = 40.
+        report = lpa.check_feasibility()
+        # Required dc values should match LPA.optimize_dc()
+        required_dc = numpy.zeros((4, 6), dtype=int)
+        for v in report:
+            self.assertEqual(v['step_start'], 0)
+            self.assertEqual(v['step_stop'], 10)
+            required_dc[v['row'], v['col']] = v['required_dc']
+        lpa.dc_lock = False
+        lpa.optimize_dc(0)
+        numpy.testing.assert_array_equal(
+            required_dc[required_dc > 0],
+            lpa.dc[:,:,0][required_dc > 0])
+
+    def test_optimize_dc_gcal(self):
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'],
+                             dc_lock=False)
+        lpa.set_n_steps(100)
+        lpa.intensity[:,:,:,0] = numpy.linspace(0.1, 20, 100)[:,None,None]
+        lpa.intensity[:,:,:,1] = 3.
+        lpa.intensity[50:,:,:,1] = 7.
+        result = lpa.optimize_dc_gcal()
+        self.assertEqual(result['error_before'].shape, (4, 6, 2))
+        self.assertTrue(numpy.all(
+            result['error_after'] <= result['error_before']))
+        # All intensities should be feasible
+        self.assertTrue(lpa.check_feasibility().feasible)
+        # Reported error should match discretization error
+        intensity = lpa.intensity.copy()
+        lpa.discretize_intensity()
+        numpy.testing.assert_almost_equal(
+            numpy.sum((lpa.intensity - intensity)**2, axis=0),
+            result['error_after'])
+
+    def test_optimize_dc_gcal_one_led_set(self):
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', None],
+                             dc_lock=False)
+        lpa.intensity.fill(5.)
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            result = lpa.optimize_dc_gcal()
+            self.assertEqual(len(w), 1)
+        self.assertTrue(numpy.all(numpy.isnan(result['error_after'][:,:,1])))
+        self.assertFalse(numpy.any(numpy.isnan(result['error_after'][:,:,0])))
+
+    def test_optimize_dc_gcal_dc_lock(self):
+        lpa = lpaprogram.LPA(name='Jennie', layout_names=['520-2-KB', '660-LS'])
+        with six.assertRaisesRegex(self, TypeError, "dc attribute is locked"):
+            lpa.optimize_dc_gcal()
+
+    def test_dc_table_summary(self):
+        lpa_1 = lpaprogram.LPA(name='Jennie',
+                               layout_names=['520-2-KB', '660-LS'])
+        lpa_2 = lpaprogram.LPA(name='Jennie',
+                               layout_names=['520-2-KB', None])
+        summary = lpaprogram.dc_table_summary([lpa_1, lpa_2], dc=[4, 8])
+        self.assertEqual(len(summary), 6)
+        self.assertEqual(list(summary['Channel']), [0, 0, 1, 1, 0, 0])
+        self.assertEqual(list(summary['DC']), [4, 8, 4, 8, 4, 8])
+        max_intensity = lpa_1.led_sets[0].get_intensity(gs=4095, dc=8)
+        numpy.testing.assert_almost_equal(summary['Max Max Intensity'][1],
+                                          max_intensity.max())
+        numpy.testing.assert_almost_equal(summary['Min Max Intensity'][1],
+                                          max_intensity.min())
+        # Default includes dc values from 1 to 63
+        summary = lpaprogram.dc_table_summary([lpa_1], gcal=255)
+        self.assertEqual(len(summary), 2*63)
+        # No LPAs
+        summary_empty = lpaprogram.dc_table_summary([])
+        self.assertEqual(len(summary_empty), 0)
+        self.assertEqual(list(summary_empty.columns), list(summary.columns))
@@ -0,0 +1,112 @@
+"""
+Unit tests for comparing light program files
+
+"""
+
+import os
+import shutil
+import unittest
+
+import numpy
+import six
+
+import lpaprogram
+
+class TestLPFDiff(unittest.TestCase):
+    """
+    Tests for diff_lpf and the LPFDiff class.
+
+    """
+    def setUp(self):
+        lpaprogram.LED_CALIBRATION_PATH = "test/test_lpa_files/led-calibration"
+        # Directory where to save temporary files
+        self.temp_dir = "test/temp_lpf_diff"
+        if not os.path.exists(self.temp_dir):
+            os.makedirs(self.temp_dir)
+        self.file_name_a = "test/test_lpf_files/program.lpf"
+        self.file_name_b = os.path.join(self.temp_dir, 'program.lpf')
+        self.lpf = lpaprogram.LPF(self.file_name_a)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_diff_lpf_identical(self):
+        self.lpf.save(self.file_name_b)
+        diff = lpaprogram.diff_lpf(self.file_name_a, self.file_name_b)
+        self.assertTrue(diff.identical)
+        self.assertEqual(len(diff), 0)
+        self.assertEqual(diff.max_delta, 0)
+        self.assertEqual(diff.n_changed_steps, 0)
+        self.assertEqual(diff.n_channels, 48)
+        self.assertEqual(diff.n_steps_a, 61)
+        self.assertEqual(len(diff.to_dataframe()), 0)
+
+    def test_diff_lpf(self):
+        gs = self.lpf.grayscale
+        gs[10:20, 3] = 4095 - gs[10:20, 3]
+        gs[15:25, 40] = (gs[15:25, 40] + 7) % 4096
+        gs[60, 47] = (gs[60, 47] + 1) % 4096
+        self.lpf.save(self.file_name_b)
+        gs_exp = lpaprogram.LPF(self.file_name_a).grayscale.astype(int)
+        for chunk_steps in [1, 4, 65536]:
+            diff = lpaprogram.diff_lpf(self.file_name_a,
+                                       self.file_name_b,
+                                       chunk_steps=chunk_steps)
+            self.assertFalse(diff.identical)
+            self.assertEqual(
+                [(d['channel'], d['step_start'], d['step_stop'])
+                 for d in diff],
+                [(3, 10, 20), (40, 15, 25), (47, 60, 61)])
+            self.assertEqual(
+                [d['max_delta'] for d in diff],
+                [numpy.abs(gs_exp[10:20, 3] - gs[10:20, 3]).max(),
+                 numpy.abs(gs_exp[15:25, 40] - gs[15:25, 40]).max(),
+                 1])
+            self.assertEqual(diff.max_delta,
+                             numpy.abs(gs_exp - gs.astype(int)).max())
+            self.assertEqual(diff.n_changed_steps, 16)
+            self.assertIsNone(diff.differences[0]['max_intensity_delta'])
+        summary = diff.channel_summary()
+        self.assertEqual(list(summary['channel']), [3, 40, 47])
+        self.assertEqual(list(summary['n_changed_steps']), [10, 10, 1])
+
+    def test_diff_lpf_intensity(self):
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', None])
+        gs = self.lpf.grayscale
+        gs[0, 2] = (gs[0, 2] + 100) % 4096
+        gs[0, 3] = (gs[0, 3] + 100) % 4096
+        self.lpf.save(self.file_name_b)
+        diff = lpaprogram.diff_lpf(self.file_name_a,
+                                   self.file_name_b,
+                                   lpa=lpa)
+        # LPF channel 2 is row 0, column 1, LPA channel 0
+        intensity = lpa.led_sets[0].get_intensity(
+            gs=diff.differences[0]['max_delta'],
+            dc=lpa.dc[:, :, 0].flatten(),
+            gcal=lpa.gcal[:, :, 0].flatten())
+        self.assertAlmostEqual(diff.differences[0]['max_intensity_delta'],
+                               intensity[1])
+        # No LED set for LPA channel 1
+        self.assertIsNone(diff.differences[1]['max_intensity_delta'])
+
+    def test_diff_lpf_header(self):
+        self.lpf.grayscale = self.lpf.grayscale[:50]
+        self.lpf.n_steps = 50
+        self.lpf.step_size = 2000
+        self.lpf.save(self.file_name_b)
+        diff = lpaprogram.diff_lpf(self.file_name_a, self.file_name_b)
+        self.assertFalse(diff.identical)
+        self.assertEqual(len(diff), 0)
+        self.assertEqual((diff.n_steps_a, diff.n_steps_b), (61, 50))
+        self.assertEqual((diff.step_size_a, diff.step_size_b), (1000, 2000))
+        self.assertIn("different number of steps: 61 vs. 50", str(diff))
+
+    def test_diff_lpf_channels_error(self):
+        self.lpf.grayscale = self.lpf.grayscale[:, :24]
+        self.lpf.n_channels = 24
+        self.lpf.save(self.file_name_b)
+        with six.assertRaisesRegex(self,
+                                   ValueError,
+                                   "different number of channels: 48 vs. 24"):
+            lpaprogram.diff_lpf(self.file_name_a, self.file_name_b)
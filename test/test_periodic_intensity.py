@@ -0,0 +1,197 @@
+"""
+Unit tests for the PeriodicIntensity class
+
+"""
+
+import filecmp
+import os
+import shutil
+import unittest
+
+import numpy
+import six
+
+import lpaprogram
+
+class TestPeriodicIntensity(unittest.TestCase):
+    """
+    Tests for the PeriodicIntensity class.
+
+    """
+    def setUp(self):
+        lpaprogram.LED_CALIBRATION_PATH = "test/test_lpa_files/led-calibration"
+        # Directory where to save temporary files
+        self.temp_dir = "test/temp_periodic_intensity"
+        if not os.path.exists(self.temp_dir):
+            os.makedirs(self.temp_dir)
+        self.lpa = lpaprogram.LPA(name='Jennie',
+                                  layout_names=['520-2-KB', '660-LS'])
+        self.cycle = numpy.random.rand(7, 4, 6, 2)*5
+        self.prefix = numpy.random.rand(3, 4, 6, 2)*5
+        self.suffix = numpy.random.rand(2, 4, 6, 2)*5
+        self.intensity = lpaprogram.PeriodicIntensity(cycle=self.cycle,
+                                                      n_repeats=10,
+                                                      prefix=self.prefix,
+                                                      suffix=self.suffix)
+        self.intensity_exp = numpy.concatenate(
+            [self.prefix, numpy.tile(self.cycle, (10, 1, 1, 1)), self.suffix])
+
+    def tearDown(self):
+        lpaprogram.instrumentation.disable()
+        lpaprogram.instrumentation.reset()
+        shutil.rmtree(self.temp_dir)
+
+    def test_create(self):
+        self.assertEqual(self.intensity.shape, (75, 4, 6, 2))
+        self.assertEqual(len(self.intensity), 75)
+        self.assertIsNone(self.intensity.dense)
+        self.assertEqual(
+            [(len(s), first_step, n_repeats)
+             for s, first_step, n_repeats in self.intensity.segments],
+            [(3, 0, 1), (7, 3, 10), (2, 73, 1)])
+        # No prefix or suffix
+        intensity = lpaprogram.PeriodicIntensity(self.cycle, 3)
+        self.assertEqual(intensity.shape, (21, 4, 6, 2))
+        self.assertEqual(len(intensity.segments), 1)
+
+    def test_create_error(self):
+        with six.assertRaisesRegex(self, ValueError,
+                                   "cycle should be a 4D array"):
+            lpaprogram.PeriodicIntensity(numpy.zeros((7, 4, 6)), 10)
+        with six.assertRaisesRegex(self, ValueError,
+                                   "prefix dimensions are not appropriate"):
+            lpaprogram.PeriodicIntensity(self.cycle,
+                                         10,
+                                         prefix=numpy.zeros((3, 4, 6, 1)))
+
+    def test_getitem(self):
+        keys = [Ellipsis,
+                0,
+                74,
+                -1,
+                slice(None),
+                slice(5, 40),
+                slice(70, 2, -3),
+                (slice(None), 1, 2, 0),
+                (slice(10, 20), slice(None), 3),
+                (Ellipsis, 1),
+                (numpy.array([0, 4, 11, 73, -2]),),
+                (numpy.array([0, 4, 11]), numpy.array([1, 2, 3])),
+                numpy.arange(75) % 4 == 0,
+                (20, 3, 5)]
+        for key in keys:
+            numpy.testing.assert_array_equal(self.intensity[key],
+                                             self.intensity_exp[key])
+        numpy.testing.assert_array_equal(numpy.asarray(self.intensity),
+                                         self.intensity_exp)
+        with self.assertRaises(IndexError):
+            self.intensity[75]
+
+    def test_get_grayscale(self):
+        lpaprogram.instrumentation.enable()
+        engine = lpaprogram.ConversionEngine()
+        gs = engine.get_grayscale(intensity=self.intensity,
+                                  led_sets=self.lpa.led_sets,
+                                  dc=self.lpa.dc,
+                                  gcal=self.lpa.gcal)
+        gs_exp = engine.get_grayscale(intensity=self.intensity_exp,
+                                      led_sets=self.lpa.led_sets,
+                                      dc=self.lpa.dc,
+                                      gcal=self.lpa.gcal)
+        numpy.testing.assert_array_equal(gs, gs_exp)
+        # Only the stored steps are converted
+        counters = lpaprogram.instrumentation.summary()['counters']
+        self.assertEqual(counters['ConversionEngine.values'],
+                         (12 + 75)*48)
+
+    def test_get_grayscale_error(self):
+        engine = lpaprogram.ConversionEngine()
+        self.cycle[5, 1, 1, 1] = 1e4
+        self.suffix[1, 0, 0, 0] = 1e4
+        intensity = lpaprogram.PeriodicIntensity(cycle=self.cycle,
+                                                 n_repeats=10,
+                                                 prefix=self.prefix,
+                                                 suffix=self.suffix)
+        # The error in the first cycle is reported
+        errmsg = "step 8, channel 1: not possible to generate requested " +\
+            "intensity with provided dc value. "
+        with six.assertRaisesRegex(self, ValueError, errmsg):
+            engine.get_grayscale(intensity=intensity,
+                                 led_sets=self.lpa.led_sets,
+                                 dc=self.lpa.dc,
+                                 gcal=self.lpa.gcal)
+        # Steps of the suffix are numbered after all cycles
+        self.cycle[5, 1, 1, 1] = 1
+        intensity = lpaprogram.PeriodicIntensity(cycle=self.cycle,
+                                                 n_repeats=10,
+                                                 prefix=self.prefix,
+                                                 suffix=self.suffix)
+        errmsg = "step 74, channel 0: not possible to generate requested " +\
+            "intensity with provided dc value. "
+        with six.assertRaisesRegex(self, ValueError, errmsg):
+            engine.get_grayscale(intensity=intensity,
+                                 led_sets=self.lpa.led_sets,
+                                 dc=self.lpa.dc,
+                                 gcal=self.lpa.gcal)
+
+    def test_iter_grayscale(self):
+        engine = lpaprogram.ConversionEngine()
+        gs_exp = engine.get_grayscale(intensity=self.intensity_exp,
+                                      led_sets=self.lpa.led_sets,
+                                      dc=self.lpa.dc,
+                                      gcal=self.lpa.gcal)
+        for block_steps in [None, 1, 20, 1000]:
+            blocks = list(engine.iter_grayscale(intensity=self.intensity,
+                                                led_sets=self.lpa.led_sets,
+                                                dc=self.lpa.dc,
+                                                gcal=self.lpa.gcal,
+                                                block_steps=block_steps))
+            # Blocks are consecutive
+            starts = [start for start, gs in blocks]
+            stops = [start + len(gs) for start, gs in blocks]
+            self.assertEqual(starts[0], 0)
+            self.assertEqual(starts[1:], stops[:-1])
+            numpy.testing.assert_array_equal(
+                numpy.concatenate([gs for start, gs in blocks]),
+                gs_exp)
+
+    def test_discretize_intensity(self):
+        self.lpa.intensity = self.intensity
+        self.lpa.discretize_intensity()
+        self.assertIsInstance(self.lpa.intensity,
+                              lpaprogram.PeriodicIntensity)
+        lpa_exp = lpaprogram.LPA(name='Jennie',
+                                 layout_names=['520-2-KB', '660-LS'])
+        lpa_exp.intensity = self.intensity_exp
+        lpa_exp.discretize_intensity()
+        numpy.testing.assert_array_equal(numpy.asarray(self.lpa.intensity),
+                                         lpa_exp.intensity)
+
+    def test_save_lpf(self):
+        lpaprogram.instrumentation.enable()
+        self.lpa.intensity = lpaprogram.PeriodicIntensity(
+            cycle=self.cycle,
+            n_repeats=500,
+            prefix=self.prefix,
+            suffix=self.suffix)
+        file_name = os.path.join(self.temp_dir, 'program.lpf')
+        self.lpa.save_lpf(file_name)
+        counters = lpaprogram.instrumentation.summary()['counters']
+        self.assertEqual(counters['ConversionEngine.values'], 12*48)
+        # Compare with file generated from the full intensity array
+        lpa_exp = lpaprogram.LPA(name='Jennie',
+                                 layout_names=['520-2-KB', '660-LS'])
+        lpa_exp.intensity = numpy.asarray(self.lpa.intensity)
+        file_name_exp = os.path.join(self.temp_dir, 'program_exp.lpf')
+        lpa_exp.save_lpf(file_name_exp)
+        self.assertTrue(filecmp.cmp(file_name, file_name_exp, shallow=False))
+        # The intensity array is not expanded
+        self.assertIsNone(self.lpa.intensity.dense)
+
+    def test_modify(self):
+        self.lpa.intensity = self.intensity
+        self.lpa.intensity[40, 1, 1, 0] = 2.
+        self.assertIsInstance(self.lpa.intensity, numpy.ndarray)
+        self.intensity_exp[40, 1, 1, 0] = 2.
+        numpy.testing.assert_array_equal(self.lpa.intensity,
+                                         self.intensity_exp)
@@ -0,0 +1,130 @@
+"""
+Unit tests for the SharedCalibration class
+
+"""
+
+import multiprocessing
+import pickle
+import unittest
+
+import numpy
+
+import lpaprogram
+
+def get_grayscale_in_worker(shared_calibration):
+    # Create LPA in a worker process using shared calibration data
+    lpa = lpaprogram.LPA(name='Jennie',
+                         layout_names=['520-2-KB', '660-LS'],
+                         calibration=shared_calibration)
+    lpa.intensity[:,:,:,0] = 10.
+    lpa.intensity[:,:,:,1] = 5.
+    return lpa.grayscale
+
+class TestSharedCalibration(unittest.TestCase):
+    """
+    Tests for the SharedCalibration class.
+
+    """
+    def setUp(self):
+        lpaprogram.LED_CALIBRATION_PATH = "test/test_lpa_files/led-calibration"
+        self.shared_calibration = lpaprogram.SharedCalibration.load(
+            ['Jennie'],
+            ['520-2-KB', '660-LS'])
+
+    def tearDown(self):
+        self.shared_calibration.unlink()
+
+    def test_load(self):
+        led_sets = self.shared_calibration.led_sets
+        self.assertEqual(len(led_sets), 2)
+        self.assertEqual(
+            self.shared_calibration.get_led_set_name('Jennie', 0, '520-2-KB'),
+            'EO_12')
+        self.assertEqual(
+            self.shared_calibration.get_led_set_name('Jennie', 1, '660-LS'),
+            'EO_20')
+        led_set = self.shared_calibration.get_led_set('EO_20', 'Jennie', 1)
+        self.assertEqual(led_set.lpa_name, 'Jennie')
+        self.assertEqual(led_set.channel, 1)
+        self.assertFalse(led_set.measured_intensity.flags.writeable)
+
+    def test_unknown_layout(self):
+        with self.assertRaises(ValueError):
+            self.shared_calibration.get_led_set_name('Jennie', 0, '660-LS')
+        with self.assertRaises(ValueError):
+            self.shared_calibration.get_led_set('EO_20', 'Jennie', 0)
+
+    def test_lpa(self):
+        lpa_file = lpaprogram.LPA(name='Jennie',
+                                  layout_names=['520-2-KB', '660-LS'])
+        lpa_shared = lpaprogram.LPA(name='Jennie',
+                                    layout_names=['520-2-KB', '660-LS'],
+                                    calibration=self.shared_calibration)
+        numpy.testing.assert_array_equal(lpa_file.dc, lpa_shared.dc)
+        numpy.testing.assert_array_equal(lpa_file.gcal, lpa_shared.gcal)
+        for led_set_file, led_set_shared in zip(lpa_file.led_sets,
+                                                lpa_shared.led_sets):
+            numpy.testing.assert_array_equal(
+                led_set_file.measured_intensity,
+                led_set_shared.measured_intensity)
+
+    def test_pickle(self):
+        # Pickled object should only contain a reference to shared memory
+        data = pickle.dumps(self.shared_calibration)
+        self.assertLess(len(data), 1000)
+        shared_calibration = pickle.loads(data)
+        led_set = shared_calibration.get_led_set('EO_12', 'Jennie', 0)
+        led_set_owner = self.shared_calibration.get_led_set('EO_12',
+                                                            'Jennie',
+                                                            0)
+        numpy.testing.assert_array_equal(led_set.measured_intensity,
+                                         led_set_owner.measured_intensity)
+        shared_calibration.close()
+
+    def test_unlink(self):
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'],
+                             calibration=self.shared_calibration)
+        measured_intensity = lpa.led_sets[1].measured_intensity.copy()
+        grayscale = lpa.grayscale
+        self.shared_calibration.unlink()
+        # LEDSet objects should still be usable
+        numpy.testing.assert_array_equal(lpa.led_sets[1].measured_intensity,
+                                         measured_intensity)
+        self.assertFalse(lpa.led_sets[1].measured_intensity.flags.writeable)
+        numpy.testing.assert_array_equal(lpa.grayscale, grayscale)
+        # Unlinking again should have no effect
+        self.shared_calibration.unlink()
+        with self.assertRaises(ValueError):
+            pickle.dumps(self.shared_calibration)
+
+    def test_close(self):
+        shared_calibration = pickle.loads(
+            pickle.dumps(self.shared_calibration))
+        led_set = shared_calibration.get_led_set('EO_12', 'Jennie', 0)
+        measured_intensity = led_set.measured_intensity.copy()
+        name = self.shared_calibration._shm.name
+        self.assertIn(name, lpaprogram._attached_shared_calibration)
+        shared_calibration.close()
+        self.assertNotIn(name, lpaprogram._attached_shared_calibration)
+        numpy.testing.assert_array_equal(led_set.measured_intensity,
+                                         measured_intensity)
+        # Attach again
+        shared_calibration = pickle.loads(
+            pickle.dumps(self.shared_calibration))
+        led_set = shared_calibration.get_led_set('EO_12', 'Jennie', 0)
+        numpy.testing.assert_array_equal(led_set.measured_intensity,
+                                         measured_intensity)
+        shared_calibration.close()
+
+    def test_worker_processes(self):
+        expected = get_grayscale_in_worker(None)
+        pool = multiprocessing.Pool(2)
+        try:
+            results = pool.map(get_grayscale_in_worker,
+                               [self.shared_calibration]*4)
+        finally:
+            pool.close()
+            pool.join()
+        for result in results:
+            numpy.testing.assert_array_equal(result, expected)
@@ -0,0 +1,165 @@
+"""
+Unit tests for compiling experiment specs
+
+"""
+
+import filecmp
+import json
+import os
+import shutil
+import unittest
+
+import numpy
+import six
+
+import lpaprogram
+
+class TestSpec(unittest.TestCase):
+    """
+    Tests for experiment spec compilation and the command line interface.
+
+    """
+    def setUp(self):
+        lpaprogram.LED_CALIBRATION_PATH = "test/test_lpa_files/led-calibration"
+        # Directory where to save temporary files
+        self.temp_dir = "test/temp_spec"
+        if not os.path.exists(self.temp_dir):
+            os.makedirs(self.temp_dir)
+        self.spec = {
+            'calibration_path': os.path.abspath(
+                "test/test_lpa_files/led-calibration"),
+            'output_path': 'output',
+            'step_size': 60000,
+            'n_steps': 120,
+            'layout_names': ['520-2-KB', '660-LS'],
+            'gcal': 255,
+            'lpas': [
+                {'name': 'Jennie',
+                 'channels': [
+                    {'channel': 0,
+                     'staggered': {
+                        'intensity': {'type': 'logspace',
+                                      'start': 0.1,
+                                      'stop': 20,
+                                      'n_steps': 96},
+                        'intensity_pre': 0,
+                        'sampling_steps': {'start': 0, 'step': 4}}},
+                    {'channel': 1,
+                     'intensity': 5},
+                    {'channel': 1,
+                     'rows': [0, 3],
+                     'cols': [0, 5],
+                     'intensity': {'type': 'linspace',
+                                   'start': 0,
+                                   'stop': 10}},
+                    ]},
+                ],
+            }
+        self.spec_file_name = os.path.join(self.temp_dir, 'spec.json')
+        with open(self.spec_file_name, 'w') as f:
+            json.dump(self.spec, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def create_expected_lpa(self, method='round'):
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'])
+        lpa.step_size = 60000
+        lpa.set_n_steps(120)
+        lpa.set_all_gcal(255)
+        lpa.set_timecourse_staggered(
+            intensity=numpy.logspace(-1, numpy.log10(20), 96),
+            intensity_pre=0,
+            sampling_steps=numpy.arange(24)*4,
+            channel=0)
+        lpa.intensity[:,:,:,1] = 5
+        lpa.intensity[:,0,0,1] = numpy.linspace(0, 10, 120)
+        lpa.intensity[:,3,5,1] = numpy.linspace(0, 10, 120)
+        lpa.discretize_intensity(method=method)
+        return lpa
+
+    def test_load_spec(self):
+        spec = lpaprogram.load_spec(self.spec_file_name)
+        self.assertEqual(spec['output_path'],
+                         os.path.join(os.path.abspath(self.temp_dir),
+                                      'output'))
+        self.assertEqual(spec['calibration_path'],
+                         self.spec['calibration_path'])
+
+    def test_compile_spec(self):
+        spec = lpaprogram.load_spec(self.spec_file_name)
+        results = lpaprogram.compile_spec(spec)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['name'], 'Jennie')
+        self.assertEqual(results[0]['n_steps'], 120)
+        self.assertEqual(sorted(results[0]['times'].keys()),
+                         ['discretize', 'load', 'save', 'set'])
+        # Compare with files generated directly
+        lpa = self.create_expected_lpa()
+        lpa.save_files(os.path.join(self.temp_dir, 'expected'))
+        for file_name in ['dc.txt', 'gcal.txt', 'program.lpf']:
+            self.assertTrue(filecmp.cmp(
+                os.path.join(self.temp_dir, 'output', 'Jennie', file_name),
+                os.path.join(self.temp_dir, 'expected', 'Jennie', file_name),
+                shallow=False))
+
+    def test_compile_spec_error_diffusion(self):
+        spec = lpaprogram.load_spec(self.spec_file_name)
+        spec['discretize'] = 'error_diffusion'
+        lpaprogram.compile_spec(spec)
+        # Compare with files generated directly
+        lpa = self.create_expected_lpa(method='error_diffusion')
+        lpa.save_files(os.path.join(self.temp_dir, 'expected'))
+        self.assertTrue(filecmp.cmp(
+            os.path.join(self.temp_dir, 'output', 'Jennie', 'program.lpf'),
+            os.path.join(self.temp_dir, 'expected', 'Jennie', 'program.lpf'),
+            shallow=False))
+
+    def test_compile_spec_dry_run(self):
+        spec = lpaprogram.load_spec(self.spec_file_name)
+        results = lpaprogram.compile_spec(spec, dry_run=True)
+        self.assertIsNone(results[0]['path'])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.temp_dir, 'output')))
+
+    def test_compile_spec_infeasible(self):
+        self.spec['lpas'][0]['channels'][1]['intensity'] = 1000
+        with six.assertRaisesRegex(self, ValueError, "on step 0, channel 1"):
+            lpaprogram.compile_spec(self.spec, dry_run=True)
+
+    def test_compile_spec_default_calibration_path(self):
+        del self.spec['calibration_path']
+        lpaprogram.compile_spec(self.spec, dry_run=True)
+        key = (os.path.abspath(lpaprogram.LED_CALIBRATION_PATH),
+               lpaprogram.LED_LAYOUT_FILENAME)
+        self.assertIn(key, lpaprogram._spec_repositories)
+        # A new default path should use a new repository
+        calibration_path = os.path.join(self.temp_dir, 'led-calibration')
+        shutil.copytree(lpaprogram.LED_CALIBRATION_PATH, calibration_path)
+        lpaprogram.LED_CALIBRATION_PATH = calibration_path
+        lpaprogram.compile_spec(self.spec, dry_run=True)
+        key = (os.path.abspath(calibration_path),
+               lpaprogram.LED_LAYOUT_FILENAME)
+        self.assertEqual(lpaprogram._spec_repositories[key].path,
+                         calibration_path)
+
+    def test_compile_spec_jobs(self):
+        spec = lpaprogram.load_spec(self.spec_file_name)
+        spec['lpas'].append(dict(spec['lpas'][0]))
+        spec['lpas'][1]['layout_names'] = ['520-2-KB', None]
+        results = lpaprogram.compile_spec(spec, jobs=2, dry_run=True)
+        self.assertEqual([result['name'] for result in results],
+                         ['Jennie', 'Jennie'])
+
+    def test_main(self):
+        output_path = os.path.join(self.temp_dir, 'main_output')
+        cache_path = os.path.join(self.temp_dir, 'cache')
+        status = lpaprogram.main([self.spec_file_name,
+                                  '--jobs', '1',
+                                  '--output', output_path,
+                                  '--cache', cache_path])
+        self.assertEqual(status, 0)
+        self.assertTrue(os.path.exists(
+            os.path.join(output_path, 'Jennie', 'program.lpf')))
+        self.assertTrue(os.path.exists(cache_path))
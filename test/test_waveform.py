@@ -0,0 +1,165 @@
+"""
+Unit tests for the Waveform classes
+
+"""
+
+import unittest
+
+import numpy
+import six
+
+import lpaprogram
+
+class TestWaveform(unittest.TestCase):
+    """
+    Tests for the Waveform classes.
+
+    """
+    def setUp(self):
+        self.t = numpy.arange(100)
+
+    def test_constant(self):
+        waveform = lpaprogram.Constant(5)
+        numpy.testing.assert_array_equal(waveform.evaluate(self.t),
+                                         numpy.ones(100)*5)
+
+    def test_ramp(self):
+        waveform = lpaprogram.Ramp(start=1, stop=20, n_steps=50, first_step=10)
+        intensity = waveform.evaluate(self.t)
+        numpy.testing.assert_array_equal(intensity[:10], 1)
+        numpy.testing.assert_allclose(intensity[10:60],
+                                      numpy.linspace(1, 20, 50))
+        numpy.testing.assert_array_equal(intensity[60:], 20)
+
+    def test_log_ramp(self):
+        waveform = lpaprogram.LogRamp(start=0.1, stop=20, n_steps=100)
+        numpy.testing.assert_allclose(
+            waveform.evaluate(self.t),
+            numpy.logspace(numpy.log10(0.1), numpy.log10(20), 100))
+        with six.assertRaisesRegex(self, ValueError,
+                                   "start and stop should be greater than "
+                                   "zero"):
+            lpaprogram.LogRamp(start=0, stop=20, n_steps=100)
+
+    def test_step(self):
+        waveform = lpaprogram.Step(before=1, after=3, step=40)
+        intensity = waveform.evaluate(self.t)
+        numpy.testing.assert_array_equal(intensity[:40], 1)
+        numpy.testing.assert_array_equal(intensity[40:], 3)
+
+    def test_pulse_train(self):
+        waveform = lpaprogram.PulseTrain(intensity=10,
+                                         period=20,
+                                         duration=5,
+                                         first_step=10,
+                                         n_pulses=3,
+                                         baseline=1)
+        intensity_exp = numpy.ones(100)
+        intensity_exp[10:15] = 10
+        intensity_exp[30:35] = 10
+        intensity_exp[50:55] = 10
+        numpy.testing.assert_array_equal(waveform.evaluate(self.t),
+                                         intensity_exp)
+
+    def test_sine(self):
+        waveform = lpaprogram.Sine(mean=10, amplitude=5, period=25, phase=1)
+        numpy.testing.assert_allclose(
+            waveform.evaluate(self.t),
+            10 + 5*numpy.sin(2*numpy.pi*self.t/25. + 1))
+
+    def test_piecewise(self):
+        waveform = lpaprogram.Piecewise(
+            steps=[10, 30, 60],
+            values=[2, lpaprogram.Ramp(0, 29, 30, first_step=30), 4],
+            initial=1)
+        intensity_exp = numpy.ones(100)
+        intensity_exp[10:30] = 2
+        intensity_exp[30:60] = numpy.arange(30)
+        intensity_exp[60:] = 4
+        numpy.testing.assert_allclose(waveform.evaluate(self.t),
+                                      intensity_exp)
+        with six.assertRaisesRegex(self, ValueError,
+                                   "steps should be in increasing order"):
+            lpaprogram.Piecewise(steps=[10, 5], values=[1, 2])
+
+    def test_operations(self):
+        a = lpaprogram.Sine(mean=10, amplitude=5, period=25)
+        b = lpaprogram.Step(before=1, after=3, step=40)
+        a_values = a.evaluate(self.t)
+        b_values = b.evaluate(self.t)
+        numpy.testing.assert_allclose((a + b).evaluate(self.t),
+                                      a_values + b_values)
+        numpy.testing.assert_allclose((a - b).evaluate(self.t),
+                                      a_values - b_values)
+        numpy.testing.assert_allclose((2*a*b + 1).evaluate(self.t),
+                                      2*a_values*b_values + 1)
+        numpy.testing.assert_allclose((10 - a).evaluate(self.t),
+                                      10 - a_values)
+        numpy.testing.assert_allclose((-b).evaluate(self.t), -b_values)
+        with self.assertRaises(TypeError):
+            a + 'b'
+
+    def test_integrate(self):
+        waveforms = [
+            lpaprogram.Constant(5),
+            lpaprogram.Ramp(start=1, stop=20, n_steps=11, first_step=2.5),
+            lpaprogram.LogRamp(start=0.1, stop=20, n_steps=13, first_step=1),
+            lpaprogram.Step(before=1, after=3, step=4.5),
+            lpaprogram.PulseTrain(intensity=10,
+                                  period=4,
+                                  duration=1.5,
+                                  first_step=1,
+                                  n_pulses=3,
+                                  baseline=1),
+            lpaprogram.Sine(mean=10, amplitude=5, period=7, phase=1),
+            lpaprogram.Piecewise(
+                steps=[0, 5, 9.5],
+                values=[2, lpaprogram.Sine(mean=1, amplitude=1, period=3), 4],
+                initial=1),
+            2*lpaprogram.Sine(mean=10, amplitude=5, period=7) -
+            lpaprogram.Step(before=1, after=3, step=4.5) + 1,
+            lpaprogram.Sine(mean=1, amplitude=1, period=7) *
+            lpaprogram.Ramp(start=0, stop=3, n_steps=20),
+        ]
+        t_start = numpy.arange(-2, 30)*0.7
+        t_stop = t_start + 1
+        for waveform in waveforms:
+            # Midpoint rule with many points per interval
+            n_points = 10000
+            t = t_start[:, None] + (numpy.arange(n_points) + 0.5)/n_points
+            integral_exp = waveform.evaluate(t).mean(axis=1)
+            numpy.testing.assert_allclose(
+                waveform.integrate(t_start, t_stop),
+                integral_exp,
+                atol=1e-3)
+            numpy.testing.assert_allclose(
+                waveform.average(t_start, t_stop),
+                integral_exp,
+                atol=1e-3)
+
+    def test_integrate_exact(self):
+        # Integrals of pulses and steps are exact
+        waveform = lpaprogram.PulseTrain(intensity=10, period=3, duration=0.5)
+        numpy.testing.assert_allclose(waveform.integrate(0, 30), 50)
+        numpy.testing.assert_allclose(waveform.average(self.t, self.t + 1),
+                                      numpy.where(self.t % 3 == 0, 5, 0))
+        waveform = lpaprogram.Step(before=1, after=3, step=40.25)
+        average = waveform.average(self.t, self.t + 1)
+        numpy.testing.assert_array_equal(average[:40], 1)
+        self.assertEqual(average[40], 2.5)
+        numpy.testing.assert_array_equal(average[41:], 3)
+        # Averages over intervals of zero length
+        waveform = lpaprogram.Sine(mean=10, amplitude=5, period=25)
+        numpy.testing.assert_allclose(waveform.average(self.t, self.t),
+                                      waveform.evaluate(self.t))
+
+    def test_step_average(self):
+        sine = lpaprogram.Sine(mean=10, amplitude=5, period=3)
+        waveform = lpaprogram.StepAverage(sine)
+        numpy.testing.assert_allclose(waveform.evaluate(self.t),
+                                      sine.average(self.t, self.t + 1))
+        # The total dose is preserved
+        self.assertAlmostEqual(numpy.sum(waveform.evaluate(self.t)),
+                               sine.integrate(0, 100))
+        self.assertNotAlmostEqual(numpy.sum(sine.evaluate(self.t)),
+                                  sine.integrate(0, 100))
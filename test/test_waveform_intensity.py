@@ -0,0 +1,186 @@
+"""
+Unit tests for the WaveformIntensity class
+
+"""
+
+import filecmp
+import os
+import shutil
+import unittest
+
+import numpy
+import six
+
+import lpaprogram
+
+class TestWaveformIntensity(unittest.TestCase):
+    """
+    Tests for the WaveformIntensity class.
+
+    """
+    def setUp(self):
+        lpaprogram.LED_CALIBRATION_PATH = "test/test_lpa_files/led-calibration"
+        # Directory where to save temporary files
+        self.temp_dir = "test/temp_waveform_intensity"
+        if not os.path.exists(self.temp_dir):
+            os.makedirs(self.temp_dir)
+        self.sine = lpaprogram.Sine(mean=10, amplitude=5, period=25)
+        self.ramp = lpaprogram.LogRamp(start=0.1, stop=20, n_steps=100)
+        waveforms = numpy.empty((4, 6, 2), dtype=object)
+        waveforms[:, :, 0] = self.sine
+        waveforms[:, :, 1] = lpaprogram.Constant(3)
+        waveforms[2, 3, 1] = self.ramp
+        self.intensity = lpaprogram.WaveformIntensity(100, waveforms)
+        self.intensity_exp = numpy.zeros((100, 4, 6, 2))
+        self.intensity_exp[:, :, :, 0] = self.sine.evaluate(
+            numpy.arange(100))[:, None, None]
+        self.intensity_exp[:, :, :, 1] = 3
+        self.intensity_exp[:, 2, 3, 1] = self.ramp.evaluate(numpy.arange(100))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_create(self):
+        self.assertEqual(self.intensity.shape, (100, 4, 6, 2))
+        self.assertIsNone(self.intensity.dense)
+
+    def test_getitem(self):
+        keys = [Ellipsis,
+                5,
+                -1,
+                slice(10, 50, 3),
+                (slice(None), 2, 3, 1),
+                (slice(None), 1, slice(2, 4)),
+                (Ellipsis, 1),
+                (numpy.array([0, 4, 11]),),
+                (numpy.array([0, 4, 11]), numpy.array([1, 2, 3])),
+                (20, 3, 5, 0)]
+        for key in keys:
+            numpy.testing.assert_array_equal(self.intensity[key],
+                                             self.intensity_exp[key])
+
+    def test_from_array(self):
+        intensity = lpaprogram.WaveformIntensity.from_array(self.intensity_exp)
+        numpy.testing.assert_array_equal(numpy.asarray(intensity),
+                                         self.intensity_exp)
+        self.assertIsInstance(intensity.waveforms[0, 0, 1],
+                              lpaprogram.Constant)
+        # Other LEDs use a single array, and behave as a Piecewise waveform
+        # with one piece per step
+        waveform = intensity.waveforms[2, 3, 1]
+        self.assertIs(waveform.values.base,
+                      intensity.waveforms[0, 0, 0].values.base)
+        piecewise = lpaprogram.Piecewise(numpy.arange(100),
+                                         self.intensity_exp[:, 2, 3, 1])
+        t = numpy.array([-1, 0, 0.5, 13.25, 99, 150])
+        numpy.testing.assert_array_equal(waveform.evaluate(t),
+                                         piecewise.evaluate(t))
+        numpy.testing.assert_allclose(waveform.integrate(t, t + 2.5),
+                                      piecewise.integrate(t, t + 2.5))
+        # Waveforms are kept when adding steps
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'])
+        lpa.intensity = intensity
+        lpa.set_n_steps(110)
+        numpy.testing.assert_array_equal(lpa.intensity[100:, 2, 3, 1],
+                                         self.intensity_exp[-1, 2, 3, 1])
+        intensity = lpaprogram.WaveformIntensity.from_array(
+            numpy.zeros((0, 4, 6, 2)))
+        self.assertEqual(intensity.shape, (0, 4, 6, 2))
+
+    def test_set_waveform(self):
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'])
+        lpa.set_n_steps(100)
+        lpa.set_waveform(self.sine, channel=0)
+        lpa.set_waveform(3, channel=1)
+        lpa.set_waveform(self.ramp, channel=1, rows=[2], cols=[3])
+        self.assertIsInstance(lpa.intensity, lpaprogram.WaveformIntensity)
+        numpy.testing.assert_array_equal(numpy.asarray(lpa.intensity),
+                                         self.intensity_exp)
+        # Waveforms are evaluated at new steps
+        lpa.set_n_steps(120)
+        numpy.testing.assert_array_equal(
+            lpa.intensity[:, 0, 0, 0],
+            self.sine.evaluate(numpy.arange(120)))
+        lpa.set_n_steps(100)
+        # Modifying a value creates a regular array
+        lpa.intensity[0, 0, 0, 0] = 1.
+        self.assertIsInstance(lpa.intensity, numpy.ndarray)
+        self.intensity_exp[0, 0, 0, 0] = 1.
+        numpy.testing.assert_array_equal(lpa.intensity, self.intensity_exp)
+
+    def test_set_waveform_average(self):
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'])
+        lpa.set_n_steps(100)
+        lpa.set_waveform(self.sine, channel=0, sampling='average')
+        t = numpy.arange(100)
+        numpy.testing.assert_allclose(lpa.intensity[:, 1, 2, 0],
+                                      self.sine.average(t, t + 1))
+        with six.assertRaisesRegex(self, ValueError,
+                                   "sampling method middle not recognized"):
+            lpa.set_waveform(self.sine, channel=0, sampling='middle')
+
+    def test_save_files(self):
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'])
+        lpa.set_n_steps(100)
+        lpa.set_waveform(self.sine, channel=0)
+        lpa.set_waveform(3, channel=1)
+        lpa.set_waveform(self.ramp, channel=1, rows=[2], cols=[3])
+        lpa.discretize_intensity()
+        lpa.save_files(os.path.join(self.temp_dir, 'waveform'))
+        # Compare with files generated from the full intensity array
+        lpa_exp = lpaprogram.LPA(name='Jennie',
+                                 layout_names=['520-2-KB', '660-LS'])
+        lpa_exp.intensity = self.intensity_exp
+        lpa_exp.discretize_intensity()
+        lpa_exp.save_files(os.path.join(self.temp_dir, 'expected'))
+        self.assertTrue(filecmp.cmp(
+            os.path.join(self.temp_dir, 'waveform', 'Jennie', 'program.lpf'),
+            os.path.join(self.temp_dir, 'expected', 'Jennie', 'program.lpf'),
+            shallow=False))
+
+    def test_discretize_intensity(self):
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'])
+        lpa.intensity = self.intensity
+        lpa.discretize_intensity()
+        # Steps are discretized when accessed
+        self.assertIsInstance(lpa.intensity, lpaprogram.LazyIntensity)
+        self.assertIsNone(lpa.intensity.dense)
+        lpa_exp = lpaprogram.LPA(name='Jennie',
+                                 layout_names=['520-2-KB', '660-LS'])
+        lpa_exp.intensity = self.intensity_exp
+        lpa_exp.discretize_intensity()
+        for key in [slice(10, 50, 3),
+                    (numpy.array([[0, 4], [11, 99]]), 1),
+                    (Ellipsis, 1)]:
+            numpy.testing.assert_array_equal(lpa.intensity[key],
+                                             lpa_exp.intensity[key])
+        numpy.testing.assert_array_equal(lpa.grayscale, lpa_exp.grayscale)
+        # Modifying the waveforms doesn't change discretized values
+        self.intensity.waveforms[0, 0, 0] = lpaprogram.Constant(1)
+        numpy.testing.assert_array_equal(lpa.intensity[:, 0, 0, 0],
+                                         lpa_exp.intensity[:, 0, 0, 0])
+        # Values that cannot be generated are found before returning
+        self.intensity.waveforms[1, 2, 1] = lpaprogram.Step(
+            step=70, before=3, after=1e4)
+        lpa.intensity = self.intensity
+        errmsg = "step 70, channel 1: not possible to generate requested " +\
+            "intensity with provided dc value. "
+        with six.assertRaisesRegex(self, ValueError, errmsg):
+            lpa.discretize_intensity()
+        self.assertIs(lpa.intensity, self.intensity)
+
+    def test_build_cache_key(self):
+        lpa = lpaprogram.LPA(name='Jennie',
+                             layout_names=['520-2-KB', '660-LS'])
+        lpa.intensity = self.intensity
+        lpa_exp = lpaprogram.LPA(name='Jennie',
+                                 layout_names=['520-2-KB', '660-LS'])
+        lpa_exp.intensity = self.intensity_exp
+        cache = lpaprogram.BuildCache(os.path.join(self.temp_dir, 'cache'))
+        self.assertEqual(cache.get_key(lpa), cache.get_key(lpa_exp))
+        self.assertIsNone(self.intensity.dense)